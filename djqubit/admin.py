@@ -1,17 +1,245 @@
 """
 Admin config for Qubit models.  This is not going to be comprehensive.
+
+Changelists are built to run a constant number of queries per page:
+term foreign keys are joined with select_related, i18n rows for the
+page (and for the terms on it) are fetched in one query per i18n
+table, and row counts are cached or, on MySQL, estimated for big
+unfiltered tables.
 """
+import hashlib
+
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList, MAX_SHOW_ALL_ALLOWED
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.paginator import Paginator, InvalidPage
+from django.db import connections
+
 from models import InformationObject, Event, Actor, Repository, Term, Taxonomy,\
-        User, Note, DigitalObject, Relation        
-
-admin.site.register(InformationObject)
-admin.site.register(Event)
-admin.site.register(Actor)
-admin.site.register(Repository)
-admin.site.register(Term)
-admin.site.register(Taxonomy)
-admin.site.register(User)
-admin.site.register(Note)
-admin.site.register(DigitalObject)
-admin.site.register(Relation)
+        User, Note, DigitalObject, Relation, I18NMixin, prefetch_i18n, \
+        FALLBACK_CULTURE
+
+# Seconds to cache changelist counts for.
+COUNT_CACHE_TIMEOUT = 300
+
+# Unfiltered MySQL tables estimated to have more rows than this
+# use the (approximate) InnoDB statistics instead of a COUNT(*).
+ESTIMATE_THRESHOLD = 100000
+
+
+def estimated_count(queryset):
+    """Return the storage engine's row estimate for an unfiltered
+    queryset's table, or None if no cheap estimate is available."""
+    if queryset.query.where:
+        return None
+    connection = connections[queryset.db]
+    if connection.vendor != "mysql":
+        return None
+    cursor = connection.cursor()
+    cursor.execute("SELECT TABLE_ROWS FROM information_schema.TABLES"
+            " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+            [queryset.model._meta.db_table])
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+def cached_count(queryset):
+    """Count a queryset, caching the result keyed on its SQL."""
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    key = "djqubit.count.%s" % hashlib.md5(
+            (u"%s|%s|%r" % (queryset.db, sql, params)).encode("utf8")).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = estimated_count(queryset)
+        if count is None or count < ESTIMATE_THRESHOLD:
+            count = queryset.count()
+        cache.set(key, count, COUNT_CACHE_TIMEOUT)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator whose total count comes from cached_count()."""
+    def _get_count(self):
+        if self._count is None:
+            self._count = cached_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+
+class QubitChangeList(ChangeList):
+    """ChangeList which counts through the paginator and prefetches
+    related i18n data for the current page."""
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.query_set, self.list_per_page)
+        result_count = paginator.count
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = cached_count(self.root_query_set)
+
+        can_show_all = result_count <= MAX_SHOW_ALL_ALLOWED
+        multi_page = result_count > self.list_per_page
+
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num+1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = self.model_admin.prefetch(list(result_list))
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
+def display_name(obj):
+    """The i18n display name of an object, or an empty string."""
+    try:
+        return obj.get_i18n(FALLBACK_CULTURE, obj.i18n_name_field) or ""
+    except ObjectDoesNotExist:
+        return ""
+
+
+def related_name_column(field, description):
+    """Changelist column showing the i18n name of a related object."""
+    def column(self, obj):
+        related = getattr(obj, field)
+        if related is None:
+            return ""
+        if isinstance(related, I18NMixin):
+            return display_name(related)
+        return unicode(related)
+    column.short_description = description
+    column.admin_order_field = field
+    return column
+
+
+class QubitAdmin(admin.ModelAdmin):
+    """Base admin for Qubit models."""
+    paginator = CachedCountPaginator
+    # Foreign keys joined into the changelist query.  Any of these
+    # which have i18n data get it prefetched along with the page.
+    related_fields = ()
+    # Foreign keys fetched with one extra query per field rather than
+    # joined.  Needed where the field name clashes with an inheritance
+    # accessor on Object (e.g. Term.taxonomy, Event.actor), which
+    # select_related() would follow instead.
+    bulk_related_fields = ()
+
+    def queryset(self, request):
+        qs = super(QubitAdmin, self).queryset(request)
+        if self.related_fields:
+            qs = qs.select_related(*self.related_fields)
+        return qs
+
+    def get_changelist(self, request, **kwargs):
+        return QubitChangeList
+
+    def prefetch(self, objects):
+        """Prefetch i18n data for a page of objects and their related
+        objects."""
+        for name in self.bulk_related_fields:
+            field = self.model._meta.get_field(name)
+            ids = set(getattr(obj, field.attname) for obj in objects)
+            ids.discard(None)
+            found = field.rel.to._default_manager.in_bulk(list(ids))
+            for obj in objects:
+                setattr(obj, field.get_cache_name(),
+                        found.get(getattr(obj, field.attname)))
+        i18nobjects = [obj for obj in objects if isinstance(obj, I18NMixin)]
+        for field in self.related_fields + self.bulk_related_fields:
+            for obj in objects:
+                related = getattr(obj, field)
+                if isinstance(related, I18NMixin):
+                    i18nobjects.append(related)
+        prefetch_i18n(i18nobjects, [FALLBACK_CULTURE])
+        return objects
+
+    def name(self, obj):
+        return display_name(obj)
+
+
+class InformationObjectAdmin(QubitAdmin):
+    list_display = ("identifier", "name", "level_of_description_name",
+            "repository", "updated_at")
+    related_fields = ("level_of_description", "repository")
+    level_of_description_name = related_name_column(
+            "level_of_description", "Level of description")
+
+
+class ActorAdmin(QubitAdmin):
+    list_display = ("name", "entity_type_name", "description_status_name",
+            "updated_at")
+    related_fields = ("entity_type", "description_status")
+    entity_type_name = related_name_column("entity_type", "Entity type")
+    description_status_name = related_name_column(
+            "description_status", "Description status")
+
+
+class RepositoryAdmin(ActorAdmin):
+    list_display = ("identifier", "name", "description_status_name",
+            "updated_at")
+    related_fields = ("description_status",)
+
+
+class UserAdmin(QubitAdmin):
+    list_display = ("username", "email", "name")
+
+
+class EventAdmin(QubitAdmin):
+    list_display = ("name", "type_name", "information_object",
+            "actor_name", "start_date", "end_date")
+    related_fields = ("type", "information_object")
+    bulk_related_fields = ("actor",)
+    type_name = related_name_column("type", "Type")
+    actor_name = related_name_column("actor", "Actor")
+
+
+class TermAdmin(QubitAdmin):
+    list_display = ("name", "taxonomy_name", "code")
+    bulk_related_fields = ("taxonomy",)
+    taxonomy_name = related_name_column("taxonomy", "Taxonomy")
+
+
+class TaxonomyAdmin(QubitAdmin):
+    list_display = ("name", "usage")
+
+
+class NoteAdmin(QubitAdmin):
+    list_display = ("__unicode__", "type_name", "object_id", "name")
+    related_fields = ("type", "object_id")
+    type_name = related_name_column("type", "Type")
+
+
+class DigitalObjectAdmin(QubitAdmin):
+    list_display = ("name", "mime_type", "media_type_name",
+            "information_object")
+    related_fields = ("media_type", "information_object")
+    media_type_name = related_name_column("media_type", "Media type")
+
+
+class RelationAdmin(QubitAdmin):
+    list_display = ("__unicode__", "subject_id", "object_id", "type_name",
+            "start_date", "end_date")
+    related_fields = ("subject_id", "object_id", "type")
+    type_name = related_name_column("type", "Type")
+
+
+admin.site.register(InformationObject, InformationObjectAdmin)
+admin.site.register(Event, EventAdmin)
+admin.site.register(Actor, ActorAdmin)
+admin.site.register(Repository, RepositoryAdmin)
+admin.site.register(Term, TermAdmin)
+admin.site.register(Taxonomy, TaxonomyAdmin)
+admin.site.register(User, UserAdmin)
+admin.site.register(Note, NoteAdmin)
+admin.site.register(DigitalObject, DigitalObjectAdmin)
+admin.site.register(Relation, RelationAdmin)
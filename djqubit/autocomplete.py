@@ -0,0 +1,394 @@
+"""
+In-memory prefix index over actor and term names for autocompletion.
+
+Answering "names starting with ..." from the database means a LIKE
+scan over actor_i18n, term_i18n and other_name_i18n per keystroke.
+NameIndex instead keeps every authorised actor name, term name and
+other name, in all cultures, folded to lowercase without accents, in
+one sorted list per kind; a lookup is a bisect and a short walk:
+
+    get_index().lookup(u"bundesar", kinds=["actor"])
+    # [("actor", 278, u"Bundesarchiv"), ...]
+
+The index for a database is built on first use, or loaded from
+DJQUBIT_AUTOCOMPLETE_SNAPSHOT if that file exists (the path may hold
+"%s" for the database alias; a freshly built index is saved there).
+A snapshot records the state of the change log and other name table
+it was built from, and is rebuilt when they have moved on.  Writes
+which bypass both, such as raw SQL or other name i18n rows, reach it
+through `./manage.py rebuildautocomplete`.
+
+From then on the index follows saves and deletes of the named rows and
+i18n writes made through set_i18n() in this process.  Writes made in a
+transaction are re-read from the database once it has ended, so that
+names from rolled back transactions never appear: by the writing
+thread's next lookup or finished request, or by any thread once the
+writing thread has exited.
+"""
+
+import cPickle
+import os
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections, router
+from django.db.models import Count, Max, signals
+
+from djqubit import models
+from djqubit.matching import fold
+
+# Results returned by a lookup when no limit is given.
+LIMIT = 10
+
+SNAPSHOT_VERSION = 2
+
+KINDS = ("actor", "term")
+
+# source model: (kind of the named object or None if it varies, i18n field)
+SOURCES = (
+    (models.Actor, "actor", "authorized_form_of_name"),
+    (models.Term, "term", "name"),
+    (models.OtherName, None, "name"),
+)
+
+SPACES = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize(name):
+    """The form names are indexed and looked up by."""
+    return SPACES.sub(u" ", fold(name)).strip()
+
+
+def source_for(model):
+    """(source model, kind, field) for a model or its i18n model, or None."""
+    for source, kind, field in SOURCES:
+        if issubclass(model, source) or model is models.i18n_model(source):
+            return source, kind, field
+    return None
+
+
+def freshness(using):
+    """A marker of the database's state which changes with every logged
+    change and other name save."""
+    marker = []
+    for model, field in ((models.ChangeLog, "pk"), (models.OtherName, "updated_at")):
+        row = model._base_manager.using(using).aggregate(count=Count("pk"), last=Max(field))
+        marker.append((row["count"], row["last"]))
+    return tuple(marker)
+
+
+def owner_kinds():
+    """Map Qubit class names to the kind of object an other name of
+    theirs names."""
+    kinds = {}
+    for classname, model in models.class_models().iteritems():
+        for source, kind, field in SOURCES:
+            if kind is not None and issubclass(model, source):
+                kinds[classname] = kind
+    return kinds
+
+
+class NameIndex(object):
+    """Sorted (key, id, name) tuples per kind, with a record of which
+    row and culture each came from so that it can be replaced."""
+    def __init__(self):
+        self.entries = dict((kind, []) for kind in KINDS)
+        self.sources = {}  # (source name, pk) -> {culture: (kind, entry)}
+        self.owners = {}   # other name pk -> (kind, object id)
+        self.marker = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return (SNAPSHOT_VERSION, self.entries, self.sources, self.owners, self.marker)
+
+    def __setstate__(self, state):
+        if state[0] != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported autocomplete snapshot version %s" % state[0])
+        version, self.entries, self.sources, self.owners, self.marker = state
+        self.lock = threading.Lock()
+
+    @classmethod
+    def build(cls, using=None):
+        """Index every actor, term and other name, in three queries."""
+        index = cls()
+        index.marker = freshness(using or router.db_for_read(models.Actor))
+        owners = models.OtherName._base_manager.values_list(
+                "pk", "object_id", "object_id__class_name")
+        if using is not None:
+            owners = owners.using(using)
+        kinds = owner_kinds()
+        for pk, objectid, classname in owners.iterator():
+            kind = kinds.get(classname)
+            if kind is not None:
+                index.owners[pk] = (kind, objectid)
+        for source, kind, field in SOURCES:
+            rows = models.i18n_model(source)._default_manager.values_list(
+                    "base", "culture", field)
+            if using is not None:
+                rows = rows.using(using)
+            for pk, culture, name in rows.iterator():
+                index._add(source, pk, culture, kind, name)
+        for entries in index.entries.itervalues():
+            entries.sort()
+        return index
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as handle:
+            return cPickle.load(handle)
+
+    def save(self, path):
+        """Write a snapshot of the index to `path`."""
+        tmp = "%s.%d" % (path, os.getpid())
+        with self.lock:
+            with open(tmp, "wb") as handle:
+                cPickle.dump(self, handle, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+    def _add(self, source, pk, culture, kind, name, insert=False):
+        if kind is None:
+            kind, id = self.owners.get(pk, (None, None))
+            if kind is None:
+                return
+        else:
+            id = pk
+        key = normalize(name)
+        if not key:
+            return
+        entry = (key, id, name)
+        self.sources.setdefault((source.__name__, pk), {})[culture] = (kind, entry)
+        if insert:
+            insort(self.entries[kind], entry)
+        else:
+            self.entries[kind].append(entry)
+
+    def _remove(self, source, pk, culture=None):
+        cultures = self.sources.get((source.__name__, pk), {})
+        for value in [culture] if culture is not None else list(cultures):
+            if value not in cultures:
+                continue
+            kind, entry = cultures.pop(value)
+            entries = self.entries[kind]
+            i = bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+        if not cultures:
+            self.sources.pop((source.__name__, pk), None)
+
+    def update(self, source, pk, culture, name, owner=None):
+        """Index `name` as the `source` row's name in `culture`, in
+        place of any earlier one.  `owner` is the (kind, id) named by
+        an other name."""
+        with self.lock:
+            if owner is not None:
+                self.owners[pk] = owner
+            self._remove(source, pk, culture)
+            self._add(source, pk, culture, source_for(source)[1], name, insert=True)
+
+    def refresh(self, source, pks, using):
+        """Re-read the names of the `source` rows `pks` from the
+        database, forgetting those which no longer exist."""
+        kind, field = source_for(source)[1:]
+        rows, owners = [], {}
+        for i in range(0, len(pks), models.PREFETCH_BATCH_SIZE):
+            batch = pks[i:i + models.PREFETCH_BATCH_SIZE]
+            rows.extend(models.i18n_model(source)._default_manager.using(using)
+                    .filter(base__in=batch).values_list("base", "culture", field))
+            if kind is None:
+                owners.update(other_name_owners(batch, using))
+        with self.lock:
+            for pk in pks:
+                self._remove(source, pk)
+                if kind is None:
+                    self.owners.pop(pk, None)
+            self.owners.update(owners)
+            for pk, culture, name in rows:
+                self._add(source, pk, culture, kind, name, insert=True)
+
+    def remove(self, source, pk):
+        """Forget all names of the `source` row."""
+        with self.lock:
+            self._remove(source, pk)
+            if source is models.OtherName:
+                self.owners.pop(pk, None)
+
+    def lookup(self, prefix, kinds=None, limit=LIMIT):
+        """Up to `limit` (kind, id, name) tuples whose names start with
+        `prefix`, ignoring case and accents, in name order.  Each object
+        appears once, under the first of its names to match."""
+        key = normalize(prefix)
+        if not key:
+            return []
+        found = []
+        with self.lock:
+            self._lookup(key, kinds or KINDS, limit, found)
+        found.sort()
+        return [match[1:] for match in found[:limit]]
+
+    def _lookup(self, key, kinds, limit, found):
+        for kind in kinds:
+            entries = self.entries.get(kind, ())
+            seen = set()
+            i = bisect_left(entries, (key,))
+            while i < len(entries) and len(seen) < limit:
+                entry = entries[i]
+                if not entry[0].startswith(key):
+                    break
+                if entry[1] not in seen:
+                    seen.add(entry[1])
+                    found.append((entry[0], kind, entry[1], entry[2]))
+                i += 1
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+# alias: {(source, pk): thread whose transaction changed the row}
+_pending = {}
+
+
+def snapshot_path(using):
+    path = getattr(settings, "DJQUBIT_AUTOCOMPLETE_SNAPSHOT", None)
+    if path and "%s" in path:
+        path = path % using
+    return path
+
+
+def load_index(using, rebuild=False):
+    """Load the snapshot for a database if it is current, otherwise
+    build the index and save a new snapshot."""
+    path = snapshot_path(using)
+    if path and os.path.exists(path) and not rebuild:
+        try:
+            index = NameIndex.load(path)
+        except ValueError:
+            index = None
+        if index is not None and index.marker == freshness(using):
+            return index
+    index = NameIndex.build(using)
+    if path:
+        index.save(path)
+    return index
+
+
+def get_index(using=None):
+    """The name index for a database, loading or building it on first
+    use."""
+    using = using or router.db_for_read(models.Actor)
+    index = _indexes.get(using)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(using)
+            if index is None:
+                index = _indexes[using] = load_index(using)
+    settle(index, using)
+    return index
+
+
+def discard_index(using=None):
+    """Drop the loaded index for a database, so the next lookup loads
+    or rebuilds it."""
+    using = using or router.db_for_read(models.Actor)
+    _indexes.pop(using, None)
+    _pending.pop(using, None)
+
+
+def defer(using, source, pks):
+    """Note rows changed in this thread's open transaction on `using`,
+    for settle() to re-read once it has ended."""
+    thread = threading.current_thread()
+    with _indexes_lock:
+        pending = _pending.setdefault(using, {})
+        for pk in pks:
+            pending[(source, pk)] = thread
+
+
+def settle(index, using):
+    """Re-read the rows changed by transactions which have since been
+    committed or rolled back.  Transaction state is per thread, so
+    only this thread's transactions, and those of threads which have
+    exited, are known to have ended."""
+    current = threading.current_thread()
+    with _indexes_lock:
+        pending = _pending.get(using)
+        if not pending:
+            return
+        clean = not connections[using].is_dirty()
+        ended = [key for key, thread in pending.items()
+                if (clean and thread is current) or not thread.is_alive()]
+        for key in ended:
+            del pending[key]
+    bysource = defaultdict(list)
+    for source, pk in ended:
+        bysource[source].append(pk)
+    for source, pks in bysource.iteritems():
+        index.refresh(source, pks, using)
+
+
+def other_name_owners(pks, using):
+    """Map other name pks to the (kind, id) of the object they name."""
+    kinds = owner_kinds()
+    owners = {}
+    for pk, objectid, classname in models.OtherName._base_manager.using(using)\
+            .filter(pk__in=pks).values_list("pk", "object_id", "object_id__class_name"):
+        if classname in kinds:
+            owners[pk] = (kinds[classname], objectid)
+    return owners
+
+
+def index_i18n_rows(sender, rows, using, **kwargs):
+    index = _indexes.get(using)
+    found = source_for(sender)
+    if index is None or found is None:
+        return
+    source, kind, field = found
+    rows = [(pk, culture, data[field]) for pk, culture, data in rows if field in data]
+    if connections[using].is_dirty():
+        defer(using, source, [pk for pk, culture, name in rows])
+        return
+    owners = {}
+    if kind is None:
+        owners = other_name_owners([pk for pk, culture, name in rows
+                if pk not in index.owners], using)
+    for pk, culture, name in rows:
+        index.update(source, pk, culture, name, owners.get(pk))
+
+
+def index_i18n_save(sender, instance, raw, using, **kwargs):
+    found = source_for(sender)
+    if found is None or issubclass(sender, found[0]):
+        return
+    index_i18n_rows(found[0], [(instance.base_id, instance.culture,
+            {found[2]: getattr(instance, found[2])})], using)
+
+
+def unindex_delete(sender, instance, using, **kwargs):
+    index = _indexes.get(using)
+    found = source_for(sender)
+    if index is None or found is None:
+        return
+    pk = instance.pk if issubclass(sender, found[0]) else instance.base_id
+    if connections[using].is_dirty():
+        defer(using, found[0], [pk])
+    elif issubclass(sender, found[0]):
+        index.remove(found[0], pk)
+    else:
+        with index.lock:
+            index._remove(found[0], pk, instance.culture)
+
+
+def settle_thread(**kwargs):
+    """Re-read the rows this thread's finished transactions changed,
+    e.g. once a request has been committed."""
+    for using, index in _indexes.items():
+        settle(index, using)
+
+
+models.i18n_written.connect(index_i18n_rows, dispatch_uid="djqubit_autocomplete_i18n")
+signals.post_save.connect(index_i18n_save, dispatch_uid="djqubit_autocomplete_save")
+signals.post_delete.connect(unindex_delete, dispatch_uid="djqubit_autocomplete_delete")
+request_finished.connect(settle_thread, dispatch_uid="djqubit_autocomplete_settle")
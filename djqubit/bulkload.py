@@ -0,0 +1,235 @@
+"""
+Bulk load mode for large imports.
+
+With default connection settings every row written by an import pays
+for a synced journal and for maintaining each secondary index as it
+goes.  bulk_load() trades that safety for speed for the duration of a
+load:
+
+    with bulk_load():
+        importer.run(path)
+
+- session settings are relaxed per backend (SQLite: WAL journal,
+  synchronous off, a large page cache and memory-mapped I/O; MySQL:
+  unique_checks and foreign_key_checks off) and restored afterwards;
+- if settings.DJQUBIT_BULK_DEFER_INDEXES is set, the non-unique
+  secondary indexes of the object, information object, slug and i18n
+  tables are dropped and rebuilt once at the end;
+- as foreign keys were not checked, every foreign key of the djqubit
+  models is verified when the load completes, raising IntegrityError
+  if any rows point nowhere.
+
+Changing these settings and indexes commits any open transaction on
+both backends, so enter bulk_load() outside the import's transaction.
+The import commands do this when given --bulk.
+
+Dropping an index is a schema change, not a session setting: every
+other client of the database loses the index until the load ends, and
+the site's queries (and OAI-PMH paging on updated_at) slow down
+accordingly.  Indexes are therefore only deferred when the database is
+known to be used by the load alone, by setting
+DJQUBIT_BULK_DEFER_INDEXES or passing `defer`.
+"""
+
+from contextlib import contextmanager
+from optparse import make_option
+
+from django.conf import settings
+from django.db import connections, router, IntegrityError
+from django.db.models import get_app, get_models
+
+from djqubit import models
+
+SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "OFF"),
+    ("cache_size", "-262144"),  # KiB, i.e. 256MB
+    ("mmap_size", "1073741824"),
+    ("foreign_keys", "OFF"),
+)
+
+MYSQL_VARIABLES = (
+    ("unique_checks", "0"),
+    ("foreign_key_checks", "0"),
+)
+
+# Models whose (and whose i18n models') secondary indexes are deferred
+# when settings.DJQUBIT_BULK_DEFER_INDEXES is set.
+DEFERRED_MODELS = (models.Object, models.InformationObject, models.Slug)
+
+BULK_OPTION = make_option(
+    "--bulk",
+    action="store_true",
+    dest="bulk",
+    default=False,
+    help="Relax database settings (and defer indexes, if "
+         "DJQUBIT_BULK_DEFER_INDEXES is set) for a large load")
+
+
+def deferred_models():
+    """DEFERRED_MODELS and every i18n model."""
+    found = list(DEFERRED_MODELS)
+    for model in get_models(get_app(models.Object._meta.app_label)):
+        if model._meta.db_table.endswith("_i18n") and model not in found:
+            found.append(model)
+    return found
+
+
+class SQLiteSession(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.saved = []
+
+    def relax(self):
+        cursor = self.connection.cursor()
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute("PRAGMA %s" % name)
+            row = cursor.fetchone()
+            if row is not None:
+                self.saved.append((name, row[0]))
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+
+    def restore(self):
+        cursor = self.connection.cursor()
+        for name, value in reversed(self.saved):
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+
+    def drop_indexes(self, table):
+        """Drop the table's explicitly created indexes and return the
+        statements recreating them."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = %s AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%%'",
+                [table])
+        indexes = cursor.fetchall()
+        for name, sql in indexes:
+            cursor.execute("DROP INDEX %s" % self.connection.ops.quote_name(name))
+        return [sql for name, sql in indexes]
+
+
+class MySQLSession(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.saved = []
+
+    def relax(self):
+        cursor = self.connection.cursor()
+        for name, value in MYSQL_VARIABLES:
+            cursor.execute("SELECT @@SESSION.%s" % name)
+            self.saved.append((name, cursor.fetchone()[0]))
+            cursor.execute("SET SESSION %s = %s" % (name, value))
+
+    def restore(self):
+        cursor = self.connection.cursor()
+        for name, value in reversed(self.saved):
+            cursor.execute("SET SESSION %s = %s" % (name, value))
+
+    def drop_indexes(self, table, keep=()):
+        """Drop the table's non-unique indexes, except those starting
+        with a column in `keep` (foreign key constraints need theirs),
+        and return the statement recreating them."""
+        qn = self.connection.ops.quote_name
+        cursor = self.connection.cursor()
+        cursor.execute("SHOW INDEX FROM %s" % qn(table))
+        names = [c[0].lower() for c in cursor.description]
+        indexes = {}
+        for row in cursor.fetchall():
+            row = dict(zip(names, row))
+            if row["non_unique"] and row["key_name"] != "PRIMARY":
+                column = qn(row["column_name"])
+                if row["sub_part"]:
+                    column += "(%d)" % row["sub_part"]
+                indexes.setdefault(row["key_name"], []).append((row["seq_in_index"],
+                        row["column_name"], column))
+        dropped = []
+        for name, columns in sorted(indexes.items()):
+            columns.sort()
+            if columns[0][1] in keep:
+                continue
+            dropped.append((name, ", ".join(c[2] for c in columns)))
+        if not dropped:
+            return []
+        cursor.execute("ALTER TABLE %s %s" % (qn(table),
+                ", ".join("DROP INDEX %s" % qn(name) for name, _ in dropped)))
+        return ["ALTER TABLE %s %s" % (qn(table), ", ".join("ADD INDEX %s (%s)" % (
+                qn(name), columns) for name, columns in dropped))]
+
+
+SESSIONS = {
+    "sqlite": SQLiteSession,
+    "mysql": MySQLSession,
+}
+
+
+def check_foreign_keys(using=None, checked=None):
+    """Return (table, column, count) for each foreign key column of the
+    `checked` models (default all djqubit models) holding values with
+    no matching row."""
+    using = using or router.db_for_write(models.Object)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    problems = []
+    for model in checked or get_models(get_app(models.Object._meta.app_label)):
+        for field in model._meta.local_fields:
+            if field.rel is None:
+                continue
+            target = field.rel.to
+            cursor.execute("SELECT COUNT(*) FROM %s t LEFT JOIN %s r ON t.%s = r.%s "
+                    "WHERE t.%s IS NOT NULL AND r.%s IS NULL" % (
+                        qn(model._meta.db_table), qn(target._meta.db_table),
+                        qn(field.column), qn(field.rel.get_related_field().column),
+                        qn(field.column), qn(field.rel.get_related_field().column)))
+            count = cursor.fetchone()[0]
+            if count:
+                problems.append((model._meta.db_table, field.column, count))
+    return problems
+
+
+@contextmanager
+def bulk_load(using=None, defer=None, check=True):
+    """Run a block in bulk load mode on the given database; see the
+    module docstring.  `defer` lists the models whose indexes are
+    deferred, by default deferred_models() if DJQUBIT_BULK_DEFER_INDEXES
+    is set and none otherwise.  Other backends run the block unchanged."""
+    using = using or router.db_for_write(models.Object)
+    if defer is None:
+        defer = deferred_models() if getattr(settings,
+                "DJQUBIT_BULK_DEFER_INDEXES", False) else []
+    connection = connections[using]
+    session_class = SESSIONS.get(connection.vendor)
+    if session_class is None:
+        yield
+        return
+    session = session_class(connection)
+    session.relax()
+    rebuild = []
+    try:
+        for model in defer:
+            table = model._meta.db_table
+            if connection.vendor == "mysql":
+                keep = set(f.column for f in model._meta.local_fields if f.rel is not None)
+                rebuild.extend(session.drop_indexes(table, keep))
+            else:
+                rebuild.extend(session.drop_indexes(table))
+        yield
+    finally:
+        cursor = connection.cursor()
+        for statement in rebuild:
+            cursor.execute(statement)
+        session.restore()
+    if check:
+        problems = check_foreign_keys(using)
+        if problems:
+            raise IntegrityError("Dangling foreign keys after bulk load: %s" % ", ".join(
+                    "%s.%s (%d rows)" % problem for problem in problems))
+
+
+@contextmanager
+def bulk_load_if(enabled, **kwargs):
+    """bulk_load() when `enabled`, for the commands' --bulk option."""
+    if enabled:
+        with bulk_load(**kwargs):
+            yield
+    else:
+        yield
@@ -0,0 +1,172 @@
+"""
+Incremental change feed over the djqubit change log.
+
+Every insert, update and delete of an Object subclass, and every
+insert or update of its i18n rows, appends a ChangeLog row in the same
+transaction.  Consumers keep an opaque token naming the log rows they
+have seen and ask for what has happened since:
+
+    changes, token = changes_since(token)
+
+Log ids are allocated when a row is written, so a transaction that
+commits late can add rows below ids already handed out.  A token is
+therefore the last id seen plus the ranges of missing ids below it,
+"1234:1201-1203,1230", which later calls re-read until their rows turn
+up or the rows logged after them are older than LOOKBACK, when the
+transaction which held them is taken to have rolled back.  At most
+MAX_GAPS ranges are kept, so gaps left by rollbacks cannot grow a
+token without bound.  Rows are
+never returned twice for one chain of tokens.  Nested-set shifts are
+logged as updates of every row whose lft or rgt moved.
+"""
+
+import datetime
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+
+from djqubit import models
+
+# Default number of log rows per changes_since() call.
+LIMIT = 1000
+
+# How long missing ids are waited for, unless DJQUBIT_CHANGELOG_LOOKBACK
+# gives a number of seconds.
+LOOKBACK = datetime.timedelta(days=1)
+
+# Most missing id ranges a token keeps; the oldest are dropped first.
+MAX_GAPS = 100
+
+
+def parse_token(token):
+    """Return (last id, [(first, last) missing id ranges]) for a token."""
+    if token in (None, ""):
+        return 0, []
+    try:
+        last, _, missing = str(token).partition(":")
+        ranges = []
+        for part in missing.split(","):
+            if part:
+                first, _, end = part.partition("-")
+                ranges.append((int(first), int(end or first)))
+        return int(last), ranges
+    except ValueError:
+        raise ValueError("Invalid change token: %r" % token)
+
+
+def format_token(last, missing):
+    if not missing:
+        return str(last)
+    return "%d:%s" % (last, ",".join(str(first) if first == end else "%d-%d" % (first, end)
+            for first, end in missing))
+
+
+def subtract(ranges, ids):
+    """Remove sorted `ids` from sorted inclusive (first, last) ranges."""
+    result = []
+    ids = list(ids)
+    i = 0
+    for first, end in ranges:
+        while i < len(ids) and ids[i] < first:
+            i += 1
+        while i < len(ids) and ids[i] <= end:
+            if ids[i] > first:
+                result.append((first, ids[i] - 1))
+            first = ids[i] + 1
+            i += 1
+        if first <= end:
+            result.append((first, end))
+    return result
+
+
+def changes_since(token=None, limit=LIMIT, using=None):
+    """Return (changes, token): up to `limit` ChangeLog rows logged
+    after `token` or missing from it, in id order, and the token to
+    resume from.  The token may change even when nothing else has."""
+    last, missing = parse_token(token)
+    qs = models.ChangeLog.objects.all()
+    if using is not None:
+        qs = qs.using(using)
+    found = Q(pk__gt=last)
+    for first, end in missing:
+        found |= Q(pk__range=(first, end))
+    changes = list(qs.filter(found).order_by("pk")[:limit])
+    high = max([last] + [change.pk for change in changes])
+    if high > last + 1:
+        missing.append((last + 1, high - 1))
+    missing = subtract(missing, [change.pk for change in changes])
+
+    # The id just after each range has been seen, so one query finds
+    # when each range was passed over.
+    missing = missing[-MAX_GAPS:]
+    lookback = getattr(settings, "DJQUBIT_CHANGELOG_LOOKBACK", None)
+    lookback = LOOKBACK if lookback is None else datetime.timedelta(seconds=lookback)
+    cutoff = datetime.datetime.now() - lookback
+    passed = dict(qs.filter(pk__in=[end + 1 for first, end in missing])
+            .values_list("pk", "created_at")) if missing else {}
+    waiting = [(first, end) for first, end in missing
+            if passed.get(end + 1, cutoff) >= cutoff]
+    return changes, format_token(high, waiting)
+
+
+def coalesce(changes):
+    """Reduce a list of changes to the latest action per row, keyed on
+    (object id, culture), in order of each row's latest change."""
+    latest = OrderedDict()
+    for change in changes:
+        key = (change.object_id, change.culture)
+        previous = latest.pop(key, None)
+        if previous is not None and previous.action == models.ChangeLog.INSERT \
+                and change.action == models.ChangeLog.UPDATE:
+            change.action = models.ChangeLog.INSERT
+        latest[key] = change
+    return latest.values()
+
+
+def delta(changes):
+    """Generate one dict per changed row, with the row's current data
+    for inserts and updates.  Current data is fetched with one query
+    per model (and one per i18n model)."""
+    changes = coalesce(changes)
+    classes = models.class_models()
+    wanted = {}
+    for change in changes:
+        if change.action == models.ChangeLog.DELETE:
+            continue
+        model = classes.get(change.class_name)
+        if model is None:
+            continue
+        if change.culture is not None:
+            model = models.i18n_model(model)
+        wanted.setdefault(model, set()).add(change.object_id)
+
+    data = {}
+    for model, ids in wanted.iteritems():
+        ids = list(ids)
+        isi18n = not issubclass(model, models.Object)
+        for i in range(0, len(ids), models.PREFETCH_BATCH_SIZE):
+            batch = ids[i:i + models.PREFETCH_BATCH_SIZE]
+            if isi18n:
+                for row in model.objects.filter(base__in=batch).values():
+                    data[(model, row["base_id"], row["culture"])] = row
+            else:
+                for row in model.objects.filter(pk__in=batch).values():
+                    data[(model, row[model._meta.pk.attname], None)] = row
+
+    for change in changes:
+        model = classes.get(change.class_name)
+        row = None
+        if model is not None and change.action != models.ChangeLog.DELETE:
+            if change.culture is not None:
+                model = models.i18n_model(model)
+            row = data.get((model, change.object_id, change.culture))
+        yield {
+            "log_id": change.pk,
+            "action": change.action,
+            "class_name": change.class_name,
+            "id": change.object_id,
+            "culture": change.culture,
+            "changed_at": change.created_at,
+            "data": row,
+        }
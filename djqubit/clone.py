@@ -0,0 +1,204 @@
+"""
+Set-based copying of nested-set subtrees.
+
+clone_subtree() copies a subtree, with its i18n rows, notes, properties,
+other names, slugs and (for information objects) events, under a new
+parent.  Nodes of subclasses, such as repositories in an actor subtree,
+keep their own tables.  Ids are reserved in blocks, lft/rgt move by one constant
+offset, and each table is copied with a single INSERT ... SELECT joined
+to an id map (models.CloneMap) of
+
+    (batch, kind, old_id, new_id, ordinal, new_ref)
+
+rows, where `new_ref` is the row's remapped parent or owner id, worked
+out in Python when the map is filled so that every statement joins the
+map once.  The map is an ordinary table rather than a temporary one
+because creating a table would commit the transaction under SQLite.
+"""
+
+import datetime
+import uuid
+
+from django.db import connections, router, transaction
+from django.db.models import F, Max
+
+from djqubit import models
+from djqubit.subtree import batches, tree_table
+
+# Tables hanging off any copied object, by their `object_id` key.
+DEPENDENTS = (models.Note, models.Property, models.OtherName)
+
+
+class SubtreeCopy(object):
+    """The id map and statements of one clone_subtree() call."""
+    def __init__(self, using):
+        self.connection = connections[using]
+        self.qn = self.connection.ops.quote_name
+        self.cursor = self.connection.cursor()
+        self.now = datetime.datetime.now()
+        self.batch = uuid.uuid4().hex
+        self.map_table = self.qn(models.CloneMap._meta.db_table)
+
+    def clear_map(self):
+        self.cursor.execute("DELETE FROM %s WHERE batch = %%s" % self.map_table,
+                [self.batch])
+
+    def join(self, column):
+        """The join of source rows (t) to their map rows (m)."""
+        return "JOIN %s m ON m.batch = %%s AND m.kind = %%s AND m.old_id = t.%s" % (
+                self.map_table, self.qn(column))
+
+    def fill_map(self, kind, rows, first, ref):
+        """Map the old ids of (old id, old ref) `rows` to consecutive
+        ids from `first`, and return {old: new}.  `ref(old_ref, map)`
+        gives each row's new_ref."""
+        mapping = dict((old, first + i) for i, (old, _) in enumerate(rows))
+        self.cursor.executemany("INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s, %%s, %%s)" % (
+                self.map_table, ", ".join(self.qn(c) for c in
+                    ("batch", "kind", "old_id", "new_id", "ordinal", "new_ref"))),
+                [(self.batch, kind, old, mapping[old], i + 1, ref(oldref, mapping))
+                    for i, (old, oldref) in enumerate(rows)])
+        return mapping
+
+    def copy(self, model, kind, idcolumn="id", overrides=None):
+        """Copy the mapped rows of `model`'s own table, joining the map
+        on `idcolumn`.  `overrides` maps columns to SQL expressions over
+        t (the source row) and m (its map row)."""
+        qn = self.qn
+        overrides = overrides or {}
+        columns, values, params = [], [], []
+        for field in model._meta.local_fields:
+            columns.append(qn(field.column))
+            if field.column in overrides:
+                values.append(overrides[field.column])
+            elif field.column == idcolumn:
+                values.append("m.new_id")
+            elif field.name in ("created_at", "updated_at"):
+                values.append("%s")
+                params.append(self.now)
+            elif field.name == "serial_number":
+                values.append("0")
+            else:
+                values.append("t.%s" % qn(field.column))
+        table = qn(model._meta.db_table)
+        self.cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s t %s" % (
+                table, ", ".join(columns), ", ".join(values), table, self.join(idcolumn)),
+                params + [self.batch, kind])
+
+    def concat(self, *parts):
+        if self.connection.vendor == "mysql":
+            return "CONCAT(%s)" % ", ".join(parts)
+        return " || ".join(parts)
+
+    def copy_slugs(self, kind):
+        """Copy slugs, suffixed with the new object id."""
+        qn = self.qn
+        table = qn(models.Slug._meta.db_table)
+        self.cursor.execute("INSERT INTO %s (%s, %s, %s) SELECT m.new_id, %s, 0 FROM %s t %s" % (
+                table, qn("object_id"), qn("slug"), qn("serial_number"),
+                self.concat("t.%s" % qn("slug"), "'-'", "m.new_id"),
+                table, self.join("object_id")), [self.batch, kind])
+
+    def log_inserts(self, kind):
+        qn = self.qn
+        self.cursor.execute("INSERT INTO %s (%s) SELECT m.new_id, t.%s, NULL, %%s, %%s "
+                "FROM %s t %s" % (qn(models.ChangeLog._meta.db_table), ", ".join(qn(c) for c in
+                    ("object_id", "class_name", "culture", "action", "created_at")),
+                    qn("class_name"), qn(models.Object._meta.db_table), self.join("id")),
+                [models.ChangeLog.INSERT, self.now, self.batch, kind])
+
+
+def clone_subtree(source, new_parent, using=None):
+    """Copy `source` and its descendants to be the last child of
+    `new_parent`, returning the copy of `source`.  Copied slugs get the
+    new object id appended."""
+    model = source.__class__
+    tree = tree_table(model)
+    using = using or router.db_for_write(model)
+    objects = tree._base_manager.using(using)
+    with transaction.commit_on_success(using=using):
+        source = objects.get(pk=source.pk)
+        new_parent = objects.get(pk=new_parent.pk)
+        if source.lft <= new_parent.lft and new_parent.rgt <= source.rgt:
+            raise ValueError("Cannot copy a subtree into itself")
+
+        # Open a gap at the end of the new parent's children, then
+        # re-read the source in case the gap moved it.
+        width = source.rgt - source.lft + 1
+        models.log_tree_changes(objects.filter(rgt__gte=new_parent.rgt))
+        objects.filter(lft__gt=new_parent.rgt).update(lft=F("lft") + width)
+        objects.filter(rgt__gte=new_parent.rgt).update(rgt=F("rgt") + width)
+        source = objects.get(pk=source.pk)
+        offset = new_parent.rgt - source.lft
+
+        nodes = list(objects.filter(lft__gte=source.lft, rgt__lte=source.rgt)
+                .order_by("lft").values_list("pk", "parent", "class_name"))
+        classes = models.class_models()
+        tables = set()
+        for pk, parent, classname in nodes:
+            tables.update(models.inheritance_chain(classes.get(classname, tree)))
+        nodes = [(pk, parent) for pk, parent, classname in nodes]
+        events = []
+        if issubclass(tree, models.InformationObject):
+            events = list(models.Event.objects.using(using)
+                    .filter(information_object__lft__gte=source.lft,
+                        information_object__rgt__lte=source.rgt)
+                    .order_by("pk").values_list("pk", "information_object"))
+
+        state = SubtreeCopy(using)
+        try:
+            first = models.allocate_ids(models.Object, len(nodes) + len(events), using)
+            nodemap = state.fill_map("node", nodes, first,
+                    lambda parent, mapping: mapping.get(parent, new_parent.pk))
+            owners = dict(nodemap)
+            owners.update(state.fill_map("event", events, first + len(nodes),
+                    lambda io, mapping: nodemap[io]))
+
+            # Object rows, then the tables of every class present, base
+            # tables first; joining the map skips nodes without a row.
+            for kind in ("node", "event"):
+                state.copy(models.Object, kind)
+            tables.discard(models.Object)
+            for table in sorted(tables, key=lambda t: len(models.inheritance_chain(t))):
+                overrides = {}
+                if table is tree:
+                    overrides = {
+                        "parent_id": "m.new_ref",
+                        "lft": "t.%s + %d" % (state.qn("lft"), offset),
+                        "rgt": "t.%s + %d" % (state.qn("rgt"), offset),
+                    }
+                if table is models.InformationObject:
+                    maxoai = objects.aggregate(Max("oai_local_identifier"))\
+                            ["oai_local_identifier__max"] or 0
+                    overrides["oai_local_identifier"] = "m.ordinal + %d" % maxoai
+                state.copy(table, "node", table._meta.pk.column, overrides)
+                for i18n in models.i18n_tables(table):
+                    state.copy(i18n, "node")
+            if events:
+                state.copy(models.Event, "event",
+                        overrides={"information_object_id": "m.new_ref"})
+                state.copy(models.EventI18N, "event")
+
+            for dependent in DEPENDENTS:
+                rows = []
+                for batch in batches(owners):
+                    rows.extend(dependent.objects.using(using).filter(object_id__in=batch)
+                            .values_list("pk", "object_id"))
+                rows.sort()
+                if not rows:
+                    continue
+                kind = dependent._meta.db_table
+                state.fill_map(kind, rows, models.allocate_ids(dependent, len(rows), using),
+                        lambda owner, mapping: owners[owner])
+                overrides = {"object_id": "m.new_ref"}
+                if dependent is models.Note:
+                    overrides["parent_id"] = "NULL"
+                state.copy(dependent, kind, overrides=overrides)
+                state.copy(models.i18n_model(dependent), kind)
+
+            for kind in ("node", "event"):
+                state.copy_slugs(kind)
+                state.log_inserts(kind)
+        finally:
+            state.clear_map()
+    return model._base_manager.using(using).get(pk=nodemap[source.pk])
@@ -0,0 +1,199 @@
+"""
+Parsing of free-text event dates.
+
+Qubit keeps a display date (`EventI18N.date`, e.g. "ca. 1933-1945",
+"March 1938", "1940s") alongside the machine-readable
+`Event.start_date`/`end_date`.  parse_date_range() turns the former
+into the latter, and normalize_event_dates() does so in bulk.
+"""
+
+import calendar
+import datetime
+import re
+
+from django.db import connections, router, transaction
+
+from djqubit import models
+
+MONTHS = {}
+for number, names in enumerate([
+        ("january", "jan", "janvier", "januar", "janv"),
+        ("february", "feb", "fevrier", "f\xe9vrier", "februar", "fev", "f\xe9v"),
+        ("march", "mar", "mars", "m\xe4rz", "marz"),
+        ("april", "apr", "avril", "avr"),
+        ("may", "mai"),
+        ("june", "jun", "juin", "juni"),
+        ("july", "jul", "juillet", "juli", "juil"),
+        ("august", "aug", "aout", "ao\xfbt"),
+        ("september", "sep", "sept", "septembre"),
+        ("october", "oct", "octobre", "oktober", "okt"),
+        ("november", "nov", "novembre"),
+        ("december", "dec", "decembre", "d\xe9cembre", "dezember", "dez", "d\xe9c")]):
+    for name in names:
+        MONTHS[name.decode("latin1")] = number + 1
+
+MONTH = u"(%s)\\.?" % u"|".join(sorted(MONTHS, key=len, reverse=True))
+
+QUALIFIERS = re.compile(u"^(c\\.|ca\\.?|circa|approx\\.?|about|um|vers)\\s*|[\\[\\]?]",
+        re.IGNORECASE | re.UNICODE)
+
+RANGE_SEPARATOR = re.compile(u"\\s*(?:\u2013|\u2014|\\bto\\b|\\buntil\\b|\\s-\\s|--)\\s*",
+        re.IGNORECASE | re.UNICODE)
+INTERVAL_SEPARATOR = re.compile(u"\\s*/\\s*")
+
+YEAR_RANGE = re.compile(u"^(\\d{4})-(\\d{2}|\\d{4})$")
+SHORT_YEAR = re.compile(u"^\\s*\\d{2}\\s*$")
+
+PATTERNS = (
+    (re.compile(u"^(\\d{4})-(\\d{1,2})-(\\d{1,2})$"), "ymd"),
+    (re.compile(u"^(\\d{4})(\\d{2})(\\d{2})$"), "ymd"),
+    (re.compile(u"^(\\d{4})-(\\d{1,2})$"), "ym"),
+    (re.compile(u"^(\\d{4})$"), "y"),
+    (re.compile(u"^(\\d{3})0s$"), "decade"),
+    (re.compile(u"^(\\d{1,2})\\.?\\s+%s\\s+(\\d{4})$" % MONTH, re.IGNORECASE | re.UNICODE), "dmy"),
+    (re.compile(u"^%s\\s+(\\d{1,2}),?\\s+(\\d{4})$" % MONTH, re.IGNORECASE | re.UNICODE), "mdy"),
+    (re.compile(u"^%s,?\\s+(\\d{4})$" % MONTH, re.IGNORECASE | re.UNICODE), "my"),
+    (re.compile(u"^(\\d{1,2})[./](\\d{1,2})[./](\\d{4})$"), "d.m.y"),
+)
+
+OPEN_START = re.compile(u"^(before|until|bis|avant)\\s+", re.IGNORECASE | re.UNICODE)
+OPEN_END = re.compile(u"^(after|since|from|nach|seit|apr\xe8s|depuis)\\s+", re.IGNORECASE | re.UNICODE)
+
+
+def _month_end(year, month):
+    return datetime.date(year, month, calendar.monthrange(year, month)[1])
+
+
+def parse_date(text):
+    """Parse a single date expression into the (first, last) days it
+    covers, or None if it is not understood."""
+    text = QUALIFIERS.sub(u"", text.strip()).strip().rstrip(u".,")
+    for pattern, kind in PATTERNS:
+        match = pattern.match(text)
+        if match is None:
+            continue
+        groups = match.groups()
+        try:
+            if kind == "ymd":
+                day = datetime.date(int(groups[0]), int(groups[1]), int(groups[2]))
+                return day, day
+            if kind == "ym":
+                year, month = int(groups[0]), int(groups[1])
+                return datetime.date(year, month, 1), _month_end(year, month)
+            if kind == "y":
+                year = int(groups[0])
+                return datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+            if kind == "decade":
+                year = int(groups[0]) * 10
+                return datetime.date(year, 1, 1), datetime.date(year + 9, 12, 31)
+            if kind == "dmy":
+                day = datetime.date(int(groups[2]), MONTHS[groups[1].lower()], int(groups[0]))
+                return day, day
+            if kind == "mdy":
+                day = datetime.date(int(groups[2]), MONTHS[groups[0].lower()], int(groups[1]))
+                return day, day
+            if kind == "my":
+                year, month = int(groups[1]), MONTHS[groups[0].lower()]
+                return datetime.date(year, month, 1), _month_end(year, month)
+            if kind == "d.m.y":
+                day = datetime.date(int(groups[2]), int(groups[1]), int(groups[0]))
+                return day, day
+        except (ValueError, KeyError):
+            return None
+    return None
+
+
+def split_range(text):
+    """Split the text of a range into its two ends, or return [text].
+    "/" only separates the ends of an ISO 8601 interval, when both
+    sides are dates, since "12/03/1938" is a single day."""
+    parts = RANGE_SEPARATOR.split(text, 1)
+    if len(parts) == 1:
+        interval = INTERVAL_SEPARATOR.split(text, 1)
+        if len(interval) == 2 and parse_date(interval[0]) \
+                and (parse_date(interval[1]) or SHORT_YEAR.match(interval[1])):
+            return interval
+    return parts
+
+
+def parse_date_range(text):
+    """Parse free text such as "1933-1945", "ca. 1940s", "12 March 1938"
+    or "before 1900" into a (start_date, end_date) pair.  Either may be
+    None for an open range; (None, None) means not understood."""
+    if not text:
+        return None, None
+    text = text.strip()
+    match = OPEN_START.match(text)
+    if match:
+        parsed = parse_date(text[match.end():])
+        return (None, parsed[1]) if parsed else (None, None)
+    match = OPEN_END.match(text)
+    if match and len(split_range(text[match.end():])) == 1:
+        parsed = parse_date(text[match.end():])
+        return (parsed[0], None) if parsed else (None, None)
+    if match:
+        text = text[match.end():]
+
+    parts = split_range(text)
+    if len(parts) == 1:
+        yearrange = YEAR_RANGE.match(QUALIFIERS.sub(u"", text).strip())
+        if yearrange:
+            start, end = yearrange.groups()
+            # "1914-18" is a range of years, but "1938-03" a month.
+            if len(end) == 4 or int(start[:2] + end) >= int(start):
+                parts = [start, end]
+    if len(parts) == 1:
+        parsed = parse_date(text)
+        return parsed if parsed else (None, None)
+    if SHORT_YEAR.match(parts[1]):
+        # "1914-18": the end year shares the start year's century.
+        century = re.search(u"\\d{4}", parts[0])
+        if century:
+            parts[1] = century.group()[:2] + parts[1].strip()
+    first, last = parse_date(parts[0]), parse_date(parts[1])
+    if first is None or last is None or first[0] > last[1]:
+        return None, None
+    return first[0], last[1]
+
+
+def normalize_event_dates(queryset=None, overwrite=False, chunk_size=1000):
+    """Fill in Event start/end dates from their free-text i18n dates.
+    Events which already have a start date are skipped unless
+    `overwrite` is set.  Distinct date strings are parsed only once.
+    Returns the number of events updated."""
+    if queryset is None:
+        queryset = models.Event.objects.all()
+    if not overwrite:
+        queryset = queryset.filter(start_date__isnull=True)
+    rows = models.EventI18N.objects\
+            .filter(base__in=queryset.values("pk"), date__isnull=False)\
+            .exclude(date="")\
+            .values_list("base", "date")
+
+    parsed = {}
+    updates = []
+    seen = set()
+    for pk, text in rows.iterator():
+        if pk in seen:
+            continue
+        if text not in parsed:
+            parsed[text] = parse_date_range(text)
+        start, end = parsed[text]
+        if start is None and end is None:
+            continue
+        seen.add(pk)
+        updates.append((start, end, pk))
+
+    using = router.db_for_write(models.Event)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    query = "UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s" % (
+            qn(models.Event._meta.db_table), qn("start_date"), qn("end_date"), qn("id"))
+    with transaction.commit_on_success(using=using):
+        cursor = connection.cursor()
+        for i in range(0, len(updates), chunk_size):
+            batch = updates[i:i + chunk_size]
+            cursor.executemany(query, batch)
+            models.log_changes(using, [(pk, "QubitEvent", None, models.ChangeLog.UPDATE)
+                    for start, end, pk in batch])
+    return len(updates)
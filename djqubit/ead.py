@@ -0,0 +1,348 @@
+"""
+Streaming import of EAD finding aids.
+
+The file is read with iterparse and each component is discarded as
+soon as it has been written, so memory use does not grow with the size
+of the finding aid.  Because EAD nesting is the tree, nested set values
+come straight from document order: a component's lft is assigned when
+it opens and its rgt when it closes.  The new subtree is built above
+the table's current maximum rgt and moved under its parent at the end
+with three range UPDATEs, so the whole import is linear in the number
+of components.  The existing rows those UPDATEs shift are logged to the
+change log with one INSERT ... SELECT.
+
+Rows are written in batches: a component's row is queued as soon as
+its first child opens (EAD puts <did> and the descriptive elements
+before <dsc>), or when it closes if it has no children, so parents are
+always inserted before their children; rgt values of components with
+children are filled in afterwards with one batched UPDATE.
+"""
+
+import datetime
+import re
+from xml.etree import cElementTree
+
+from django.db import connections, router, transaction
+from django.db.models import F, Max
+
+from djqubit import models
+from djqubit.dates import parse_date_range
+
+BATCH_SIZE = 1000
+
+COMPONENT = re.compile(r"^(archdesc|c|c\d\d)$")
+
+# EAD descriptive elements and the InformationObjectI18N fields they
+# are imported into.
+SECTIONS = {
+    "scopecontent": "scope_and_content",
+    "arrangement": "arrangement",
+    "accessrestrict": "access_conditions",
+    "userestrict": "reproduction_conditions",
+    "custodhist": "archival_history",
+    "acqinfo": "acquisition",
+    "appraisal": "appraisal",
+    "accruals": "accruals",
+    "phystech": "physical_characteristics",
+    "otherfindaid": "finding_aids",
+    "originalsloc": "location_of_originals",
+    "altformavail": "location_of_copies",
+    "relatedmaterial": "related_units_of_description",
+}
+
+# EAD elements imported as notes, by note type.
+NOTES = {
+    "odd": models.Term.GENERAL_NOTE_ID,
+    "note": models.Term.GENERAL_NOTE_ID,
+    "processinfo": models.Term.ARCHIVIST_NOTE_ID,
+}
+
+# Name elements and the entity type of the actors made from them.
+NAMES = {
+    "persname": models.Term.PERSON_ID,
+    "corpname": models.Term.CORPORATE_BODY_ID,
+    "famname": models.Term.FAMILY_ID,
+    "name": None,
+}
+
+
+def localname(tag):
+    """Strip any namespace from an element tag."""
+    return tag.rsplit("}", 1)[-1]
+
+
+def text(elem):
+    """An element's text content with whitespace collapsed, ignoring
+    any <head>."""
+    parts = []
+    if elem.text:
+        parts.append(elem.text)
+    for child in elem:
+        if localname(child.tag) != "head":
+            parts.extend(child.itertext())
+        if child.tail:
+            parts.append(child.tail)
+    return u" ".join(u"".join(parts).split())
+
+
+def paragraphs(elem):
+    """Text of a descriptive element, one paragraph per <p>."""
+    paras = [text(p) for p in elem.iter() if localname(p.tag) == "p"]
+    return u"\n\n".join(p for p in paras if p) or text(elem) or None
+
+
+class Component(object):
+    """An open component: its ids, position and element."""
+    __slots__ = ("elem", "id", "lft", "parent", "written")
+
+    def __init__(self, elem, id, lft, parent):
+        self.elem = elem
+        self.id = id
+        self.lft = lft
+        self.parent = parent
+        self.written = False
+
+
+class EADImporter(object):
+    """Import one or more EAD files under an information object."""
+    def __init__(self, parent=None, repository=None, culture=models.FALLBACK_CULTURE,
+            batch_size=BATCH_SIZE):
+        self.using = router.db_for_write(models.InformationObject)
+        self.parent = parent or models.InformationObject.objects.get(
+                pk=models.InformationObject.ROOT_ID)
+        self.repository = repository
+        self.culture = culture
+        self.batch_size = batch_size
+        self.levels = {}
+        self.actors = {}
+        self.count = 0
+
+    def run(self, source):
+        """Import from a file name or file object; returns the number of
+        information objects created."""
+        with transaction.commit_on_success(using=self.using):
+            self.start()
+            self.parse(source)
+            self.finish()
+        return self.count
+
+    def start(self):
+        self.nextid = models.allocate_ids(models.Object, 0, self.using)
+        self.firstid = self.nextid
+        self.nextnote = models.allocate_ids(models.Note, 0, self.using)
+        self.nextoai = (models.InformationObject.objects.using(self.using)
+                .aggregate(Max("oai_local_identifier"))
+                ["oai_local_identifier__max"] or 0) + 1
+        # New nodes are numbered from above every existing rgt and
+        # moved into place by finish().
+        self.base = (models.InformationObject.objects.using(self.using)
+                .aggregate(Max("rgt"))["rgt__max"] or 0) + 1
+        self.position = self.base
+        self.now = datetime.datetime.now()
+        self.objects, self.i18n, self.rgts = [], [], []
+        self.events, self.eventi18n, self.notes, self.relations = [], [], [], []
+
+    def newid(self):
+        id = self.nextid
+        self.nextid += 1
+        return id
+
+    def parse(self, source):
+        stack = []
+        components = []
+        for event, elem in cElementTree.iterparse(source, events=("start", "end")):
+            tag = localname(elem.tag)
+            if event == "start":
+                stack.append(elem)
+                if COMPONENT.match(tag):
+                    parent = components[-1] if components else None
+                    if parent is not None and not parent.written:
+                        self.queue(parent)
+                    components.append(Component(elem, self.newid(), self.position,
+                            parent.id if parent else self.parent.pk))
+                    self.position += 1
+                continue
+
+            stack.pop()
+            if COMPONENT.match(tag):
+                component = components.pop()
+                rgt = self.position
+                self.position += 1
+                if component.written:
+                    self.rgts.append((rgt, component.id))
+                else:
+                    self.queue(component, rgt)
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
+                if len(self.objects) >= self.batch_size:
+                    self.flush()
+            elif not components and tag != "ead":
+                # Nothing outside the description (eadheader etc.) is kept.
+                elem.clear()
+
+    def queue(self, component, rgt=None):
+        """Queue the rows for a component whose descriptive content has
+        been read."""
+        elem = component.elem
+        component.written = True
+        fields = {}
+        identifier = level = None
+        dates, creators = [], []
+        notes, names = [], []
+        for child in elem:
+            tag = localname(child.tag)
+            if tag == "did":
+                for part in child:
+                    ptag = localname(part.tag)
+                    if ptag == "unittitle" and "title" not in fields:
+                        fields["title"] = text(part)[:255] or None
+                    elif ptag == "unitid" and identifier is None:
+                        identifier = text(part)[:255] or None
+                    elif ptag == "unitdate":
+                        dates.append((text(part), part.get("normal")))
+                    elif ptag == "physdesc":
+                        fields["extent_and_medium"] = text(part) or None
+                    elif ptag == "origination":
+                        creators.extend(self.names(part))
+                    elif ptag in SECTIONS:
+                        fields[SECTIONS[ptag]] = paragraphs(part)
+            elif tag in SECTIONS:
+                fields[SECTIONS[tag]] = paragraphs(child)
+            elif tag in NOTES:
+                content = paragraphs(child)
+                if content:
+                    notes.append((NOTES[tag], content))
+            elif tag == "controlaccess":
+                names.extend(self.names(child))
+        level = elem.get("level")
+        if level == "otherlevel":
+            level = elem.get("otherlevel")
+
+        pk = component.id
+        self.objects.append(dict(pk=pk, created_at=self.now, updated_at=self.now,
+                identifier=identifier, oai_local_identifier=self.nextoai,
+                level_of_description_id=self.level(level),
+                repository_id=self.repository.pk if self.repository else None,
+                parent_id=component.parent, lft=component.lft,
+                rgt=rgt if rgt is not None else component.lft + 1,
+                source_culture=self.culture))
+        self.nextoai += 1
+        self.count += 1
+        self.i18n.append(dict(fields, base_id=pk, culture=self.culture))
+
+        creator = creators[0] if creators else None
+        for display, normal in dates or ([(None, None)] if creator else []):
+            start, end = parse_date_range(normal or display)
+            eventid = self.newid()
+            self.events.append(dict(pk=eventid, created_at=self.now, updated_at=self.now,
+                    start_date=start, end_date=end, type_id=models.Term.CREATION_ID,
+                    information_object_id=pk, actor_id=creator, source_culture=self.culture))
+            self.eventi18n.append(dict(base_id=eventid, culture=self.culture, date=display))
+        for actor in creators[1:]:
+            eventid = self.newid()
+            self.events.append(dict(pk=eventid, created_at=self.now, updated_at=self.now,
+                    type_id=models.Term.CREATION_ID, information_object_id=pk,
+                    actor_id=actor, source_culture=self.culture))
+        for type, content in notes:
+            self.notes.append((pk, type, content))
+        for actor in names:
+            self.relations.append(dict(pk=self.newid(), created_at=self.now,
+                    updated_at=self.now, subject_id_id=pk, object_id_id=actor,
+                    type_id=models.Term.NAME_ACCESS_POINT_ID))
+
+    def names(self, elem):
+        """Actor ids for the name elements within `elem`."""
+        return [self.actor(text(child), NAMES[localname(child.tag)])
+                for child in elem if localname(child.tag) in NAMES and text(child)]
+
+    def level(self, name):
+        """Level of description term id for a level name, memoized."""
+        if not name:
+            return None
+        key = name.lower()
+        if key not in self.levels:
+            ids = models.TermI18N.objects.using(self.using).filter(
+                    base__taxonomy=models.Taxonomy.LEVEL_OF_DESCRIPTION_ID,
+                    name__iexact=name).values_list("base", flat=True)[:1]
+            self.levels[key] = ids[0] if ids else None
+        return self.levels[key]
+
+    def actor(self, name, entitytype):
+        """Id of the actor called `name`, creating it under the actor
+        root if need be.  Lookups are memoized."""
+        name = name[:255]
+        if name in self.actors:
+            return self.actors[name]
+        ids = models.ActorI18N.objects.using(self.using)\
+                .filter(authorized_form_of_name=name).values_list("base", flat=True)[:1]
+        if ids:
+            self.actors[name] = ids[0]
+            return ids[0]
+        actors = models.Actor.objects.using(self.using)
+        root = actors.get(pk=models.Actor.ROOT_ID)
+        models.log_tree_changes(actors.filter(rgt__gte=root.rgt))
+        actors.filter(lft__gt=root.rgt).update(lft=F("lft") + 2)
+        actors.filter(rgt__gte=root.rgt).update(rgt=F("rgt") + 2)
+        pk = self.newid()
+        models.insert_objects(models.Actor, [dict(pk=pk, created_at=self.now,
+                updated_at=self.now, parent_id=root.pk, lft=root.rgt, rgt=root.rgt + 1,
+                entity_type_id=entitytype, source_culture=self.culture)], self.using)
+        models.bulk_insert(models.ActorI18N, [dict(base_id=pk, culture=self.culture,
+                authorized_form_of_name=name)], self.using)
+        self.actors[name] = pk
+        return pk
+
+    def flush(self):
+        """Write the queued rows, parents before children."""
+        using = self.using
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        models.insert_objects(models.InformationObject, self.objects, using)
+        models.bulk_insert(models.InformationObjectI18N, self.i18n, using)
+        models.insert_objects(models.Event, self.events, using)
+        models.bulk_insert(models.EventI18N, self.eventi18n, using)
+        models.insert_objects(models.Relation, self.relations, using)
+        models.bulk_insert(models.Note, [dict(id=self.nextnote + i, object_id_id=pk,
+                type_id=type, source_culture=self.culture)
+                for i, (pk, type, content) in enumerate(self.notes)], using)
+        models.bulk_insert(models.NoteI18N, [dict(base_id=self.nextnote + i,
+                culture=self.culture, content=content)
+                for i, (pk, type, content) in enumerate(self.notes)], using)
+        self.nextnote += len(self.notes)
+        if self.rgts:
+            connection.cursor().executemany("UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                    qn(models.InformationObject._meta.db_table), qn("rgt"), qn("id")),
+                    self.rgts)
+        models.log_changes(using, [(row["base_id"], "QubitInformationObject",
+                row["culture"], models.ChangeLog.INSERT) for row in self.i18n]
+                + [(row["base_id"], "QubitEvent", row["culture"], models.ChangeLog.INSERT)
+                    for row in self.eventi18n])
+        self.objects, self.i18n, self.rgts = [], [], []
+        self.events, self.eventi18n, self.notes, self.relations = [], [], [], []
+
+    def finish(self):
+        """Write what is left and move the new subtree from above the
+        existing tree to the end of the parent's children."""
+        self.flush()
+        width = self.position - self.base
+        if not width:
+            return
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        table = qn(models.InformationObject._meta.db_table)
+        lft, rgt, id = qn("lft"), qn("rgt"), qn("id")
+        # Re-read the parent: actor creation does not move it, but an
+        # earlier run on the same importer may have.
+        objects = models.InformationObject._base_manager.using(self.using)
+        parent = objects.get(pk=self.parent.pk)
+        models.log_tree_changes(objects.filter(rgt__gte=parent.rgt, pk__lt=self.firstid))
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %s SET %s = %s + %%s WHERE %s >= %%s AND %s < %%s" % (
+                table, lft, lft, lft, id), [width, parent.rgt, self.firstid])
+        cursor.execute("UPDATE %s SET %s = %s + %%s WHERE %s >= %%s AND %s < %%s" % (
+                table, rgt, rgt, rgt, id), [width, parent.rgt, self.firstid])
+        cursor.execute("UPDATE %s SET %s = %s - %%s, %s = %s - %%s WHERE %s >= %%s" % (
+                table, lft, lft, rgt, rgt, id),
+                [self.base - parent.rgt, self.base - parent.rgt, self.firstid])
+        self.parent.rgt = parent.rgt + width
@@ -0,0 +1,124 @@
+"""
+Faceted counts over nested-set subtrees.
+
+All requested facets are counted with a single grouped query over the
+subtree's lft/rgt range:
+
+    SELECT level_of_description_id, repository_id, ..., COUNT(*)
+      FROM information_object ... WHERE lft > %s AND rgt < %s
+     GROUP BY level_of_description_id, repository_id, ...
+
+and each facet's totals are then summed out of the (small) set of
+combinations in Python.  Facets may follow a relation, e.g.
+"digital_objects__media_type"; Qubit attaches at most one master
+digital object per description, so such joins do not inflate counts.
+"""
+
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Count, Max
+
+from djqubit.models import FALLBACK_CULTURE, I18NMixin, i18n_model, PREFETCH_BATCH_SIZE
+
+# Seconds to keep facet counts in the cache.  Entries are keyed on the
+# subtree's max updated_at, so edits invalidate them anyway.
+CACHE_TIMEOUT = 3600
+
+
+class Facet(object):
+    """Counts for one facet: a list of (value id, label, count) tuples,
+    most frequent first.  Nodes with no value are counted under None."""
+    def __init__(self, name, values):
+        self.name = name
+        self.values = values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "<Facet %s: %r>" % (self.name, self.values)
+
+    def counts(self):
+        """Map value id -> count."""
+        return dict((value, count) for value, label, count in self.values)
+
+
+def related_model(model, path):
+    """Return the model at the end of a `__`-separated relation path."""
+    for name in path.split("__"):
+        field, fmodel, direct, m2m = model._meta.get_field_by_name(name)
+        if direct:
+            model = field.rel.to
+        else:
+            model = field.model
+    return model
+
+
+def resolve_names(model, ids, culture=FALLBACK_CULTURE):
+    """Map ids of an I18NMixin model to display names, preferring
+    `culture`, then the fallback culture, then any culture."""
+    names = {}
+    if not issubclass(model, I18NMixin):
+        return names
+    ids = list(ids)
+    rank = {culture: 0, FALLBACK_CULTURE: 1}
+    best = {}
+    for i in range(0, len(ids), PREFETCH_BATCH_SIZE):
+        rows = i18n_model(model).objects.filter(base__in=ids[i:i + PREFETCH_BATCH_SIZE])\
+                .values_list("base", "culture", model.i18n_name_field)
+        for id, rowculture, name in rows:
+            score = rank.get(rowculture, 2)
+            if name is not None and score < best.get(id, 3):
+                best[id] = score
+                names[id] = name
+    return names
+
+
+def count_facets(queryset, facets, culture=FALLBACK_CULTURE):
+    """Count `queryset` grouped by each of `facets` (field names or
+    relation paths) in one query.  Returns {facet: Facet}."""
+    model = queryset.model
+    rows = queryset.order_by().values(*facets).annotate(_count=Count("pk"))
+    totals = dict((facet, defaultdict(int)) for facet in facets)
+    for row in rows:
+        for facet in facets:
+            totals[facet][row[facet]] += row["_count"]
+
+    result = {}
+    for facet in facets:
+        counts = totals[facet]
+        names = resolve_names(related_model(model, facet),
+                [v for v in counts if v is not None], culture)
+        values = [(value, names.get(value), count) for value, count in counts.iteritems()]
+        values.sort(key=lambda v: (-v[2], v[1], v[0]))
+        result[facet] = Facet(facet, values)
+    return result
+
+
+def subtree_facets(node, facets=None, include_self=False,
+        culture=FALLBACK_CULTURE, use_cache=True):
+    """Facet counts for the descendants of `node`.  `facets` defaults
+    to the model's `facet_fields`.  Results are cached until anything
+    in the subtree is updated, moved, added or removed."""
+    model = node.__class__
+    if facets is None:
+        facets = model.facet_fields
+    facets = list(facets)
+    subtree = node.get_descendants(include_self=include_self)
+    if not use_cache:
+        return count_facets(subtree, facets, culture)
+
+    state = subtree.aggregate(Max("updated_at"), Count("pk"))
+    marker = (node.lft, node.rgt, state["updated_at__max"], state["pk__count"])
+    key = "djqubit.facets.%s.%s.%s.%d.%s.%s" % (subtree.db, model._meta.db_table, node.pk,
+            include_self, culture, ",".join(facets))
+    cached = cache.get(key)
+    if cached is not None and cached[0] == marker:
+        return cached[1]
+    result = count_facets(subtree, facets, culture)
+    cache.set(key, (marker, result), CACHE_TIMEOUT)
+    return result
@@ -0,0 +1,121 @@
+"""
+Relation graph loading and traversal.
+
+Relations are loaded in batches, one query per set of unseen nodes,
+and kept in an in-memory adjacency index so that repeated lookups
+within a request do not touch the database again.
+"""
+
+from collections import defaultdict
+
+from django.db.models import Q
+
+from djqubit import models
+
+# Keep IN (...) lists comfortably below SQLite's 999 parameter limit,
+# remembering that each batch is used in two IN clauses.
+BATCH_SIZE = 400
+
+FORWARD = "forward"
+REVERSE = "reverse"
+BOTH = "both"
+
+REQUEST_ATTR = "_djqubit_relation_graph"
+
+
+def _batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class RelationGraph(object):
+    """In-memory adjacency index over Relation rows.  Edges are
+    indexed by node id and relation type id in both directions."""
+    def __init__(self, using=None):
+        self.using = using
+        self.forward = defaultdict(lambda: defaultdict(set))
+        self.reverse = defaultdict(lambda: defaultdict(set))
+        self.loaded = set()
+
+    @classmethod
+    def for_request(cls, request):
+        """Get a graph shared by everything handling this request."""
+        graph = getattr(request, REQUEST_ATTR, None)
+        if graph is None:
+            graph = cls()
+            setattr(request, REQUEST_ATTR, graph)
+        return graph
+
+    def load(self, ids):
+        """Load all relations touching the given ids which have not
+        been loaded already.  Returns the number of queries run."""
+        missing = set(ids) - self.loaded
+        queries = 0
+        for batch in _batches(missing):
+            qs = models.Relation.objects.filter(
+                    Q(subject_id__in=batch) | Q(object_id__in=batch))
+            if self.using is not None:
+                qs = qs.using(self.using)
+            for subject, obj, reltype in qs.values_list(
+                    "subject_id", "object_id", "type"):
+                self.forward[subject][reltype].add(obj)
+                self.reverse[obj][reltype].add(subject)
+            queries += 1
+        self.loaded.update(missing)
+        return queries
+
+    def neighbours(self, node, types=None, direction=BOTH):
+        """Ids directly related to `node`, optionally restricted to
+        relations with the given type ids."""
+        self.load([node])
+        found = set()
+        indexes = []
+        if direction in (FORWARD, BOTH):
+            indexes.append(self.forward)
+        if direction in (REVERSE, BOTH):
+            indexes.append(self.reverse)
+        for index in indexes:
+            if node not in index:
+                continue
+            for reltype, targets in index[node].iteritems():
+                if types is None or reltype in types:
+                    found.update(targets)
+        return found
+
+    def traverse(self, ids, types=None, depth=1, direction=BOTH):
+        """Breadth-first walk from `ids` up to `depth` hops.  Each level
+        is fetched in one batch.  Returns a dict of id -> hop count,
+        including the starting ids at distance 0."""
+        distances = dict((node, 0) for node in ids)
+        frontier = set(distances)
+        for hop in range(1, depth + 1):
+            if not frontier:
+                break
+            self.load(frontier)
+            nextfrontier = set()
+            for node in frontier:
+                for target in self.neighbours(node, types, direction):
+                    if target not in distances:
+                        distances[target] = hop
+                        nextfrontier.add(target)
+            frontier = nextfrontier
+        return distances
+
+    def related(self, ids, model, types=None, depth=1, direction=BOTH):
+        """Queryset of `model` instances reachable from `ids` within
+        `depth` hops, not counting the starting ids themselves.
+
+        For example, all actors related to any description in a fonds:
+
+            graph.related(fonds.get_descendants(include_self=True)\\
+                    .values_list("pk", flat=True), models.Actor)
+        """
+        ids = list(ids)
+        distances = self.traverse(ids, types, depth, direction)
+        for node in ids:
+            distances.pop(node, None)
+        qs = model.objects.filter(pk__in=distances.keys())
+        if self.using is not None:
+            qs = qs.using(self.using)
+        return qs
@@ -0,0 +1,36 @@
+"""
+Dump a node of a Qubit tree, its descendants and their dependent rows
+to a compressed file for loadsubtree, e.g.:
+
+    ./manage.py dumpsubtree informationobject 281 fonds.qst
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from djqubit import models, subtree
+from djqubit.tenants import TENANT_OPTION, tenant_command
+
+HELP = """Dump a subtree of a djqubit tree model to a file."""
+
+
+class Command(BaseCommand):
+    args = "<model> <id> <file>"
+    help = HELP
+    option_list = BaseCommand.option_list + (
+        TENANT_OPTION,
+    )
+
+    @tenant_command
+    def handle(self, *args, **options):
+        if len(args) != 3:
+            raise CommandError("A model name, an id and a file must be provided")
+        model = get_model("djqubit", args[0])
+        if model is None or not issubclass(model, models.NestedObject):
+            raise CommandError("'%s' is not a djqubit tree model" % args[0])
+        try:
+            root = model._base_manager.get(pk=int(args[1]))
+        except (ValueError, model.DoesNotExist):
+            raise CommandError("No %s with id %s" % (args[0], args[1]))
+        count = subtree.dump_subtree(root, args[2])
+        self.stdout.write("Dumped %d rows\n" % count)
@@ -0,0 +1,76 @@
+"""
+Export the rows changed since a change-log token as JSON lines, one
+object or i18n row per line, e.g.:
+
+    ./manage.py exportdelta --token-file=/var/lib/sync/qubit.token > delta.jsonl
+
+With --token-file the token is read from the file before exporting and
+the new token written back afterwards; otherwise pass --since and read
+the new token from stderr.
+"""
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from djqubit import changelog
+from djqubit.tenants import TENANT_OPTION, tenant_command
+
+HELP = """Export changed rows since a change-log token as JSON lines."""
+
+
+class Command(BaseCommand):
+    help = HELP
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "-s",
+            "--since",
+            action="store",
+            dest="since",
+            default=None,
+            help="Export changes logged after this token"),
+        make_option(
+            "-f",
+            "--token-file",
+            action="store",
+            dest="tokenfile",
+            default=None,
+            help="File to read the starting token from and save the new token to"),
+        make_option(
+            "-l",
+            "--limit",
+            action="store",
+            dest="limit",
+            type="int",
+            default=changelog.LIMIT,
+            help="Change-log rows to read per batch"),
+        TENANT_OPTION,
+    )
+
+    @tenant_command
+    def handle(self, *args, **options):
+        token = options["since"]
+        tokenfile = options["tokenfile"]
+        if tokenfile and token is None and os.path.exists(tokenfile):
+            with open(tokenfile) as handle:
+                token = handle.read().strip()
+        try:
+            changelog.parse_token(token)
+        except ValueError, err:
+            raise CommandError(str(err))
+
+        encoder = DjangoJSONEncoder()
+        while True:
+            # The token can change without new rows as missing ids expire.
+            changes, token = changelog.changes_since(token, options["limit"])
+            if not changes:
+                break
+            for row in changelog.delta(changes):
+                self.stdout.write(encoder.encode(row) + "\n")
+
+        if tokenfile:
+            with open(tokenfile, "w") as handle:
+                handle.write("%s\n" % token)
+        self.stderr.write("Next token: %s\n" % token)
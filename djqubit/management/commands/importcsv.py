@@ -27,14 +27,21 @@ import phpserialize
 from incf.countryutils import data as countrydata
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
+from django.db import router, transaction
 from django.core.exceptions import ImproperlyConfigured
 from django.template.defaultfilters import slugify
 
 from djqubit import models
+from djqubit.bulkload import BULK_OPTION, bulk_load_if
+from djqubit.matching import RepositoryIndex
+from djqubit.staging import StagedImport
+from djqubit.tenants import TENANT_OPTION, tenant_command
 
 HELP = """Import CSV files into the database.""" 
 
+# Queued i18n writes are flushed in batches every this many records.
+I18N_FLUSH_EVERY = 500
+
 
 class CvsImportError(CommandError):
     pass
@@ -74,56 +81,141 @@ class Command(BaseCommand):
             dest="lang",
             default="en",
             help="Language for imported i18n fields"),
+        make_option(
+            "-s",
+            "--staging",
+            action="store",
+            dest="staging",
+            default=None,
+            help="Stage, check and bulk-merge the import via this SQLite file"),
+        BULK_OPTION,
+        TENANT_OPTION,
     )
 
-    @transaction.commit_manually
+    @tenant_command
     def handle(self, *args, **options):
         if len(args) != 1:
             raise CommandError("One (and only one) CSV file must be provided")
+        with bulk_load_if(options["bulk"]):
+            if options["staging"]:
+                return self.handle_staged(args[0], **options)
+            with transaction.commit_manually(using=router.db_for_write(models.Object)):
+                return self.handle_direct(args[0], **options)
 
+    def open_csv(self, path):
         # attempt to sniff the CSV dialect
-        handle = open(args[0], "rb")
+        handle = open(path, "rb")
         sample = handle.read(1024)
         handle.seek(0)        
         dialect = csv.Sniffer().sniff(sample)
+        return handle, dialect
 
-        user = models.User.objects.get(username=options["user"])
+    def get_terms(self):
         status = models.Term.objects.get(
                 taxonomy=models.Taxonomy.DESCRIPTION_STATUS_ID,
                 i18n__name__exact="Draft")
         detail = models.Term.objects.get(
                 taxonomy=models.Taxonomy.DESCRIPTION_DETAIL_LEVEL_ID,
                 i18n__name__exact="Partial")
+        return status, detail
+
+    def handle_staged(self, path, **options):
+        """Load the whole file into a staging database, check it there
+        and merge the clean rows into Qubit in one short transaction."""
+        handle, dialect = self.open_csv(path)
+        user = models.User.objects.get(username=options["user"])
+        status, detail = self.get_terms()
+        reader = csv.DictReader(handle, dialect=dialect)
+        rows = []
+        for rawrecord in reader:
+            if options["fromrec"] > 0 and reader.line_num < options["fromrec"]:
+                continue
+            record = self.decode(rawrecord)
+            countrycode = self._get_country_code(record)
+            rows.append(dict(
+                line=reader.line_num,
+                identifier="ehri%d%s" % (reader.line_num, countrycode),
+                name=record["Original Name"],
+                english_name=record["English Name"],
+                origin=record["Origin"],
+                comments=record["Comments"],
+                extra=record["Extra"],
+                country_code=countrycode,
+                city=record["City"],
+                region=record["State"],
+                street_address=self._get_address(record),
+                contact_person=record["Contact"],
+                email=record["E-mail"],
+                website=record["URL"],
+                fax=record["Fax"],
+                telephone=record["Phone"]))
+            if options["to"] > 0 and reader.line_num == options["to"]:
+                break
+        handle.close()
+
+        staged = StagedImport(options["staging"])
+        staged.load(rows)
+        staged.validate()
+        staged.deduplicate()
+        staged.allocate()
+        for line, reason in staged.rejected():
+            self.stderr.write("Skipping %d: %s\n" % (line, reason))
+        for line, match in staged.matched():
+            self.stdout.write("Updating %d: matches repository %d\n" % (line, match))
+        count = staged.merge(options["lang"], user, status, detail, properties=dict(
+                language=phpserialize.dumps([options["lang"]]),
+                script=phpserialize.dumps(["Latn"])))
+        self.stdout.write("Imported %d of %d records\n" % (count, len(rows)))
+
+    def handle_direct(self, path, **options):
+        using = router.db_for_write(models.Object)
+        handle, dialect = self.open_csv(path)
+        user = models.User.objects.get(username=options["user"])
+        status, detail = self.get_terms()
+        self.index = RepositoryIndex.build()
 
         # the first line MUST be headers
         reader = csv.DictReader(handle, dialect=dialect)
         try:
-            for record in reader:
-                if options["fromrec"] > 0 and reader.line_num < options["fromrec"]:
-                    continue
-                self.stdout.write("Adding %d: %s\n" % (reader.line_num, record["Original Name"]))
-                self.handle_row(record, reader.line_num, options["lang"], user, status, detail)
-                if options["to"] > 0 and reader.line_num == options["to"]:
-                    break
+            with models.buffered_i18n() as i18nbuffer:
+                for record in reader:
+                    if options["fromrec"] > 0 and reader.line_num < options["fromrec"]:
+                        continue
+                    self.stdout.write("Adding %d: %s\n" % (reader.line_num, record["Original Name"]))
+                    self.handle_row(record, reader.line_num, options["lang"], user, status, detail)
+                    if reader.line_num % I18N_FLUSH_EVERY == 0:
+                        i18nbuffer.flush()
+                    if options["to"] > 0 and reader.line_num == options["to"]:
+                        break
         except exceptions.BaseException, err:
             self.stderr.write("Caught exception: %s, Rolling back imports...\n" % err)
-            transaction.rollback()
+            transaction.rollback(using=using)
             raise err
         else:
-            transaction.commit()
+            transaction.commit(using=using)
         handle.close()                    
 
-    def handle_row(self, rawrecord, index, lang, user, status, detail):
+    def decode(self, rawrecord):
         record = {}
         for k, v in rawrecord.iteritems():
             if isinstance(v, str):
                 record[k] = unicode(v, encoding="utf8")
             else:
                 record[k] = unicode("", encoding="utf8")
+        return record
 
+    def handle_row(self, rawrecord, index, lang, user, status, detail):
+        record = self.decode(rawrecord)
         countrycode = self._get_country_code(record)
         ident = "ehri%d%s" % (index, countrycode)
         truncname = record["Original Name"][0:255]
+        englishname = record["English Name"].strip()[0:255]
+        match = self.index.match(truncname, countrycode, record["City"],
+                record["E-mail"], record["URL"], other_names=[englishname])
+        if match is not None:
+            self.stdout.write("  matches repository %d, updating\n" % match)
+            return self.update_row(match, record, lang, countrycode)
+
         repo = models.Repository(
             identifier=ident,
             entity_type_id=models.Term.CORPORATE_BODY_ID,
@@ -217,8 +309,36 @@ class Command(BaseCommand):
         scriptprop.set_i18n(lang, dict(
             value=phpserialize.dumps(["Latn"])
         ))
+        self.index.add(repo.pk, [truncname, englishname], countrycode,
+                record["City"], record["E-mail"], record["URL"])
 
-            
+    def update_row(self, pk, record, lang, countrycode):
+        """Update an existing repository from a matching record: its
+        name and any contact details the record provides."""
+        repo = models.Repository.objects.get(pk=pk)
+        repo.save()
+        repo.set_i18n(lang, dict(
+            authorized_form_of_name=record["Original Name"][0:255]
+        ))
+        values = dict(
+            contact_person=record["Contact"],
+            country_code=countrycode,
+            email=record["E-mail"],
+            website=record["URL"],
+            street_address=self._get_address(record),
+            fax=record["Fax"],
+            telephone=record["Phone"])
+        values = dict((k, v) for k, v in values.iteritems() if v and v.strip())
+        try:
+            contact = repo.contacts.filter(primary_contact=True)[0]
+        except IndexError:
+            contact = models.ContactInformation(actor=repo, primary_contact=True,
+                    source_culture=lang)
+        for key, value in values.iteritems():
+            setattr(contact, key, value)
+        contact.save()
+        if record["City"].strip():
+            contact.set_i18n(lang, dict(city=record["City"]))
 
 
     def _get_country_code(self, record):
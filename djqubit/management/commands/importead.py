@@ -0,0 +1,72 @@
+"""
+Import EAD finding aids into the database.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djqubit import models
+from djqubit.bulkload import BULK_OPTION, bulk_load_if
+from djqubit.ead import EADImporter, BATCH_SIZE
+from djqubit.tenants import TENANT_OPTION, tenant_command
+
+HELP = """Import EAD XML files as information object hierarchies."""
+
+
+class Command(BaseCommand):
+    args = "<eadfile> [<eadfile> ...]"
+    help = HELP
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "-p",
+            "--parent",
+            action="store",
+            dest="parent",
+            type="int",
+            default=models.InformationObject.ROOT_ID,
+            help="Id of the information object to import under"),
+        make_option(
+            "-r",
+            "--repository",
+            action="store",
+            dest="repository",
+            type="int",
+            default=None,
+            help="Id of the repository holding the material"),
+        make_option(
+            "-l",
+            "--lang",
+            action="store",
+            dest="lang",
+            default="en",
+            help="Language for imported i18n fields"),
+        make_option(
+            "-b",
+            "--batch-size",
+            action="store",
+            dest="batch_size",
+            type="int",
+            default=BATCH_SIZE,
+            help="Number of components written per batch"),
+        BULK_OPTION,
+        TENANT_OPTION,
+    )
+
+    @tenant_command
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("At least one EAD file must be provided")
+        try:
+            parent = models.InformationObject.objects.get(pk=options["parent"])
+            repository = None
+            if options["repository"] is not None:
+                repository = models.Repository.objects.get(pk=options["repository"])
+        except models.ObjectDoesNotExist, err:
+            raise CommandError(err)
+        importer = EADImporter(parent, repository, options["lang"], options["batch_size"])
+        with bulk_load_if(options["bulk"]):
+            for path in args:
+                count = importer.run(path)
+                self.stdout.write("Imported %d descriptions from %s\n" % (count, path))
+                importer.count = 0
@@ -0,0 +1,102 @@
+"""
+Import a CSV file using a declarative column mapping.  See
+djqubit.mapping for the spec format; djqubit/mappings/ has examples.
+"""
+
+import csv
+import exceptions
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+
+from djqubit import models
+from djqubit.bulkload import BULK_OPTION, bulk_load_if
+from djqubit.mapping import Mapping, MappingError, MappedImporter
+from djqubit.tenants import TENANT_OPTION, tenant_command
+
+HELP = """Import a CSV file into the database using a mapping spec."""
+
+# Queued i18n writes are flushed in batches every this many records.
+I18N_FLUSH_EVERY = 500
+
+
+class Command(BaseCommand):
+    args = "<mapping> <csvfile>"
+    help = HELP
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "-f",
+            "--from",
+            action="store",
+            dest="fromrec",
+            type="int",
+            default=1,
+            help="Import records from this offset"),
+        make_option(
+            "-t",
+            "--to",
+            action="store",
+            dest="to",
+            type="int",
+            default=-1,
+            help="Import records up to this offset"),
+        make_option(
+            "-l",
+            "--lang",
+            action="store",
+            dest="lang",
+            default=None,
+            help="Language for imported i18n fields (overrides the mapping)"),
+        BULK_OPTION,
+        TENANT_OPTION,
+    )
+
+    @tenant_command
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("A mapping file and a CSV file must be provided")
+        with bulk_load_if(options["bulk"]):
+            with transaction.commit_manually(using=router.db_for_write(models.Object)):
+                self.handle_import(*args, **options)
+
+    def handle_import(self, *args, **options):
+        using = router.db_for_write(models.Object)
+        try:
+            mapping = Mapping.load(args[0])
+        except (IOError, ValueError), err:
+            raise CommandError("Unable to load mapping: %s" % err)
+        if options["lang"]:
+            mapping.culture = options["lang"]
+
+        handle = open(args[1], "rb")
+        sample = handle.read(1024)
+        handle.seek(0)
+        dialect = csv.Sniffer().sniff(sample)
+        reader = csv.reader(handle, dialect=dialect)
+        try:
+            extract = mapping.compile([h.decode(mapping.encoding) for h in reader.next()])
+        except (StopIteration, MappingError), err:
+            raise CommandError("Unable to use mapping: %s" % err)
+        importer = MappedImporter(mapping)
+
+        count = 0
+        try:
+            with models.buffered_i18n() as i18nbuffer:
+                for row in reader:
+                    if options["fromrec"] > 0 and reader.line_num < options["fromrec"]:
+                        continue
+                    importer.save(extract(row, reader.line_num))
+                    count += 1
+                    if count % I18N_FLUSH_EVERY == 0:
+                        i18nbuffer.flush()
+                    if options["to"] > 0 and reader.line_num == options["to"]:
+                        break
+        except exceptions.BaseException, err:
+            self.stderr.write("Caught exception: %s, Rolling back imports...\n" % err)
+            transaction.rollback(using=using)
+            raise
+        else:
+            transaction.commit(using=using)
+        handle.close()
+        self.stdout.write("Imported %d records\n" % count)
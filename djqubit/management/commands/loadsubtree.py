@@ -0,0 +1,42 @@
+"""
+Load a subtree written by dumpsubtree as the last child of a node,
+with new ids, e.g.:
+
+    ./manage.py loadsubtree informationobject 1 fonds.qst --tenant=niod
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from djqubit import models, subtree
+from djqubit.bulkload import BULK_OPTION, bulk_load_if
+from djqubit.tenants import TENANT_OPTION, tenant_command
+
+HELP = """Load a dumped subtree under a node of a djqubit tree model."""
+
+
+class Command(BaseCommand):
+    args = "<model> <parent id> <file>"
+    help = HELP
+    option_list = BaseCommand.option_list + (
+        BULK_OPTION,
+        TENANT_OPTION,
+    )
+
+    @tenant_command
+    def handle(self, *args, **options):
+        if len(args) != 3:
+            raise CommandError("A model name, a parent id and a file must be provided")
+        model = get_model("djqubit", args[0])
+        if model is None or not issubclass(model, models.NestedObject):
+            raise CommandError("'%s' is not a djqubit tree model" % args[0])
+        try:
+            parent = model._base_manager.get(pk=int(args[1]))
+        except (ValueError, model.DoesNotExist):
+            raise CommandError("No %s with id %s" % (args[0], args[1]))
+        try:
+            with bulk_load_if(options["bulk"]):
+                root = subtree.load_subtree(args[2], parent)
+        except (IOError, ValueError), err:
+            raise CommandError(str(err))
+        self.stdout.write("Loaded subtree as %s %d\n" % (args[0], root.pk))
@@ -0,0 +1,30 @@
+"""
+Rebuild the autocompletion name index of a database and rewrite its
+snapshot (see djqubit.autocomplete), e.g. after loading names with
+raw SQL:
+
+    ./manage.py rebuildautocomplete --tenant=kcl
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import router
+
+from djqubit import autocomplete, models
+from djqubit.tenants import TENANT_OPTION, tenant_command
+
+HELP = """Rebuild the autocompletion name index and its snapshot."""
+
+
+class Command(BaseCommand):
+    help = HELP
+    option_list = BaseCommand.option_list + (
+        TENANT_OPTION,
+    )
+
+    @tenant_command
+    def handle(self, *args, **options):
+        using = router.db_for_read(models.Actor)
+        autocomplete.discard_index(using)
+        index = autocomplete.load_index(using, rebuild=True)
+        self.stdout.write("Indexed %d names\n" % sum(len(entries)
+                for entries in index.entries.itervalues()))
@@ -0,0 +1,70 @@
+"""
+Rebuild the nested-set lft/rgt values of a Qubit tree table from its
+parent ids, e.g.:
+
+    ./manage.py rebuildnestedset informationobject
+    ./manage.py rebuildnestedset term --engine=python
+    ./manage.py rebuildnestedset actor --benchmark
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from djqubit import models, nestedset
+from djqubit.tenants import TENANT_OPTION, tenant_command
+
+HELP = """Rebuild nested-set values for a djqubit tree model."""
+
+
+class Command(BaseCommand):
+    args = "<model>"
+    help = HELP
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "-e",
+            "--engine",
+            action="store",
+            dest="engine",
+            type="choice",
+            choices=[nestedset.NUMPY, nestedset.PYTHON],
+            default=None,
+            help="Computation engine (default: numpy if installed)"),
+        make_option(
+            "-c",
+            "--chunk-size",
+            action="store",
+            dest="chunksize",
+            type="int",
+            default=nestedset.CHUNK_SIZE,
+            help="Rows per batched UPDATE"),
+        make_option(
+            "-b",
+            "--benchmark",
+            action="store_true",
+            dest="benchmark",
+            default=False,
+            help="Time each engine against a row-by-row walk, writing nothing"),
+        TENANT_OPTION,
+    )
+
+    @tenant_command
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("One (and only one) model name must be provided")
+        model = get_model("djqubit", args[0])
+        if model is None or not issubclass(model, models.NestedObject):
+            raise CommandError("'%s' is not a djqubit tree model" % args[0])
+
+        if options["benchmark"]:
+            for name, seconds in nestedset.benchmark(model):
+                self.stdout.write("%-8s %.3fs\n" % (name, seconds))
+            return
+
+        try:
+            updated = nestedset.rebuild(model, engine=options["engine"],
+                    chunk_size=options["chunksize"])
+        except nestedset.NestedSetError, err:
+            raise CommandError(str(err))
+        self.stdout.write("Updated %d rows\n" % updated)
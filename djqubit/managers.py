@@ -0,0 +1,189 @@
+"""
+Custom managers and querysets for djqubit models.
+"""
+
+from django.core.exceptions import FieldError
+from django.db import connections, models
+from django.db.models import Q
+from django.utils.datastructures import SortedDict
+
+
+class EventQuerySet(models.query.QuerySet):
+    """Date-range and tree-restricted queries over events."""
+    def overlapping(self, start=None, end=None):
+        """Events whose [start_date, end_date] overlaps [start, end].
+        An event with no end date is treated as lasting its start day;
+        either bound may be None for an open range."""
+        qs = self.filter(start_date__isnull=False)
+        if end is not None:
+            qs = qs.filter(start_date__lte=end)
+        if start is not None:
+            qs = qs.filter(Q(end_date__gte=start)
+                    | Q(end_date__isnull=True, start_date__gte=start))
+        return qs
+
+    def within(self, start, end):
+        """Events lying entirely inside [start, end]."""
+        return self.filter(start_date__gte=start).filter(
+                Q(end_date__lte=end) | Q(end_date__isnull=True, start_date__lte=end))
+
+    def in_subtree(self, node, include_self=True):
+        """Events attached to information objects under `node`."""
+        if include_self:
+            return self.filter(information_object__lft__gte=node.lft,
+                    information_object__rgt__lte=node.rgt)
+        return self.filter(information_object__lft__gt=node.lft,
+                information_object__rgt__lt=node.rgt)
+
+    def of_type(self, *types):
+        return self.filter(type__in=types)
+
+    def chronological(self):
+        return self.order_by("start_date", "end_date", "pk")
+
+
+class EventManager(models.Manager):
+    """Manager exposing EventQuerySet methods, e.g.:
+
+        Event.objects.of_type(Term.CREATION_ID)\\
+                .overlapping(date(1933, 1, 1), date(1945, 12, 31))\\
+                .in_subtree(fonds)
+    """
+    def get_query_set(self):
+        return EventQuerySet(self.model, using=self._db)
+
+    def overlapping(self, *args, **kwargs):
+        return self.get_query_set().overlapping(*args, **kwargs)
+
+    def within(self, *args, **kwargs):
+        return self.get_query_set().within(*args, **kwargs)
+
+    def in_subtree(self, *args, **kwargs):
+        return self.get_query_set().in_subtree(*args, **kwargs)
+
+    def of_type(self, *args, **kwargs):
+        return self.get_query_set().of_type(*args, **kwargs)
+
+    def chronological(self):
+        return self.get_query_set().chronological()
+
+
+def i18n_field_sql(model, name, cultures, connection):
+    """SQL (and params) for the value of i18n field `name` of a row of
+    `model`'s table in the first of `cultures` that has a row."""
+    from djqubit.models import FALLBACK_CULTURE, i18n_tables, inheritance_chain
+    for table in inheritance_chain(model):
+        for i18nmodel in i18n_tables(table):
+            if name not in ("base", "culture") and name in [f.name for f in i18nmodel._meta.fields]:
+                break
+        else:
+            continue
+        break
+    else:
+        raise FieldError("%s has no i18n field %s" % (model.__name__, name))
+    qn = connection.ops.quote_name
+    cultures = list(cultures or [])
+    if FALLBACK_CULTURE not in cultures:
+        cultures.append(FALLBACK_CULTURE)
+    value = "(SELECT %s FROM %s WHERE %s = %s.%s AND %s = %%s)" % (
+            qn(i18nmodel._meta.get_field(name).column), qn(i18nmodel._meta.db_table),
+            qn(i18nmodel._meta.get_field("base").column), qn(model._meta.db_table),
+            qn(model._meta.pk.column), qn("culture"))
+    if len(cultures) == 1:
+        return value, cultures
+    return "COALESCE(%s)" % ", ".join([value] * len(cultures)), cultures
+
+
+def lookup_sql(connection, sql, lookup, value):
+    """A WHERE condition (and params) applying a field lookup to `sql`."""
+    if lookup == "isnull":
+        return "%s IS %sNULL" % (sql, "" if value else "NOT "), []
+    if lookup == "in":
+        value = list(value)
+        return "%s IN (%s)" % (sql, ", ".join(["%s"] * len(value))), value
+    if lookup not in connection.operators:
+        raise FieldError("Unsupported lookup '%s' on a translated field" % lookup)
+    if lookup in ("contains", "icontains"):
+        value = "%%%s%%" % connection.ops.prep_for_like_query(value)
+    elif lookup in ("startswith", "istartswith"):
+        value = "%s%%" % connection.ops.prep_for_like_query(value)
+    elif lookup in ("endswith", "iendswith"):
+        value = "%%%s" % connection.ops.prep_for_like_query(value)
+    elif lookup == "iexact":
+        value = connection.ops.prep_for_iexact_query(value)
+    return "%s %s" % (connection.ops.lookup_cast(lookup) % sql,
+            connection.operators[lookup]), [value]
+
+
+class I18NQuerySet(models.query.QuerySet):
+    """Querysets which can select, sort and filter on translated fields
+    in the database."""
+    def __init__(self, *args, **kwargs):
+        super(I18NQuerySet, self).__init__(*args, **kwargs)
+        self._i18n_fields = {}
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault("_i18n_fields", dict(self._i18n_fields))
+        return super(I18NQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def annotate_i18n(self, name, cultures=None):
+        """Add i18n field `name` as a column taken from the first of
+        `cultures` with a row, then FALLBACK_CULTURE, e.g.:
+
+            InformationObject.objects.annotate_i18n("title", ["fr", "en"])\
+                    .filter(title__istartswith="a").order_by("title")
+
+        The column can be used in order_by(), values() and in keyword
+        lookups passed to filter() and exclude()."""
+        if name in [f.name for f in self.model._meta.fields]:
+            raise FieldError("%s already has a field %s" % (self.model.__name__, name))
+        sql, params = i18n_field_sql(self.model, name, cultures, connections[self.db])
+        clone = self.extra(select=SortedDict([(name, sql)]), select_params=params)
+        clone._i18n_fields[name] = (sql, params)
+        return clone
+
+    def _i18n_lookups(self, kwargs, negate=False):
+        """Split keyword lookups on annotated i18n fields, as WHERE
+        conditions and params, from the rest.  Negated conditions, like
+        exclude() on a nullable field, also match NULL."""
+        connection = connections[self.db]
+        where, params, rest = [], [], {}
+        for key, value in kwargs.iteritems():
+            parts = key.split("__")
+            if parts[0] not in self._i18n_fields or len(parts) > 2:
+                rest[key] = value
+                continue
+            sql, sqlparams = self._i18n_fields[parts[0]]
+            lookup = parts[1] if len(parts) > 1 else "exact"
+            condition, conditionparams = lookup_sql(connection, sql, lookup, value)
+            if negate and lookup != "isnull":
+                condition = "%s AND %s IS NOT NULL" % (condition, sql)
+                conditionparams = conditionparams + sqlparams
+            where.append(condition)
+            params.extend(sqlparams + conditionparams)
+        return where, params, rest
+
+    def filter(self, *args, **kwargs):
+        where, params, kwargs = self._i18n_lookups(kwargs)
+        clone = super(I18NQuerySet, self).filter(*args, **kwargs)
+        return clone.extra(where=where, params=params) if where else clone
+
+    def exclude(self, *args, **kwargs):
+        where, params, rest = self._i18n_lookups(kwargs, negate=True)
+        if not where:
+            return super(I18NQuerySet, self).exclude(*args, **kwargs)
+        if args or rest:
+            # exclude(a, b) drops the rows matching both a and b, so
+            # mixed lookups pick those rows out in one subquery.
+            matching = self.filter(*args, **kwargs).values("pk")
+            return super(I18NQuerySet, self).exclude(pk__in=matching)
+        return self.extra(where=["NOT (%s)" % " AND ".join(where)], params=params)
+
+
+class I18NManager(models.Manager):
+    """Manager for models with i18n tables, see I18NQuerySet."""
+    def get_query_set(self):
+        return I18NQuerySet(self.model, using=self._db)
+
+    def annotate_i18n(self, *args, **kwargs):
+        return self.get_query_set().annotate_i18n(*args, **kwargs)
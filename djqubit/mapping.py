@@ -0,0 +1,297 @@
+"""
+Declarative column mappings for tabular imports.
+
+A mapping spec (JSON, or YAML if PyYAML is installed) describes how the
+columns of a spreadsheet become djqubit objects.  Each record produces
+one object per "part"; the first part is the main object and the others
+are linked to it:
+
+    {
+      "culture": "en",
+      "parts": [
+        {"name": "repository", "model": "Repository",
+         "fields": {
+           "identifier": {"columns": ["Country"], "transforms": ["country"],
+                          "format": "ehri{line}{0}"},
+           "parent_id": {"value": 3}},
+         "i18n": {
+           "authorized_form_of_name": {"column": "Original Name",
+                                       "transforms": ["strip", ["truncate", 255]]}},
+         "slug": "authorized_form_of_name"},
+        {"name": "comments", "model": "Note", "link": "object_id",
+         "required": "content",
+         "fields": {"type_id": {"value": 127}},
+         "i18n": {"content": {"column": "Comments"}}}
+      ]
+    }
+
+A field takes a constant "value", or the value of one "column" (or the
+formatted values of several "columns"), passed through "transforms".
+Each transform is a name or a [name, arg, ...] list; see TRANSFORMS.
+
+Mapping.compile() resolves column names against the header once and
+returns a function turning a raw row into {part name: (fields, i18n)}.
+Each used cell is decoded once per row, and lookups such as country
+names and terms are memoized for the whole import.
+"""
+
+import json
+
+from django.db.models import get_model
+from django.template.defaultfilters import slugify
+
+from djqubit import models
+
+
+class MappingError(ValueError):
+    pass
+
+
+def load_spec(path):
+    """Read a mapping spec from a JSON or YAML file."""
+    handle = open(path)
+    try:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise MappingError("PyYAML is required to read %s" % path)
+            return yaml.safe_load(handle)
+        return json.load(handle)
+    finally:
+        handle.close()
+
+
+def memoize(func):
+    """Cache a one-argument lookup for the lifetime of the mapping."""
+    cache = {}
+    def lookup(value):
+        try:
+            return cache[value]
+        except KeyError:
+            result = cache[value] = func(value)
+            return result
+    return lookup
+
+
+def t_strip(arg=None):
+    return lambda v: v.strip() if v else v
+
+
+def t_truncate(length):
+    return lambda v: v[:length] if v else v
+
+
+def t_lower(arg=None):
+    return lambda v: v.lower() if v else v
+
+
+def t_upper(arg=None):
+    return lambda v: v.upper() if v else v
+
+
+def t_empty_null(arg=None):
+    return lambda v: v if v and v.strip() else None
+
+
+def t_default(value):
+    return lambda v: v if v else value
+
+
+def t_map(table):
+    return lambda v: table.get(v, v)
+
+
+def t_country(arg=None):
+    """Country name to ISO 3166 alpha-2 code."""
+    try:
+        from incf.countryutils import data as countrydata
+    except ImportError:
+        raise MappingError("The country transform requires incf.countryutils")
+    def lookup(value):
+        ccn = countrydata.cn_to_ccn.get(value.strip())
+        return countrydata.ccn_to_cca2.get(ccn) if ccn is not None else None
+    return memoize(lambda v: lookup(v) if v else None)
+
+
+def t_term(taxonomy):
+    """Term name to term id within a taxonomy (None if unknown)."""
+    def lookup(value):
+        ids = models.TermI18N.objects.filter(base__taxonomy=taxonomy, name=value)\
+                .values_list("base", flat=True)[:1]
+        return ids[0] if ids else None
+    return memoize(lambda v: lookup(v) if v else None)
+
+
+def t_phpserialize(arg=None):
+    """Serialise the value as a one-item PHP array, as Qubit stores
+    language and script properties."""
+    try:
+        import phpserialize
+    except ImportError:
+        raise MappingError("The phpserialize transform requires phpserialize")
+    return memoize(lambda v: phpserialize.dumps([v]) if v else None)
+
+
+TRANSFORMS = {
+    "strip": t_strip,
+    "truncate": t_truncate,
+    "lower": t_lower,
+    "upper": t_upper,
+    "empty_null": t_empty_null,
+    "default": t_default,
+    "map": t_map,
+    "country": t_country,
+    "term": t_term,
+    "phpserialize": t_phpserialize,
+}
+
+
+def compile_transforms(specs):
+    """Compose a list of transform specs into a single function."""
+    funcs = []
+    for spec in specs or []:
+        if isinstance(spec, basestring):
+            name, args = spec, []
+        else:
+            name, args = spec[0], list(spec[1:])
+        if name not in TRANSFORMS:
+            raise MappingError("Unknown transform: %s" % name)
+        funcs.append(TRANSFORMS[name](*args))
+    if not funcs:
+        return None
+    if len(funcs) == 1:
+        return funcs[0]
+    def apply(value):
+        for func in funcs:
+            value = func(value)
+        return value
+    return apply
+
+
+class Part(object):
+    """One object produced per record."""
+    def __init__(self, spec):
+        self.name = spec["name"]
+        self.model = get_model("djqubit", spec["model"])
+        if self.model is None:
+            raise MappingError("Unknown model: %s" % spec["model"])
+        self.link = spec.get("link")
+        self.required = spec.get("required")
+        self.slug = spec.get("slug")
+        self.fields = spec.get("fields", {})
+        self.i18n = spec.get("i18n", {})
+
+
+class Mapping(object):
+    """A parsed mapping spec."""
+    def __init__(self, spec):
+        self.culture = spec.get("culture", models.FALLBACK_CULTURE)
+        self.encoding = spec.get("encoding", "utf8")
+        self.parts = [Part(p) for p in spec["parts"]]
+        if not self.parts:
+            raise MappingError("A mapping needs at least one part")
+
+    @classmethod
+    def load(cls, path):
+        return cls(load_spec(path))
+
+    def compile(self, header):
+        """Return a function of (row, line) giving {part: (fields, i18n)}
+        for a raw row of cells laid out as in `header`."""
+        header = [h.strip() for h in header]
+        used = []
+
+        def cell(column):
+            if column not in header:
+                raise MappingError("No such column: %s" % column)
+            index = header.index(column)
+            if index not in used:
+                used.append(index)
+            return used.index(index)
+
+        # (part, 0 for model fields or 1 for i18n, field, function)
+        extractors = []
+        for part in self.parts:
+            for slot, fields in enumerate((part.fields, part.i18n)):
+                for name, spec in fields.iteritems():
+                    extractors.append((part.name, slot, name,
+                            self.extractor(spec, cell)))
+        encoding = self.encoding
+        partnames = [p.name for p in self.parts]
+
+        def extract(row, line):
+            cells = []
+            for index in used:
+                value = row[index] if index < len(row) else ""
+                cells.append(value.decode(encoding) if isinstance(value, str) else value)
+            record = dict((name, ({}, {})) for name in partnames)
+            for partname, slot, name, func in extractors:
+                record[partname][slot][name] = func(cells, line)
+            return record
+        return extract
+
+    def extractor(self, spec, cell):
+        """Compile one field spec into a function of (cells, line)."""
+        transform = compile_transforms(spec.get("transforms"))
+        if "value" in spec:
+            value = spec["value"]
+            if transform is not None:
+                value = transform(value)
+            return lambda cells, line: value
+        if "column" in spec:
+            index = cell(spec["column"])
+            if transform is None:
+                return lambda cells, line: cells[index]
+            return lambda cells, line: transform(cells[index])
+        if "columns" in spec:
+            indexes = [cell(c) for c in spec["columns"]]
+            template = spec.get("format", u" ".join(["{%d}" % i for i in range(len(indexes))]))
+            transform = transform or (lambda v: v)
+            return lambda cells, line: template.format(
+                    *[transform(cells[i]) or u"" for i in indexes], line=line)
+        if "format" in spec:
+            template = spec["format"]
+            return lambda cells, line: template.format(line=line)
+        raise MappingError("Field needs a value, column or columns: %r" % spec)
+
+
+class MappedImporter(object):
+    """Save the records produced by a compiled mapping."""
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.slugs = set()
+
+    def save(self, record):
+        """Create the objects for one extracted record and return the
+        main object."""
+        culture = self.mapping.culture
+        main = None
+        for part in self.mapping.parts:
+            fields, i18n = record[part.name]
+            if part.required and not (fields.get(part.required) or i18n.get(part.required)):
+                continue
+            obj = part.model(**fields)
+            if part.link and main is not None:
+                setattr(obj, part.link, main)
+            for name in ("source_culture", "repository_source_culture"):
+                if hasattr(obj, name) and not getattr(obj, name):
+                    setattr(obj, name, culture)
+            obj.save()
+            if i18n:
+                obj.set_i18n(culture, i18n)
+            if part.slug and isinstance(obj, models.Object):
+                value = i18n.get(part.slug) or fields.get(part.slug)
+                models.Slug(object_id=obj, slug=self.unique_slug(value)).save()
+            if main is None:
+                main = obj
+        return main
+
+    def unique_slug(self, value):
+        suffix = 0
+        potential = base = slugify(value or u"")[:235] or u"untitled"
+        while potential in self.slugs or models.Slug.objects.filter(slug=potential).exists():
+            suffix += 1
+            potential = u"%s-%d" % (base, suffix)
+        self.slugs.add(potential)
+        return potential
@@ -0,0 +1,184 @@
+"""
+Matching incoming institution records against existing repositories.
+
+Comparing every incoming row with every repository is quadratic, so a
+blocking index is built once: each repository is filed under
+(country code, token) for every token of its normalised names, and
+under (None, token) for rows whose country is unknown.  An incoming
+row is only scored against the repositories sharing one of its blocks,
+preferring the rarest tokens, which is usually a handful.
+"""
+
+import re
+import unicodedata
+from collections import defaultdict
+
+from djqubit import models
+
+# Words which carry no weight when comparing institution names.
+STOPWORDS = frozenset("""
+    a an and at de del der des di die du en et for fur in la le les of
+    the und van von voor zu
+""".split())
+
+# Blocks larger than this are skipped when the row has rarer tokens.
+MAX_BLOCK = 50
+
+# Minimum score for a candidate to count as a match.
+THRESHOLD = 0.8
+
+# Mail domains which say nothing about the institution.
+GENERIC_DOMAINS = frozenset(["gmail.com", "hotmail.com", "yahoo.com", "aol.com",
+        "outlook.com", "web.de", "gmx.de", "gmx.net"])
+
+NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def fold(text):
+    """Lowercase `text` and strip its accents."""
+    if not text:
+        return u""
+    if isinstance(text, str):
+        text = text.decode("utf8")
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return u"".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def name_tokens(name):
+    """The significant tokens of a name, as a frozenset."""
+    return frozenset(t for t in NON_WORD.split(fold(name))
+            if len(t) > 1 and t not in STOPWORDS)
+
+
+def domain(value):
+    """The host part of an email address or URL, without "www."."""
+    value = fold(value).strip()
+    if not value:
+        return None
+    if "@" in value:
+        value = value.rsplit("@", 1)[1]
+    else:
+        value = re.sub(r"^[a-z]+://", "", value).split("/", 1)[0]
+    if value.startswith("www."):
+        value = value[4:]
+    return value or None
+
+
+class Entry(object):
+    """What the index knows about one repository."""
+    __slots__ = ("id", "names", "country", "city", "domains")
+
+    def __init__(self, id, country=None):
+        self.id = id
+        self.names = []
+        self.country = (country or u"").upper()
+        self.city = None
+        self.domains = set()
+
+
+class RepositoryIndex(object):
+    """In-memory blocking index over repositories."""
+    def __init__(self):
+        self.entries = {}
+        self.blocks = defaultdict(set)
+
+    @classmethod
+    def build(cls, using=None):
+        """Index every repository, with its authorised and other names
+        and contact details, in five queries."""
+        index = cls()
+        repos = models.Repository.objects.all()
+        names = models.ActorI18N.objects.all()
+        othernames = models.OtherNameI18N.objects.all()
+        contacts = models.ContactInformation.objects.all()
+        cities = models.ContactInformationI18N.objects.all()
+        if using is not None:
+            repos, names, othernames, contacts, cities = [qs.using(using)
+                    for qs in (repos, names, othernames, contacts, cities)]
+        ids = repos.values("pk")
+        entries = dict((pk, Entry(pk)) for pk, in repos.values_list("pk"))
+        for actor, country, email, website in contacts\
+                .filter(actor__in=ids).order_by("-primary_contact")\
+                .values_list("actor", "country_code", "email", "website"):
+            entry = entries[actor]
+            if not entry.country and country:
+                entry.country = country.upper()
+            entry.domains.update(d for d in (domain(email), domain(website))
+                    if d and d not in GENERIC_DOMAINS)
+        for actor, city in cities.filter(base__actor__in=ids)\
+                .values_list("base__actor", "city"):
+            if city and entries[actor].city is None:
+                entries[actor].city = fold(city)
+        for actor, name in names.filter(base__in=ids)\
+                .values_list("base", "authorized_form_of_name"):
+            entries[actor].names.append(name)
+        for actor, name in othernames.filter(base__object_id__in=ids)\
+                .values_list("base__object_id", "name"):
+            entries[actor].names.append(name)
+        for entry in entries.itervalues():
+            index.add_entry(entry)
+        return index
+
+    def add_entry(self, entry):
+        entry.names = list(set(t for t in (name_tokens(n) for n in entry.names) if t))
+        self.entries[entry.id] = entry
+        for tokens in entry.names:
+            for token in tokens:
+                self.blocks[(entry.country, token)].add(entry.id)
+                self.blocks[(None, token)].add(entry.id)
+
+    def add(self, id, names, country=None, city=None, email=None, website=None):
+        """Index a repository created during the import, so that later
+        rows match it too."""
+        entry = Entry(id, country)
+        entry.names = list(names)
+        entry.city = fold(city) or None
+        entry.domains.update(d for d in (domain(email), domain(website))
+                if d and d not in GENERIC_DOMAINS)
+        self.add_entry(entry)
+
+    def candidates(self, tokens, country=None):
+        """Ids of repositories sharing a block with the given tokens,
+        in any country if `country` is not given."""
+        country = country.upper() if country else None
+        blocks = sorted((self.blocks.get((country, t), ()) for t in tokens), key=len)
+        found = set()
+        for block in blocks:
+            if found and len(block) > MAX_BLOCK:
+                break
+            found.update(block)
+        return found
+
+    def score(self, entry, tokens, city=None, domains=()):
+        """Similarity in [0, ~1.3]: the best Jaccard overlap between
+        name token sets, plus a little for a shared city or domain."""
+        best = 0.0
+        for names in entry.names:
+            for incoming in tokens:
+                union = len(names | incoming)
+                if union:
+                    best = max(best, len(names & incoming) / float(union))
+        if city and entry.city == city:
+            best += 0.1
+        if entry.domains & set(domains):
+            best += 0.2
+        return best
+
+    def match(self, name, country=None, city=None, email=None, website=None,
+            other_names=()):
+        """Return the id of the best-matching repository, or None."""
+        tokens = [t for t in (name_tokens(n) for n in (name,) + tuple(other_names)) if t]
+        if not tokens:
+            return None
+        candidates = set()
+        for t in tokens:
+            candidates.update(self.candidates(t, country))
+        city = fold(city) or None
+        domains = [d for d in (domain(email), domain(website))
+                if d and d not in GENERIC_DOMAINS]
+        best, bestscore = None, 0.0
+        for id in sorted(candidates):
+            score = self.score(self.entries[id], tokens, city, domains)
+            if score >= THRESHOLD and score > bestscore:
+                best, bestscore = id, score
+        return best
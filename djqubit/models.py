@@ -3,13 +3,22 @@ DjQubit Models.
 """
 
 import datetime
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 
 from django.db import models, connections, transaction, router
+from django.dispatch import Signal
 from django.db.models import F, Max
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 
+from djqubit.managers import EventManager, I18NManager
+
 FALLBACK_CULTURE = "en"
 
+# Number of ids per IN (...) clause when prefetching related rows.
+PREFETCH_BATCH_SIZE = 500
+
 
 class I18NValidationError(ValidationError):
     pass
@@ -21,62 +30,355 @@ def dict_cursor(cursor):
         yield dict(zip(description, row))
 
 
+def i18n_model(cls):
+    """Return the i18n model for a model class.  Going through the
+    class avoids instance related managers, which for NestedObject
+    subclasses cost a query to resolve the inherited `id` link."""
+    return cls.i18n.related.model
+
+
+def i18n_tables(cls):
+    """The i18n models keyed on a model's own table, as opposed to
+    inherited ones: Repository has RepositoryI18N, while its ActorI18N
+    belongs to Actor."""
+    return [r.model for r in cls._meta.get_all_related_objects(local_only=True)
+            if r.field.name == "base"]
+
+
+def prefetch_i18n(objects, cultures=None):
+    """Fetch the i18n rows for a list of objects with one query per
+    i18n table and cache them on each instance, so that subsequent
+    get_i18n() calls do not touch the database.  If `cultures` is
+    given only those (and the fallback culture) are fetched."""
+    wanted = None
+    if cultures is not None:
+        wanted = set(cultures) | set([FALLBACK_CULTURE])
+    byi18n = defaultdict(list)
+    for obj in objects:
+        byi18n[(i18n_model(obj.__class__), obj._state.db)].append(obj)
+    for (i18nmodel, using), objs in byi18n.iteritems():
+        rows = defaultdict(dict)
+        pks = [obj.pk for obj in objs]
+        for i in range(0, len(pks), PREFETCH_BATCH_SIZE):
+            qs = i18nmodel.objects.using(using).filter(
+                    base__in=pks[i:i + PREFETCH_BATCH_SIZE])
+            if wanted is not None:
+                qs = qs.filter(culture__in=wanted)
+            for row in qs:
+                rows[row.base_id][row.culture] = row
+        for obj in objs:
+            obj._i18n_cache = rows[obj.pk]
+            obj._i18n_cultures = wanted
+    return objects
+
+
 class I18NMixin(object):
     """Mixin for I18N-related methods."""
+    # The i18n field used as a display name for this model.
+    i18n_name_field = "name"
+
+    def _get_cached_i18n(self, culture):
+        """Return the prefetched i18n row for `culture` (falling back
+        to FALLBACK_CULTURE), or raise KeyError if nothing suitable
+        was prefetched."""
+        cache = getattr(self, "_i18n_cache", None)
+        if cache is None:
+            raise KeyError(culture)
+        wanted = self._i18n_cultures
+        if wanted is not None and culture not in wanted:
+            raise KeyError(culture)
+        if culture in cache:
+            return cache[culture]
+        if FALLBACK_CULTURE in cache:
+            return cache[FALLBACK_CULTURE]
+        raise i18n_model(self.__class__).DoesNotExist
+
     def get_i18n(self, culture, name):
         """Get i18n data."""
+        try:
+            return getattr(self._get_cached_i18n(culture), name)
+        except KeyError:
+            pass
+        buffer = current_i18n_buffer()
+        if buffer is not None and buffer.has_pending(self.__class__, self.pk):
+            buffer.flush()
+        i18n = i18n_model(self.__class__).objects.using(self._state.db)\
+                .filter(base=self.pk)
         try:                                                 
-            return getattr(self.i18n.get(culture=culture), name)
+            return getattr(i18n.get(culture=culture), name)
         except ObjectDoesNotExist:
-            return getattr(self.i18n.get(culture=FALLBACK_CULTURE), name)        
+            return getattr(i18n.get(culture=FALLBACK_CULTURE), name)        
 
     def set_i18n(self, culture, data):
-        """Set i18n data for a model."""
+        """Set i18n data for a model, on the database it was loaded
+        from or saved to.  Inside a buffered_i18n() block the write is
+        queued and coalesced with other writes to the same row."""
         if not self.pk:
             raise I18NValidationError("Cannot set i18n data on an unsaved model")
-
-        fields = self.i18n.model._meta.get_all_field_names()
-
-        # FIXME: This is VERY fragile in it's current state
-        table = self._meta.db_table
-        cursor = connections[router.db_for_read(self.__class__)].cursor()
-        findquery = "SELECT * FROM %s_i18n WHERE id=%%s AND culture=%%s" % self._meta.db_table
-        cursor.execute(findquery, [self.pk, culture])
-        row = cursor.fetchone()
-        args = [kv for kv in data.iteritems() if kv[0] in fields]
-        uquery = None
-        if row is not None:
-            fstr = ", ".join(["%s=%%s" % k[0] for k in args])
-            uquery = "UPDATE %s_i18n SET %s WHERE id=%%s AND culture=%%s" % (table, fstr)
+        self.__dict__.pop("_i18n_cache", None)
+        buffer = current_i18n_buffer()
+        if buffer is not None:
+            buffer.add(self.__class__, self.pk, culture, data, self._state.db)
         else:
-            kstr = ", ".join([a[0] for a in args]) 
-            vstr = ", ".join(['%s' for a in args])
-            uquery = "INSERT INTO %s_i18n (%s,id,culture) VALUES (%s,%%s,%%s)" % (
-                    table, kstr, vstr)
-        cursor.execute(uquery, [a[1] for a in args] + [self.pk, culture])
-        transaction.commit_unless_managed(using=router.db_for_write(self.__class__))
+            write_i18n(self.__class__, [(self.pk, culture, data)], self._state.db)
+
+
+class I18NStatements(object):
+    """SQL for writing a model's i18n rows, built once per model and
+    database and reused for every write."""
+    def __init__(self, model, alias):
+        self.alias = alias
+        i18nmodel = i18n_model(model)
+        qn = connections[alias].ops.quote_name
+        self.table = qn(i18nmodel._meta.db_table)
+        self.columns = dict((f.name, qn(f.column)) for f in i18nmodel._meta.fields
+                if f.name not in ("base", "culture"))
+        self.id = qn("id")
+        self.culture = qn("culture")
+        self.exists = "SELECT %s, %s FROM %s WHERE %s IN (%%s)" % (
+                self.id, self.culture, self.table, self.id)
+        self._updates = {}
+        self._inserts = {}
+
+    def names(self, data):
+        """The i18n field names in `data`, in a stable order.  Unknown
+        keys are ignored."""
+        return tuple(sorted(k for k in data if k in self.columns))
+
+    def update(self, names):
+        query = self._updates.get(names)
+        if query is None:
+            query = self._updates[names] = "UPDATE %s SET %s WHERE %s=%%s AND %s=%%s" % (
+                    self.table, ", ".join("%s=%%s" % self.columns[n] for n in names),
+                    self.id, self.culture)
+        return query
+
+    def insert(self, names):
+        query = self._inserts.get(names)
+        if query is None:
+            cols = [self.columns[n] for n in names] + [self.id, self.culture]
+            query = self._inserts[names] = "INSERT INTO %s (%s) VALUES (%s)" % (
+                    self.table, ", ".join(cols), ", ".join(["%s"] * len(cols)))
+        return query
+
+
+_i18n_statements = {}
+
+
+def i18n_statements(model, using=None):
+    """Get the cached I18NStatements for a model on the given database
+    (default its write database)."""
+    alias = using or router.db_for_write(model)
+    key = (model, alias)
+    if key not in _i18n_statements:
+        _i18n_statements[key] = I18NStatements(model, alias)
+    return _i18n_statements[key]
+
+
+# Sent by write_i18n() with the model as sender, once per call.
+i18n_written = Signal(providing_args=["rows", "using"])
+
+
+def write_i18n(model, rows, using=None):
+    """Insert or update i18n rows for a model on the given database
+    (default its write database).  `rows` is a list of (pk, culture,
+    data) tuples, with at most one tuple per (pk, culture).  A single
+    row costs one UPDATE (plus an INSERT if it did not exist); several
+    rows cost one existence check and one batched statement per
+    distinct set of fields."""
+    stmts = i18n_statements(model, using)
+    cursor = connections[stmts.alias].cursor()
+    changes = []
+    if len(rows) == 1:
+        pk, culture, data = rows[0]
+        names = stmts.names(data)
+        if names:
+            cursor.execute(stmts.update(names),
+                    [data[n] for n in names] + [pk, culture])
+            if cursor.rowcount:
+                changes.append((pk, culture, ChangeLog.UPDATE))
+            else:
+                cursor.execute(stmts.insert(names),
+                        [data[n] for n in names] + [pk, culture])
+                changes.append((pk, culture, ChangeLog.INSERT))
+        else:
+            cursor.execute(stmts.exists % "%s" + " AND %s=%%s" % stmts.culture,
+                    [pk, culture])
+            if cursor.fetchone() is None:
+                cursor.execute(stmts.insert(names), [pk, culture])
+                changes.append((pk, culture, ChangeLog.INSERT))
+    elif rows:
+        existing = set()
+        pks = list(set(row[0] for row in rows))
+        for i in range(0, len(pks), PREFETCH_BATCH_SIZE):
+            batch = pks[i:i + PREFETCH_BATCH_SIZE]
+            cursor.execute(stmts.exists % ", ".join(["%s"] * len(batch)), batch)
+            existing.update(tuple(r) for r in cursor.fetchall())
+        updates = defaultdict(list)
+        inserts = defaultdict(list)
+        for pk, culture, data in rows:
+            names = stmts.names(data)
+            params = [data[n] for n in names] + [pk, culture]
+            if (pk, culture) in existing:
+                if names:
+                    updates[names].append(params)
+                    changes.append((pk, culture, ChangeLog.UPDATE))
+            else:
+                inserts[names].append(params)
+                changes.append((pk, culture, ChangeLog.INSERT))
+        for names, params in updates.iteritems():
+            cursor.executemany(stmts.update(names), params)
+        for names, params in inserts.iteritems():
+            cursor.executemany(stmts.insert(names), params)
+    if changes and issubclass(model, Object):
+        classname = "Qubit%s" % model.__name__
+        log_changes(stmts.alias, [(pk, classname, culture, action)
+                for pk, culture, action in changes])
+    transaction.commit_unless_managed(using=stmts.alias)
+    i18n_written.send(sender=model, rows=rows, using=stmts.alias)
+
+
+class I18NBuffer(object):
+    """Unit of work for i18n writes.  Repeated writes to the same
+    (model, database, pk, culture) row are merged and written by
+    flush()."""
+    def __init__(self):
+        self.pending = {}
+
+    def add(self, model, pk, culture, data, using=None):
+        self.pending.setdefault((model, using, pk, culture), {}).update(data)
+
+    def has_pending(self, model, pk):
+        return any(m is model and p == pk for m, u, p, c in self.pending)
+
+    def flush(self):
+        bymodel = defaultdict(list)
+        for (model, using, pk, culture), data in self.pending.iteritems():
+            bymodel[(model, using)].append((pk, culture, data))
+        self.pending = {}
+        for (model, using), rows in bymodel.iteritems():
+            write_i18n(model, rows, using)
+
+
+_i18n_local = threading.local()
+
+
+def current_i18n_buffer():
+    return getattr(_i18n_local, "buffer", None)
+
+
+@contextmanager
+def buffered_i18n():
+    """Queue set_i18n() writes made inside the block and write them,
+    coalesced, when it exits.  Use it inside the transaction so the
+    writes land before the commit:
+
+        with transaction.commit_on_success(using="djqubit"):
+            with buffered_i18n():
+                ...
+
+    Pending writes are discarded if the block raises.  Nested blocks
+    share the outermost buffer."""
+    buffer = current_i18n_buffer()
+    if buffer is not None:
+        yield buffer
+        return
+    buffer = _i18n_local.buffer = I18NBuffer()
+    try:
+        yield buffer
+        _i18n_local.buffer = None
+        buffer.flush()
+    finally:
+        _i18n_local.buffer = None
+
+
+class ConcurrentUpdateError(Exception):
+    """Raised when saving a row which has been saved elsewhere since
+    it was read."""
+    pass
 
 
-class Object(models.Model):
+class SerialNumberMixin(object):
+    """
+    Optimistic locking on Qubit's serial_number version counter.  An
+    existing row is saved only after a conditional UPDATE bumps its
+    serial number from the value read; if another writer got there
+    first that matches nothing and ConcurrentUpdateError is raised, so
+    no table or long-lived transaction lock is needed.  The claim and
+    the writes it guards run in one transaction: the caller's, inside
+    a managed transaction, otherwise one of their own.
+    """
+    @contextmanager
+    def serial_transaction(self, using=None):
+        """Run a save's claim and writes in the caller's managed
+        transaction, or else in one committed when the block exits and
+        rolled back, claim included, if it raises."""
+        using = using or router.db_for_write(self.__class__, instance=self)
+        if transaction.is_managed(using=using):
+            yield
+            return
+        serial = self.serial_number
+        try:
+            with transaction.commit_on_success(using=using):
+                yield
+        except:
+            self.serial_number = serial
+            raise
+
+    def claim_serial_number(self, using=None):
+        """Bump the stored serial number if it still matches ours.
+        A row which does not exist yet is left for the insert."""
+        if self.__dict__.pop("_serial_claimed", False):
+            return
+        model = self._meta.get_field("serial_number").model
+        using = using or router.db_for_write(self.__class__, instance=self)
+        rows = model._base_manager.using(using).filter(pk=self.pk)
+        if rows.filter(serial_number=self.serial_number)\
+                .update(serial_number=F("serial_number") + 1):
+            self.serial_number += 1
+        elif rows.exists():
+            raise ConcurrentUpdateError("%s %s was modified by someone else" % (
+                    self.__class__.__name__, self.pk))
+
+
+def retry_on_conflict(func, attempts=3, using=None):
+    """Call `func` in a transaction on the given database (default the
+    one djqubit objects are routed to) until it gets through without a
+    ConcurrentUpdateError, at most `attempts` times.  `func` must
+    re-read the objects it changes, so each attempt sees fresh serial
+    numbers."""
+    using = using or router.db_for_write(Object)
+    for attempt in range(attempts):
+        try:
+            with transaction.commit_on_success(using=using):
+                return func()
+        except ConcurrentUpdateError:
+            if attempt == attempts - 1:
+                raise
+
+
+class Object(models.Model, SerialNumberMixin):
     """Object model."""
     object = models.AutoField(primary_key=True, db_column="id")
     class_name = models.CharField(max_length=255)
     serial_number = models.IntegerField(default=0)
     created_at = models.DateTimeField(editable=False)
-    updated_at = models.DateTimeField(editable=False)
+    updated_at = models.DateTimeField(editable=False, db_index=True)
 
     class Meta:
         db_table = "object"
 
-    def save(self):
+    def save(self, *args, **kwargs):
+        if not self.class_name:
+            self.class_name = "Qubit%s" % self.__class__.__name__
         if not self.object:
             self.created_at = datetime.datetime.now()
             self.updated_at = datetime.datetime.now()
-        else:
+            return super(Object, self).save(*args, **kwargs)
+        with self.serial_transaction(kwargs.get("using")):
+            self.claim_serial_number(kwargs.get("using"))
             self.updated_at = datetime.datetime.now()
-        if not self.class_name:
-            self.class_name = "Qubit%s" % self.__class__.__name__
-        super(Object, self).save()
+            super(Object, self).save(*args, **kwargs)
 
     def __unicode__(self):
         return "%s: %d" % (self.class_name, self.pk)
@@ -88,6 +390,9 @@ class NestedObject(Object):
     tree structure which allows for optimised traversal, as opposed to
     crawling the heirarchy via the database.
     """
+    # Fields (or relation paths) counted by facets() by default.
+    facet_fields = ()
+
     id = models.OneToOneField(Object, primary_key=True, db_column="id")
     parent = models.ForeignKey("self", null=True, blank=True, related_name="children")
     lft = models.PositiveIntegerField()
@@ -97,6 +402,44 @@ class NestedObject(Object):
         abstract = True
         ordering = ["-lft"]
 
+    def get_descendants(self, include_self=False):
+        """Queryset of all nodes beneath this one in the tree."""
+        if include_self:
+            return self.__class__.objects.filter(lft__gte=self.lft, rgt__lte=self.rgt)
+        return self.__class__.objects.filter(lft__gt=self.lft, rgt__lt=self.rgt)
+
+    def facets(self, facets=None, include_self=False, culture=FALLBACK_CULTURE,
+            use_cache=True):
+        """Grouped descendant counts, computed in one query.  See
+        djqubit.facets.subtree_facets."""
+        from djqubit.facets import subtree_facets
+        return subtree_facets(self, facets, include_self, culture, use_cache)
+
+    def snapshot(self, cultures=None, use_cache=True):
+        """Compact in-memory copy of the subtree under this node.  See
+        djqubit.tree.TreeSnapshot."""
+        from djqubit.tree import TreeSnapshot
+        return TreeSnapshot.load(self, cultures, use_cache)
+
+    def clone(self, new_parent):
+        """Copy this subtree under `new_parent` and return the copy.
+        See djqubit.clone.clone_subtree."""
+        from djqubit.clone import clone_subtree
+        return clone_subtree(self, new_parent)
+
+    def set_status(self, status_type, status):
+        """Set a status on this node and all its descendants.  See
+        djqubit.status.set_status_for_subtree."""
+        from djqubit.status import set_status_for_subtree
+        return set_status_for_subtree(self, status_type, status)
+
+    @classmethod
+    def rebuild_nested_set(cls, engine=None, using=None):
+        """Recompute lft/rgt for the whole table from parent ids.  See
+        djqubit.nestedset.rebuild."""
+        from djqubit import nestedset
+        return nestedset.rebuild(cls, engine=engine, using=using)
+
     def update_nested_set(self):
         """Update nested tree values for this model."""
         delta = 2
@@ -112,6 +455,7 @@ class NestedObject(Object):
                 return
             shift = maxrgt + 1 - self.lft
         else:
+            self.log_tree_changes(cls.objects.filter(rgt__gte=self.parent.rgt))
             cls.objects.filter(lft__gte=self.parent.rgt).update(lft=F('lft') + delta)
             cls.objects.filter(rgt__gte=self.parent.rgt).update(rgt=F('rgt') + delta)
             if not self.lft or not self.rgt:
@@ -123,8 +467,9 @@ class NestedObject(Object):
                 self.lft += delta
                 self.rgt += delta
                 shift = self.parent.rgt - self.lft
-        cls.objects.filter(lft__gte=self.lft, rgt__lte=self.rgt)\
-                .update(lft=F('lft') + shift, rgt=F('rgt') + shift)
+        subtree = cls.objects.filter(lft__gte=self.lft, rgt__lte=self.rgt)
+        self.log_tree_changes(subtree)
+        subtree.update(lft=F('lft') + shift, rgt=F('rgt') + shift)
         self.delete_nested_set()
         if shift > 0:
             self.lft -= delta
@@ -136,19 +481,30 @@ class NestedObject(Object):
         """Delete nested tree values for this model."""
         delta = self.rgt - self.lft + 1
         cls = self.__class__
+        self.log_tree_changes(cls.objects.filter(rgt__gte=self.rgt))
         cls.objects.filter(lft__gte=self.rgt).update(lft=F('lft') - delta)
         cls.objects.filter(rgt__gte=self.rgt).update(rgt=F('rgt') - delta)
         return
 
+    def log_tree_changes(self, rows):
+        log_tree_changes(rows.using(router.db_for_write(self.__class__, instance=self)))
+
     def save(self, *args, **kwargs):
         """Update tree-structure on when created or when parent has changed."""
         if self.pk is None:
-           self.update_nested_set()
-        else:
-            dbself = self.__class__.objects.get(pk=self.pk)
-            if dbself.parent != self.parent:
-                self.update_nested_set()
-        super(NestedObject, self).save(*args, **kwargs)
+            self.update_nested_set()
+            return super(NestedObject, self).save(*args, **kwargs)
+        with self.serial_transaction(kwargs.get("using")):
+            # Check the version before touching the tree.
+            self.claim_serial_number(kwargs.get("using"))
+            self._serial_claimed = True
+            try:
+                dbself = self.__class__.objects.get(pk=self.pk)
+                if dbself.parent != self.parent:
+                    self.update_nested_set()
+                super(NestedObject, self).save(*args, **kwargs)
+            finally:
+                self.__dict__.pop("_serial_claimed", None)
 
     def delete(self, *args, **kwargs):
         """Update tree structure on save."""
@@ -227,6 +583,8 @@ class Term(NestedObject, I18NMixin):
     code = models.CharField(max_length=255, null=True, blank=True)
     source_culture = models.CharField(max_length=25)
 
+    objects = I18NManager()
+
     # ROOT term id
     ROOT_ID = 110
 
@@ -368,6 +726,8 @@ class Relation(Object):
 
 class Actor(NestedObject, I18NMixin):
     """Actor class."""
+    i18n_name_field = "authorized_form_of_name"
+
     corporate_body_identifiers = models.CharField(max_length=255, null=True, blank=True)
     entity_type = models.ForeignKey(Term, null=True, blank=True, related_name="entity_type",
             limit_choices_to=dict(taxonomy=Taxonomy.ACTOR_ENTITY_TYPE_ID))
@@ -379,6 +739,8 @@ class Actor(NestedObject, I18NMixin):
     source_standard = models.CharField(max_length=255, null=True, blank=True)
     source_culture = models.CharField(max_length=25)
 
+    objects = I18NManager()
+
     # ROOT Actor id
     # FIXME: This is... fragile...?  Just copying Qubit here!!!
     ROOT_ID = 3
@@ -434,6 +796,8 @@ class Repository(Actor):
     repository_description_identifier = models.CharField(max_length=255, db_column="desc_identifier", null=True, blank=True)
     repository_source_culture = models.CharField(max_length=25, db_column="source_culture")
 
+    objects = I18NManager()
+
     class Meta:
         db_table = "repository"
 
@@ -493,6 +857,10 @@ class User(Actor):
 
 class InformationObject(NestedObject, I18NMixin):
     """Information Object model."""
+    i18n_name_field = "title"
+    facet_fields = ("level_of_description", "description_status", "repository",
+            "digital_objects__media_type")
+
     identifier = models.CharField(max_length=255, null=True, blank=True)
     oai_local_identifier = models.PositiveIntegerField(unique=True)
     level_of_description = models.ForeignKey(Term, null=True, blank=True, related_name="+",
@@ -508,6 +876,8 @@ class InformationObject(NestedObject, I18NMixin):
     source_standard = models.CharField(max_length=255, null=True, blank=True)
     source_culture = models.CharField(max_length=25)
 
+    objects = I18NManager()
+
     # ROOT InformationObject id
     # FIXME: This is... fragile...?  Just copying Qubit here!!!
     ROOT_ID = 1
@@ -570,9 +940,9 @@ class InformationObjectI18N(models.Model):
 class Event(Object, I18NMixin):
     """Event class."""
     id = models.OneToOneField(Object, primary_key=True, db_column="id")
-    start_date = models.DateField(null=True, blank=True)
+    start_date = models.DateField(null=True, blank=True, db_index=True)
     start_time = models.TimeField(null=True, blank=True)
-    end_date = models.DateField(null=True, blank=True)
+    end_date = models.DateField(null=True, blank=True, db_index=True)
     end_time = models.TimeField(null=True, blank=True)
     type = models.ForeignKey(Term, related_name="+",
             limit_choices_to=dict(taxonomy=Taxonomy.EVENT_TYPE_ID))
@@ -580,6 +950,8 @@ class Event(Object, I18NMixin):
     actor = models.ForeignKey(Actor, null=True, related_name="actor_object")
     source_culture = models.CharField(max_length=25)
 
+    objects = EventManager()
+
     class Meta:
         db_table = "event"
 
@@ -611,6 +983,8 @@ class EventI18N(models.Model):
 
 class Function(NestedObject, I18NMixin):
     """Function class."""
+    i18n_name_field = "authorized_form_of_name"
+
     type = models.ForeignKey(Term, null=True, related_name="+")
     description_status = models.ForeignKey(Term, null=True, blank=True, related_name="+",
             limit_choices_to=dict(taxonomy=Taxonomy.DESCRIPTION_STATUS_ID))
@@ -669,8 +1043,10 @@ class DigitalObject(NestedObject):
         db_table = "digital_object"
 
 
-class Property(models.Model, I18NMixin):
+class Property(models.Model, I18NMixin, SerialNumberMixin):
     """Property class."""
+    i18n_name_field = "value"
+
     object_id = models.ForeignKey(Object, related_name="properties", db_column="object_id")
     scope = models.CharField(max_length=255, null=True, blank=True)
     name = models.CharField(max_length=255, null=True, blank=True)
@@ -686,9 +1062,11 @@ class Property(models.Model, I18NMixin):
         if not self.id:
             self.created_at = datetime.datetime.now()
             self.updated_at = datetime.datetime.now()
-        else:
+            return super(Property, self).save(*args, **kwargs)
+        with self.serial_transaction(kwargs.get("using")):
+            self.claim_serial_number(kwargs.get("using"))
             self.updated_at = datetime.datetime.now()
-        super(Property, self).save(*args, **kwargs)
+            super(Property, self).save(*args, **kwargs)
 
 
 class PropertyI18N(models.Model):
@@ -702,7 +1080,7 @@ class PropertyI18N(models.Model):
         unique_together = (("base", "culture"),)
 
 
-class OtherName(models.Model, I18NMixin):
+class OtherName(models.Model, I18NMixin, SerialNumberMixin):
     """Other Name class"""
     object_id = models.ForeignKey(Object, related_name="other_names", db_column="object_id")
     type = models.ForeignKey(Term, null=True, related_name="+")
@@ -718,9 +1096,11 @@ class OtherName(models.Model, I18NMixin):
         if not self.id:
             self.created_at = datetime.datetime.now()
             self.updated_at = datetime.datetime.now()
-        else:
+            return super(OtherName, self).save(*args, **kwargs)
+        with self.serial_transaction(kwargs.get("using")):
+            self.claim_serial_number(kwargs.get("using"))
             self.updated_at = datetime.datetime.now()
-        super(OtherName, self).save(*args, **kwargs)
+            super(OtherName, self).save(*args, **kwargs)
 
 
 class OtherNameI18N(models.Model):
@@ -734,8 +1114,10 @@ class OtherNameI18N(models.Model):
         db_table = "other_name_i18n"
 
 
-class ContactInformation(models.Model, I18NMixin):
+class ContactInformation(models.Model, I18NMixin, SerialNumberMixin):
     """Contact object."""
+    i18n_name_field = "city"
+
     actor = models.ForeignKey(Actor, related_name="contacts")
     primary_contact = models.NullBooleanField(null=True)
     contact_person = models.CharField(max_length=255, null=True, blank=True)
@@ -760,9 +1142,11 @@ class ContactInformation(models.Model, I18NMixin):
         if not self.id:
             self.created_at = datetime.datetime.now()
             self.updated_at = datetime.datetime.now()
-        else:
+            return super(ContactInformation, self).save(*args, **kwargs)
+        with self.serial_transaction(kwargs.get("using")):
+            self.claim_serial_number(kwargs.get("using"))
             self.updated_at = datetime.datetime.now()
-        super(ContactInformation, self).save(*args, **kwargs)
+            super(ContactInformation, self).save(*args, **kwargs)
 
 
 class ContactInformationI18N(models.Model):
@@ -779,8 +1163,10 @@ class ContactInformationI18N(models.Model):
         unique_together = (("base", "culture"),)
 
 
-class Note(models.Model, I18NMixin):
+class Note(models.Model, I18NMixin, SerialNumberMixin):
     """Note class"""
+    i18n_name_field = "content"
+
     # FIXME: in Qubit 1.1 QubitNote has nested set behaviour, which was
     # removed in Qubit 1.2-dev.  We're going to ignore this for now
     # which avoids making the Note class a NestedObject.  We do need
@@ -805,9 +1191,11 @@ class Note(models.Model, I18NMixin):
         if not self.id:
             self.created_at = datetime.datetime.now()
             self.updated_at = datetime.datetime.now()
-        else:
+            return super(Note, self).save(*args, **kwargs)
+        with self.serial_transaction(kwargs.get("using")):
+            self.claim_serial_number(kwargs.get("using"))
             self.updated_at = datetime.datetime.now()
-        super(Note, self).save(*args, **kwargs)
+            super(Note, self).save(*args, **kwargs)
 
 
     def __unicode__(self):
@@ -825,7 +1213,7 @@ class NoteI18N(models.Model):
         unique_together = (("base", "culture"),)
 
 
-class Slug(models.Model):
+class Slug(models.Model, SerialNumberMixin):
     """Slug class."""
     object_id = models.OneToOneField(Object, related_name="slug", db_column="object_id")
     slug = models.CharField(max_length=255, unique=True)
@@ -834,7 +1222,194 @@ class Slug(models.Model):
     class Meta:
         db_table = "slug"
 
+    def save(self, *args, **kwargs):
+        if not self.id:
+            return super(Slug, self).save(*args, **kwargs)
+        with self.serial_transaction(kwargs.get("using")):
+            self.claim_serial_number(kwargs.get("using"))
+            super(Slug, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return self.slug
 
 
+class Status(models.Model):
+    """Status class, e.g. the publication status of an object."""
+    object_id = models.ForeignKey(Object, related_name="statuses", db_column="object_id")
+    type = models.ForeignKey(Term, null=True, related_name="+",
+            limit_choices_to=dict(taxonomy=Taxonomy.STATUS_TYPE_ID))
+    status = models.ForeignKey(Term, null=True, related_name="+")
+    serial_number = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = "status"
+
+    def __unicode__(self):
+        return "Status: %s" % self.status_id
+
+
+class ChangeLog(models.Model):
+    """Append-only record of inserts, updates and deletes of Object
+    subclasses and their i18n rows (those with a culture), written in
+    the same transaction as the change.  See djqubit.changelog."""
+    INSERT = "insert"
+    UPDATE = "update"
+    DELETE = "delete"
+
+    object_id = models.IntegerField(db_index=True)
+    class_name = models.CharField(max_length=255)
+    culture = models.CharField(max_length=25, null=True, blank=True)
+    action = models.CharField(max_length=10)
+    created_at = models.DateTimeField()
+
+    class Meta:
+        db_table = "djqubit_change_log"
+
+
+class CloneMap(models.Model):
+    """Scratch id map used by djqubit.clone while copying a subtree;
+    rows only live for the duration of one copy."""
+    batch = models.CharField(max_length=32)
+    kind = models.CharField(max_length=64)
+    old_id = models.IntegerField()
+    new_id = models.IntegerField()
+    ordinal = models.IntegerField()
+    new_ref = models.IntegerField(null=True)
+
+    class Meta:
+        db_table = "djqubit_clone_map"
+        unique_together = ("batch", "kind", "old_id")
+
+
+def log_changes(using, changes):
+    """Append (object_id, class_name, culture, action) rows to the
+    change log on the given database."""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    now = datetime.datetime.now()
+    cursor = connection.cursor()
+    cursor.executemany("INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s, %%s)" % (
+            qn(ChangeLog._meta.db_table), ", ".join(qn(c) for c in
+                ("object_id", "class_name", "culture", "action", "created_at"))),
+            [change + (now,) for change in changes])
+
+
+def log_tree_changes(rows):
+    """Log an update of each of the tree rows about to have their lft
+    or rgt shifted by update(), which sends no signals.  The rows are
+    logged with one INSERT ... SELECT, without reading them."""
+    connection = connections[rows.db]
+    qn = connection.ops.quote_name
+    select, params = rows.order_by().values_list("pk", "class_name")\
+            .query.get_compiler(rows.db).as_sql()
+    connection.cursor().execute("INSERT INTO %s (%s) SELECT shifted.*, NULL, %%s, %%s "
+            "FROM (%s) shifted" % (qn(ChangeLog._meta.db_table), ", ".join(qn(c) for c in
+                ("object_id", "class_name", "culture", "action", "created_at")), select),
+            (ChangeLog.UPDATE, datetime.datetime.now()) + tuple(params))
+
+
+def log_object_save(sender, instance, created, raw, using, **kwargs):
+    if raw or not issubclass(sender, Object):
+        return
+    log_changes(using, [(instance.pk, instance.class_name, None,
+            ChangeLog.INSERT if created else ChangeLog.UPDATE)])
+
+
+def log_object_delete(sender, instance, using, **kwargs):
+    # Deleting any Object subclass also deletes its `object` row, so
+    # logging that alone records each deletion exactly once.
+    if sender is not Object:
+        return
+    log_changes(using, [(instance.pk, instance.class_name, None, ChangeLog.DELETE)])
+
+
+models.signals.post_save.connect(log_object_save, dispatch_uid="djqubit_log_save")
+models.signals.post_delete.connect(log_object_delete, dispatch_uid="djqubit_log_delete")
+
+
+def allocate_ids(model, count, using=None):
+    """Reserve `count` consecutive primary keys for explicit inserts
+    into `model`'s table and return the first.  Call this inside the
+    transaction that does the inserts; on MySQL the table's last index
+    entry stays locked until it commits."""
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    query = "SELECT MAX(%s) FROM %s" % (qn(model._meta.pk.column), qn(model._meta.db_table))
+    if connection.vendor == "mysql":
+        query += " FOR UPDATE"
+    cursor = connection.cursor()
+    cursor.execute(query)
+    return (cursor.fetchone()[0] or 0) + 1
+
+
+def bulk_insert(model, rows, using=None, chunk_size=PREFETCH_BATCH_SIZE):
+    """Insert `rows`, dicts keyed by field attname, into the model's
+    own table with executemany.  Missing values take the field default
+    (or now, for created_at/updated_at); an auto primary key absent
+    from the rows is left to the database."""
+    if not rows:
+        return
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields if not
+            (isinstance(f, models.AutoField) and f.attname not in rows[0])]
+    query = "INSERT INTO %s (%s) VALUES (%s)" % (qn(model._meta.db_table),
+            ", ".join(qn(f.column) for f in fields), ", ".join(["%s"] * len(fields)))
+    now = datetime.datetime.now()
+    params = []
+    for row in rows:
+        values = []
+        for f in fields:
+            if f.attname in row:
+                value = row[f.attname]
+            elif f.name in ("created_at", "updated_at"):
+                value = now
+            else:
+                value = f.get_default()
+            values.append(f.get_db_prep_save(value, connection=connection))
+        params.append(values)
+    cursor = connection.cursor()
+    for i in range(0, len(params), chunk_size):
+        cursor.executemany(query, params[i:i + chunk_size])
+
+
+def inheritance_chain(model):
+    """The concrete models whose tables make up `model`, from Object
+    down to `model` itself."""
+    chain = [model]
+    while chain[0]._meta.parents:
+        chain.insert(0, chain[0]._meta.parents.keys()[0])
+    return chain
+
+
+def class_models():
+    """Map Qubit class names, as stored in Object.class_name, to the
+    djqubit models."""
+    app = models.get_app(Object._meta.app_label)
+    return dict(("Qubit%s" % m.__name__, m) for m in models.get_models(app)
+            if issubclass(m, Object))
+
+
+def insert_objects(model, rows, using=None):
+    """Insert new instances of an Object subclass, given as dicts keyed
+    by attname plus "pk", into each table of its inheritance chain with
+    one batched statement per table, and log the inserts.  No signals
+    are sent and nested set values are taken as given."""
+    if not rows:
+        return
+    using = using or router.db_for_write(model)
+    classname = "Qubit%s" % model.__name__
+    for table in inheritance_chain(model):
+        pkname = table._meta.pk.attname
+        tablerows = []
+        for row in rows:
+            tablerow = dict(row)
+            tablerow[pkname] = row["pk"]
+            tablerows.append(tablerow)
+        if table is Object:
+            for tablerow in tablerows:
+                tablerow.setdefault("class_name", classname)
+        bulk_insert(table, tablerows, using)
+    log_changes(using, [(row["pk"], classname, None, ChangeLog.INSERT) for row in rows])
@@ -0,0 +1,247 @@
+"""
+Full rebuilds of nested-set (lft/rgt) values from parent ids.
+
+The intervals are computed from `(id, parent_id, sort key)` columns
+loaded in one pass, either with NumPy (level-at-a-time vectorised
+subtree sizes and sibling prefix sums) or, when NumPy is not
+installed, with an iterative pure-Python walk.  Only rows whose
+values actually change are written back, in chunks, and logged to
+the change log as updates.
+"""
+
+import time
+from array import array
+
+from django.db import connections, router, transaction
+
+from djqubit import models
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMPY = "numpy"
+PYTHON = "python"
+
+# Rows per executemany() when writing back, and per fetchmany() when
+# loading.
+CHUNK_SIZE = 5000
+
+
+class NestedSetError(Exception):
+    pass
+
+
+def default_engine():
+    return NUMPY if numpy is not None else PYTHON
+
+
+def compute_intervals_numpy(ids, parents, keys):
+    """Compute (lft, rgt) arrays for the forest described by `ids` and
+    `parents`, ordering siblings by `keys`.  A parent id which is not
+    among `ids` (e.g. 0 or NULL) makes the node a root."""
+    ids = numpy.asarray(ids, dtype=numpy.int64)
+    parents = numpy.asarray(parents, dtype=numpy.int64)
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+    count = len(ids)
+    if not count:
+        return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64)
+
+    # parent row index of each row, -1 for roots
+    byid = numpy.argsort(ids)
+    found = numpy.searchsorted(ids[byid], parents)
+    found[found >= count] = 0
+    pidx = numpy.where(ids[byid][found] == parents, byid[found], -1)
+
+    # depth by pointer doubling: each round every row jumps to its
+    # ancestor's ancestor, so this takes log2(depth) rounds
+    depth = (pidx >= 0).astype(numpy.int64)
+    ancestor = pidx.copy()
+    rounds = 0
+    while True:
+        live = numpy.flatnonzero(ancestor >= 0)
+        if not len(live):
+            break
+        rounds += 1
+        if 2 ** (rounds - 1) > count:
+            raise NestedSetError("Cycle detected in parent ids")
+        jump = ancestor[live]
+        depth[live] += depth[jump]
+        ancestor[live] = ancestor[jump]
+    maxdepth = int(depth.max())
+    bydepth = numpy.argsort(depth, kind="mergesort")
+    bounds = numpy.cumsum(numpy.bincount(depth, minlength=maxdepth + 1))
+    levels = numpy.split(bydepth, bounds[:-1])
+
+    # subtree sizes, deepest level first
+    size = numpy.ones(count, numpy.int64)
+    for d in range(maxdepth, 0, -1):
+        rows = levels[d]
+        numpy.add.at(size, pidx[rows], size[rows])
+    width = size * 2
+
+    # offset of each row within its parent: the widths of the siblings
+    # which sort before it, via an exclusive prefix sum per sibling group
+    order = numpy.lexsort((ids, keys, pidx))
+    sortedwidth = width[order]
+    before = numpy.cumsum(sortedwidth) - sortedwidth
+    sortedparents = pidx[order]
+    starts = numpy.ones(count, bool)
+    starts[1:] = sortedparents[1:] != sortedparents[:-1]
+    groupstart = numpy.maximum.accumulate(
+            numpy.where(starts, numpy.arange(count), 0))
+    offset = numpy.empty(count, numpy.int64)
+    offset[order] = before - before[groupstart]
+
+    # lft of each level from the level above
+    lft = numpy.empty(count, numpy.int64)
+    lft[levels[0]] = offset[levels[0]] + 1
+    for d in range(1, maxdepth + 1):
+        rows = levels[d]
+        lft[rows] = lft[pidx[rows]] + 1 + offset[rows]
+    return lft, lft + width - 1
+
+
+def compute_intervals_python(ids, parents, keys):
+    """Pure-Python equivalent of compute_intervals_numpy(), returning
+    lists."""
+    index = dict((id, i) for i, id in enumerate(ids))
+    children = [[] for i in range(len(ids))]
+    roots = []
+    for i, parent in enumerate(parents):
+        if parent in index:
+            children[index[parent]].append(i)
+        else:
+            roots.append(i)
+    sortkey = lambda i: (keys[i], ids[i])
+    roots.sort(key=sortkey)
+    for kids in children:
+        kids.sort(key=sortkey)
+
+    lft = [0] * len(ids)
+    rgt = [0] * len(ids)
+    counter = 1
+    seen = 0
+    stack = [(i, False) for i in reversed(roots)]
+    while stack:
+        i, done = stack.pop()
+        if done:
+            rgt[i] = counter
+            counter += 1
+            continue
+        lft[i] = counter
+        counter += 1
+        seen += 1
+        stack.append((i, True))
+        stack.extend((c, False) for c in reversed(children[i]))
+    if seen != len(ids):
+        raise NestedSetError("Cycle detected in parent ids")
+    return lft, rgt
+
+
+def compute_intervals(ids, parents, keys, engine=None):
+    if engine is None:
+        engine = default_engine()
+    if engine == NUMPY:
+        if numpy is None:
+            raise NestedSetError("NumPy is not installed")
+        return compute_intervals_numpy(ids, parents, keys)
+    return compute_intervals_python(ids, parents, keys)
+
+
+def load_tree(model, using=None):
+    """Load the (id, parent_id, lft, rgt) columns of a model's table
+    as four arrays."""
+    using = using or router.db_for_read(model)
+    qn = connections[using].ops.quote_name
+    cursor = connections[using].cursor()
+    cursor.execute("SELECT %s, %s, %s, %s FROM %s" % (
+            qn("id"), qn("parent_id"), qn("lft"), qn("rgt"),
+            qn(model._meta.db_table)))
+    columns = [array("l") for i in range(4)]
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        for id, parent, lft, rgt in rows:
+            columns[0].append(id)
+            columns[1].append(parent or 0)
+            columns[2].append(lft or 0)
+            columns[3].append(rgt or 0)
+    return columns
+
+
+def rebuild(model, engine=None, using=None, chunk_size=CHUNK_SIZE):
+    """Recompute lft/rgt for every row of a NestedObject model's table
+    from parent ids, keeping the existing sibling order where there is
+    one.  Returns the number of rows updated."""
+    using = using or router.db_for_write(model)
+    ids, parents, oldlft, oldrgt = load_tree(model, using)
+    lft, rgt = compute_intervals(ids, parents, oldlft, engine)
+
+    if numpy is not None and engine != PYTHON:
+        changed = numpy.flatnonzero((numpy.asarray(oldlft) != lft)
+                | (numpy.asarray(oldrgt) != rgt))
+        lft, rgt = lft.tolist(), rgt.tolist()
+    else:
+        changed = [i for i in range(len(ids))
+                if oldlft[i] != lft[i] or oldrgt[i] != rgt[i]]
+
+    qn = connections[using].ops.quote_name
+    query = "UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s" % (
+            qn(model._meta.db_table), qn("lft"), qn("rgt"), qn("id"))
+    rows = model._base_manager.using(using)
+    with transaction.commit_on_success(using=using):
+        cursor = connections[using].cursor()
+        for start in range(0, len(changed), chunk_size):
+            chunk = [ids[i] for i in changed[start:start + chunk_size]]
+            for i in range(0, len(chunk), models.PREFETCH_BATCH_SIZE):
+                models.log_tree_changes(rows.filter(
+                        pk__in=chunk[i:i + models.PREFETCH_BATCH_SIZE]))
+            cursor.executemany(query, [(lft[i], rgt[i], ids[i])
+                    for i in changed[start:start + chunk_size]])
+    return len(changed)
+
+
+def compute_intervals_rowwise(model, using=None):
+    """Reference row-by-row computation, walking the tree with one
+    children query per node.  Only used for benchmarking."""
+    using = using or router.db_for_read(model)
+    qs = model.objects.using(using)
+    result = {}
+    counter = [1]
+
+    def visit(id):
+        lft = counter[0]
+        counter[0] += 1
+        for child in qs.filter(parent=id).order_by("lft", "pk")\
+                .values_list("pk", flat=True):
+            visit(child)
+        result[id] = (lft, counter[0])
+        counter[0] += 1
+
+    for root in qs.filter(parent__isnull=True).order_by("lft", "pk")\
+            .values_list("pk", flat=True):
+        visit(root)
+    return result
+
+
+def benchmark(model, using=None):
+    """Time each engine's computation (without writing) against the
+    row-by-row walk.  Returns a list of (name, seconds) pairs."""
+    timings = []
+    start = time.time()
+    ids, parents, oldlft, oldrgt = load_tree(model, using)
+    timings.append(("load", time.time() - start))
+    engines = [PYTHON]
+    if numpy is not None:
+        engines.insert(0, NUMPY)
+    for engine in engines:
+        start = time.time()
+        compute_intervals(ids, parents, oldlft, engine)
+        timings.append((engine, time.time() - start))
+    start = time.time()
+    compute_intervals_rowwise(model, using)
+    timings.append(("rowwise", time.time() - start))
+    return timings
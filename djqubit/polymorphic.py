@@ -0,0 +1,73 @@
+"""
+Batch loading of generic Object rows as their concrete classes.
+
+Relations, notes, properties and slugs point at plain Object rows, so
+following them gives base instances.  downcast() groups objects by the
+Qubit class name stored on each row and loads every concrete model
+with one query per class (and batch of ids), joining its parent
+tables, instead of one query per object:
+
+    targets = downcast(r.object_id_id for r in relations)
+"""
+
+from collections import defaultdict
+
+from djqubit import models
+
+
+def downcast(objects, i18n=False, cultures=None, using=None):
+    """Return the concrete instances for a sequence of Object ids or
+    instances, in the given order.  Rows whose class has no djqubit
+    model stay plain Objects and ids with no row are dropped.  With
+    `i18n` (or `cultures`) the i18n rows are prefetched as well, see
+    prefetch_i18n."""
+    ids, found, bases = [], {}, {}
+    for obj in objects:
+        if not isinstance(obj, models.Object):
+            ids.append(obj)
+            continue
+        ids.append(obj.pk)
+        # Instances already of a concrete class need no loading.
+        if obj.__class__ is models.Object:
+            bases[obj.pk] = obj
+        else:
+            found[obj.pk] = obj
+    classnames = dict((pk, obj.class_name) for pk, obj in bases.iteritems())
+
+    # Class names for bare ids, from the object table.
+    unknown = [pk for pk in set(ids) if pk not in found and pk not in classnames]
+    for batch in batches(unknown):
+        qs = models.Object._base_manager.filter(pk__in=batch)
+        if using is not None:
+            qs = qs.using(using)
+        for obj in qs:
+            classnames[obj.pk] = obj.class_name
+            bases[obj.pk] = obj
+
+    classes = models.class_models()
+    byclass = defaultdict(list)
+    for pk, classname in classnames.iteritems():
+        model = classes.get(classname)
+        if model is None:
+            found[pk] = bases[pk]
+        else:
+            byclass[model].append(pk)
+    for model, pks in byclass.iteritems():
+        for batch in batches(pks):
+            qs = model._default_manager.filter(pk__in=batch)
+            if using is not None:
+                qs = qs.using(using)
+            for obj in qs:
+                found[obj.pk] = obj
+
+    result = [found[pk] for pk in ids if pk in found]
+    if i18n or cultures is not None:
+        models.prefetch_i18n([obj for obj in result
+                if isinstance(obj, models.I18NMixin)], cultures)
+    return result
+
+
+def batches(items, size=models.PREFETCH_BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
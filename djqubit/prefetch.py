@@ -0,0 +1,117 @@
+"""
+Prefetching of the satellite rows of a list of objects.
+
+Showing a page of descriptions reads each object's notes, properties,
+other names, slug, contacts and events, each a query per object, plus
+a query per row for its i18n.  prefetch_qubit() reads every satellite
+table, and its i18n table, once for the whole list:
+
+    objs = prefetch_qubit(InformationObject.objects.filter(parent=fonds),
+            include=["notes", "events", "slug"], cultures=["en", "fr"])
+    for obj in objs:
+        for note in obj.notes.all():    # no query
+            note.get_i18n("fr", "content")    # no query
+
+The rows are cached per instance and served by the usual related
+names: `obj.notes.all()` returns a queryset whose results are already
+filled in (anything that filters it goes to the database as before),
+and `obj.slug` uses the descriptor's own instance cache.
+"""
+
+from collections import defaultdict
+
+from django.db.models.fields.related import ForeignRelatedObjectsDescriptor
+
+from djqubit import models
+
+# Satellite relations prefetched when `include` is not given, where
+# the model has them.
+SATELLITES = ("notes", "properties", "other_names", "slug", "contacts", "events")
+
+CACHE_ATTR = "_prefetched_satellites"
+
+
+class PrefetchedObjectsDescriptor(object):
+    """Wraps a reverse foreign key descriptor, serving prefetched rows
+    from the instance when there are any."""
+    def __init__(self, descriptor, name):
+        self.descriptor = descriptor
+        self.name = name
+
+    def __get__(self, instance, instance_type=None):
+        manager = self.descriptor.__get__(instance, instance_type)
+        if instance is None:
+            return manager
+        rows = instance.__dict__.get(CACHE_ATTR, {}).get(self.name)
+        if rows is not None:
+            queryset = manager.get_query_set()
+            queryset._result_cache = list(rows)
+            manager.get_query_set = lambda: queryset._clone(_result_cache=queryset._result_cache)
+        return manager
+
+    def __set__(self, instance, value):
+        instance.__dict__.get(CACHE_ATTR, {}).pop(self.name, None)
+        self.descriptor.__set__(instance, value)
+
+
+def related_object(model, name):
+    """The reverse relation of `model` with accessor `name`."""
+    for related in model._meta.get_all_related_objects():
+        if related.get_accessor_name() == name:
+            return related
+    raise ValueError("%s has no related objects called %s" % (model.__name__, name))
+
+
+def install(related):
+    """Make sure the reverse descriptor for `related` can serve
+    prefetched rows."""
+    name = related.get_accessor_name()
+    model = related.parent_model
+    descriptor = model.__dict__.get(name)
+    if isinstance(descriptor, ForeignRelatedObjectsDescriptor):
+        setattr(model, name, PrefetchedObjectsDescriptor(descriptor, name))
+
+
+def prefetch_qubit(objects, include=None, cultures=None, using=None):
+    """Evaluate `objects` (a queryset or list of one model's instances)
+    and prefetch the named reverse relations for all of them with one
+    query per table and batch of ids, plus their i18n rows (and the
+    objects' own) in `cultures`.  Returns the list of objects."""
+    objects = list(objects)
+    if not objects:
+        return objects
+    model = objects[0].__class__
+    if include is None:
+        names = set(r.get_accessor_name() for r in model._meta.get_all_related_objects())
+        include = [name for name in SATELLITES if name in names]
+    pks = [obj.pk for obj in objects]
+    for name in include:
+        related = related_object(model, name)
+        field = related.field
+        single = field.rel.multiple is False
+        if not single:
+            install(related)
+        grouped = defaultdict(list)
+        for i in range(0, len(pks), models.PREFETCH_BATCH_SIZE):
+            qs = related.model._base_manager.filter(
+                    **{"%s__in" % field.name: pks[i:i + models.PREFETCH_BATCH_SIZE]})
+            if using is not None:
+                qs = qs.using(using)
+            for row in qs.order_by("pk"):
+                grouped[getattr(row, field.attname)].append(row)
+        rows = []
+        for obj in objects:
+            found = grouped.get(obj.pk, [])
+            for row in found:
+                setattr(row, field.get_cache_name(), obj)
+            rows.extend(found)
+            if single:
+                if found:
+                    setattr(obj, related.get_cache_name(), found[0])
+            else:
+                obj.__dict__.setdefault(CACHE_ATTR, {})[name] = found
+        if issubclass(related.model, models.I18NMixin) and rows:
+            models.prefetch_i18n(rows, cultures)
+    if issubclass(model, models.I18NMixin):
+        models.prefetch_i18n(objects, cultures)
+    return objects
@@ -0,0 +1,145 @@
+"""
+Read-only projections of objects for bulk jobs.
+
+A Repository instance is built from three tables and carries every
+column of each; an exporter reading a million of them mostly wants a
+handful.  project() instead yields small namedtuple rows for a declared
+set of fields, which may come from any table of the inheritance chain
+and from the i18n tables in a chosen culture:
+
+    for row in project(Repository.objects.filter(parent=3),
+            ["identifier", "class_name", "updated_at"],
+            i18n=["authorized_form_of_name", "holdings"], culture="de"):
+        write(row.identifier, row.authorized_form_of_name)
+
+The queryset's filters select the ids; one query joins them to the
+tables needed and is read from a server-side cursor on MySQL (SQLite
+steps through results anyway), so memory stays flat however many rows
+there are.  Values are as the database returns them, and rows come in
+no particular order.
+
+On MySQL the server-side cursor runs on a connection of its own, so
+the ORM can be used while the rows are read, but rows written by the
+caller's uncommitted transaction are not seen.
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.db import connections
+from django.db.utils import load_backend
+
+from djqubit import models
+
+# Rows fetched from the cursor at a time.
+CHUNK_SIZE = 1000
+
+_row_classes = {}
+
+
+def row_class(model, names):
+    """A namedtuple class for rows of `model` with the given fields."""
+    key = (model, tuple(names))
+    if key not in _row_classes:
+        _row_classes[key] = namedtuple("%sRow" % model.__name__, names)
+    return _row_classes[key]
+
+
+@contextmanager
+def stream_cursor(connection):
+    """A cursor that leaves results on the server until fetched, where
+    the backend needs asking.  On MySQL such a cursor blocks every other
+    query on its connection until its results are read, so it gets a
+    connection of its own, closed with the cursor."""
+    if connection.vendor != "mysql":
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+        return
+    from MySQLdb.cursors import SSCursor
+    backend = load_backend(connection.settings_dict["ENGINE"])
+    streaming = backend.DatabaseWrapper(dict(connection.settings_dict), connection.alias)
+    try:
+        streaming.cursor()
+        cursor = streaming.connection.cursor(SSCursor)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+    finally:
+        streaming.close()
+
+
+def projection_sql(queryset, fields, i18n=(), culture=models.FALLBACK_CULTURE):
+    """Return (sql, params) selecting `fields` and `i18n` fields for
+    the objects in `queryset`.  i18n values missing in `culture` fall
+    back to FALLBACK_CULTURE."""
+    model = queryset.model
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    pkcolumn = qn(model._meta.pk.column)
+    inner, params = queryset.order_by().values_list("pk").query\
+            .get_compiler(queryset.db).as_sql()
+
+    aliases = {}
+    joins = []
+    def alias(table):
+        if table not in aliases:
+            aliases[table] = "t%d" % len(aliases)
+            joins.append("JOIN %s %s ON %s.%s = q.%s" % (qn(table._meta.db_table),
+                    aliases[table], aliases[table], qn(table._meta.pk.column), pkcolumn))
+        return aliases[table]
+
+    columns = []
+    for name in fields:
+        field = model._meta.get_field(name)
+        columns.append("%s.%s" % (alias(field.model), qn(field.column)))
+
+    i18nfields = {}
+    for table in models.inheritance_chain(model):
+        for i18nmodel in models.i18n_tables(table):
+            for field in i18nmodel._meta.local_fields:
+                if field.name != "base":
+                    i18nfields.setdefault(field.name, (i18nmodel, field))
+    joinparams = []
+    i18naliases = {}
+    for name in i18n:
+        if name not in i18nfields:
+            raise ValueError("%s has no i18n field %s" % (model.__name__, name))
+        i18nmodel, field = i18nfields[name]
+        if i18nmodel not in i18naliases:
+            cultures = [culture]
+            if culture != models.FALLBACK_CULTURE:
+                cultures.append(models.FALLBACK_CULTURE)
+            i18naliases[i18nmodel] = []
+            for value in cultures:
+                join = "c%d" % len(joinparams)
+                joins.append("LEFT JOIN %s %s ON %s.%s = q.%s AND %s.%s = %%s" % (
+                        qn(i18nmodel._meta.db_table), join, join, qn("id"), pkcolumn,
+                        join, qn("culture")))
+                joinparams.append(value)
+                i18naliases[i18nmodel].append(join)
+        values = ["%s.%s" % (a, qn(field.column)) for a in i18naliases[i18nmodel]]
+        columns.append(values[0] if len(values) == 1 else "COALESCE(%s)" % ", ".join(values))
+
+    sql = "SELECT %s FROM (%s) q %s" % (", ".join(columns), inner, " ".join(joins))
+    return sql, tuple(params) + tuple(joinparams)
+
+
+def project(queryset, fields, i18n=(), culture=models.FALLBACK_CULTURE,
+        chunk_size=CHUNK_SIZE):
+    """Yield a namedtuple per object in `queryset` holding the named
+    model and i18n fields.  See projection_sql()."""
+    fields, i18n = list(fields), list(i18n)
+    Row = row_class(queryset.model, fields + i18n)
+    sql, params = projection_sql(queryset, fields, i18n, culture)
+    with stream_cursor(connections[queryset.db]) as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield Row._make(row)
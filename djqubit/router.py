@@ -2,21 +2,32 @@
 Database router class.
 """
 
+from djqubit import tenants
+
+
+def djqubit_alias(**hints):
+    """The alias for djqubit models: an instance's own database, then
+    the current tenant's, then 'djqubit'."""
+    instance = hints.get("instance")
+    if instance is not None and instance._state.db is not None:
+        return instance._state.db
+    return tenants.current_alias() or 'djqubit'
+
 
 class DjqubitRouter(object):
     """A router to control all database operations on models in
     the djqubit application"""
 
     def db_for_read(self, model, **hints):
-        "Point all operations on djqubit models to 'djqubit'"
+        "Point all operations on djqubit models to 'djqubit' or the tenant's db"
         if model._meta.app_label == 'djqubit':
-            return 'djqubit'
+            return djqubit_alias(**hints)
         return None
 
     def db_for_write(self, model, **hints):
-        "Point all operations on djqubit models to 'djqubit'"
+        "Point all operations on djqubit models to 'djqubit' or the tenant's db"
         if model._meta.app_label == 'djqubit':
-            return 'djqubit'
+            return djqubit_alias(**hints)
         return None
 
     def allow_relation(self, obj1, obj2, **hints):
@@ -26,8 +37,8 @@ class DjqubitRouter(object):
         return None
 
     def allow_syncdb(self, db, model):
-        "Make sure the djqubit app only appears on the 'djqubit' db"
-        if db == 'djqubit':
+        "Make sure the djqubit app only appears on the 'djqubit' and tenant dbs"
+        if db == 'djqubit' or tenants.is_tenant_alias(db):
             return model._meta.app_label == 'djqubit'
         elif model._meta.app_label == 'djqubit':
             return False
@@ -0,0 +1,333 @@
+"""
+Staged imports of repository records.
+
+Rather than writing each incoming row straight into the live Qubit
+database, rows are first loaded into a table on a separate staging
+database (by default a local SQLite file) where validation, duplicate
+detection and slug allocation run as set-based SQL.  Only the clean
+result is then merged into the live schema, with one batched statement
+per table inside a single short transaction:
+
+    staged = StagedImport("/tmp/import.sqlite")
+    staged.load(rows)
+    staged.validate()
+    staged.deduplicate()
+    staged.allocate()
+    staged.merge(lang="en", user=user, status=status, detail=detail)
+
+Rows that match an existing repository (see djqubit.matching) update
+it in place instead of creating a new one.
+"""
+
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import F
+from django.template.defaultfilters import slugify
+
+from djqubit import models
+from djqubit.matching import RepositoryIndex
+
+STAGING_ALIAS = "djqubit_staging"
+
+TABLE = "staged_repository"
+
+# Raw columns loaded from the import source.
+COLUMNS = (
+    "line", "identifier", "name", "english_name", "origin", "comments",
+    "extra", "country_code", "city", "region", "street_address",
+    "contact_person", "email", "website", "fax", "telephone",
+)
+
+
+def staging_alias(path=None):
+    """Return the alias of a staging database.  Without a `path` this is
+    STAGING_ALIAS, registered as the SQLite database at
+    settings.DJQUBIT_STAGING_DATABASE if it is not one of the configured
+    DATABASES; each other SQLite file gets an alias of its own."""
+    alias = STAGING_ALIAS
+    if path is not None and connections.databases.get(alias, {}).get("NAME") != path:
+        alias = "%s_%s" % (STAGING_ALIAS, hashlib.md5(path).hexdigest()[:12])
+    if alias not in connections.databases:
+        connections.databases[alias] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": path or getattr(settings, "DJQUBIT_STAGING_DATABASE", ":memory:"),
+        }
+    return alias
+
+
+class StagedImport(object):
+    """One import run's staging table and the steps to process it."""
+    def __init__(self, path=None, using=None):
+        self.alias = staging_alias(path)
+        self.using = using or router.db_for_write(models.Repository)
+        self.connection = connections[self.alias]
+        self.create()
+
+    def execute(self, query, params=None):
+        cursor = self.connection.cursor()
+        cursor.execute(query, params or [])
+        return cursor
+
+    def create(self):
+        with transaction.commit_on_success(using=self.alias):
+            self.execute("DROP TABLE IF EXISTS %s" % TABLE)
+            self.execute("DROP TABLE IF EXISTS live_slug")
+            self.execute("DROP TABLE IF EXISTS live_identifier")
+            self.execute("CREATE TABLE %s (%s, %s)" % (TABLE,
+                    "line INTEGER PRIMARY KEY, " + ", ".join("%s TEXT" % c for c in COLUMNS[1:]),
+                    "name_key TEXT, slug TEXT, error TEXT, duplicate_of INTEGER, match_id INTEGER, "
+                    "object_id INTEGER"))
+            self.execute("CREATE INDEX %s_name_key ON %s (name_key, country_code)" % (TABLE, TABLE))
+            self.execute("CREATE TABLE live_slug (slug TEXT PRIMARY KEY)")
+            self.execute("CREATE TABLE live_identifier (identifier TEXT PRIMARY KEY)")
+
+    def load(self, rows):
+        """Load raw rows (dicts keyed by COLUMNS) into the staging table."""
+        query = "INSERT INTO %s (%s) VALUES (%s)" % (TABLE, ", ".join(COLUMNS),
+                ", ".join(["%s"] * len(COLUMNS)))
+        with transaction.commit_on_success(using=self.alias):
+            self.connection.cursor().executemany(query,
+                    [[row.get(c) for c in COLUMNS] for row in rows])
+
+    def validate(self):
+        """Tidy values and flag rows that cannot be imported."""
+        with transaction.commit_on_success(using=self.alias):
+            for column in COLUMNS[1:]:
+                self.execute("UPDATE %s SET %s = NULLIF(TRIM(%s), '')" % (TABLE, column, column))
+            self.execute("UPDATE %s SET name = SUBSTR(name, 1, 255), "
+                    "english_name = SUBSTR(english_name, 1, 255)" % TABLE)
+            self.execute("UPDATE %s SET error = 'missing name' WHERE name IS NULL" % TABLE)
+            self.execute("UPDATE %s SET email = NULL WHERE email NOT LIKE '%%_@_%%'" % TABLE)
+
+    def deduplicate(self, index=None):
+        """Mark rows repeating an earlier row's name and country, match
+        the rest against existing repositories using `index` (by default
+        a RepositoryIndex of the live database), and flag unmatched rows
+        whose identifier is already in use."""
+        with transaction.commit_on_success(using=self.alias):
+            self.execute("UPDATE %s SET name_key = LOWER(name)" % TABLE)
+            self.execute("""UPDATE %(t)s SET duplicate_of = (
+                    SELECT MIN(s.line) FROM %(t)s s WHERE s.name_key = %(t)s.name_key
+                    AND COALESCE(s.country_code, '') = COALESCE(%(t)s.country_code, '')
+                    AND s.error IS NULL)
+                WHERE error IS NULL""" % dict(t=TABLE))
+            self.execute("UPDATE %s SET duplicate_of = NULL WHERE duplicate_of = line" % TABLE)
+
+            if index is None:
+                index = RepositoryIndex.build(self.using)
+            matches = []
+            for line, name, english, country, city, email, website in self.execute("""
+                    SELECT line, name, english_name, country_code, city, email, website
+                    FROM %s WHERE error IS NULL AND duplicate_of IS NULL""" % TABLE).fetchall():
+                match = index.match(name, country, city, email, website,
+                        other_names=[english] if english else [])
+                if match is not None:
+                    matches.append((match, line))
+            self.connection.cursor().executemany(
+                    "UPDATE %s SET match_id = %%s WHERE line = %%s" % TABLE, matches)
+
+            live = models.Repository.objects.using(self.using)\
+                    .filter(identifier__isnull=False).values_list("identifier")
+            self.connection.cursor().executemany(
+                    "INSERT OR IGNORE INTO live_identifier VALUES (%s)", live.iterator())
+            self.execute("""UPDATE %s SET error = 'identifier exists' WHERE error IS NULL
+                AND match_id IS NULL
+                AND identifier IN (SELECT identifier FROM live_identifier)""" % TABLE)
+
+    def allocate(self):
+        """Allocate a slug, unique against the live database and the
+        rest of the import, to each row that will be merged."""
+        pending = self.execute("SELECT line, name FROM %s WHERE error IS NULL "
+                "AND duplicate_of IS NULL AND match_id IS NULL ORDER BY line" % TABLE).fetchall()
+        bases = [(line, slugify(name)[:235] or "untitled") for line, name in pending]
+        with transaction.commit_on_success(using=self.alias):
+            self.execute("DELETE FROM live_slug")
+            self.execute("CREATE TEMPORARY TABLE slug_base (base TEXT PRIMARY KEY)")
+            cursor = self.connection.cursor()
+            cursor.executemany("INSERT OR IGNORE INTO slug_base VALUES (%s)",
+                    [(base,) for line, base in bases])
+            # Copy the live slugs across and pick out those that could
+            # clash with one of ours in a single join.
+            live = models.Slug.objects.using(self.using).values_list("slug")
+            cursor.executemany("INSERT OR IGNORE INTO live_slug VALUES (%s)", live.iterator())
+            taken = set(r[0] for r in self.execute("""SELECT l.slug FROM live_slug l
+                    JOIN slug_base b ON l.slug = b.base OR l.slug LIKE b.base || '-%%'"""))
+            self.execute("DROP TABLE slug_base")
+
+            slugs = []
+            for line, base in bases:
+                slug, suffix = base, 0
+                while slug in taken:
+                    suffix += 1
+                    slug = "%s-%d" % (base, suffix)
+                taken.add(slug)
+                slugs.append((slug, line))
+            cursor.executemany("UPDATE %s SET slug = %%s WHERE line = %%s" % TABLE, slugs)
+
+    def rejected(self):
+        """(line, reason) for each row that will not be merged."""
+        return self.execute("""SELECT line, COALESCE(error, 'duplicate of line ' || duplicate_of)
+                FROM %s WHERE error IS NOT NULL OR duplicate_of IS NOT NULL
+                ORDER BY line""" % TABLE).fetchall()
+
+    def matched(self):
+        """(line, repository id) for each row matching a repository."""
+        return self.execute("SELECT line, match_id FROM %s WHERE error IS NULL "
+                "AND duplicate_of IS NULL AND match_id IS NOT NULL ORDER BY line" % TABLE).fetchall()
+
+    def merge(self, lang, user=None, status=None, detail=None, properties=None):
+        """Merge the staged rows into the live database, in one
+        transaction.  Matched rows update their repository's name and
+        primary contact; the rest become new repositories under the
+        actor root, with their names, slug, notes, other names, contact
+        information and `properties` ({name: value}).  Returns the
+        number of rows merged."""
+        fields = COLUMNS + ("slug", "match_id")
+        rows = [dict(zip(fields, r)) for r in self.execute(
+                "SELECT %s FROM %s WHERE error IS NULL AND duplicate_of IS NULL "
+                "AND object_id IS NULL ORDER BY line" % (", ".join(fields), TABLE))]
+        if not rows:
+            return 0
+        with transaction.commit_on_success(using=self.using):
+            self.update([r for r in rows if r["match_id"] is not None], lang)
+            self.insert([r for r in rows if r["match_id"] is None], lang,
+                    user, status, detail, properties)
+        with transaction.commit_on_success(using=self.alias):
+            self.connection.cursor().executemany(
+                    "UPDATE %s SET object_id = %%s WHERE line = %%s" % TABLE,
+                    [(row["pk"], row["line"]) for row in rows])
+        return len(rows)
+
+    def update(self, rows, lang):
+        """Update matched repositories in place."""
+        if not rows:
+            return
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        now = datetime.datetime.now()
+        for row in rows:
+            row["pk"] = row["match_id"]
+        models.write_i18n(models.Actor, [(row["pk"], lang,
+                dict(authorized_form_of_name=row["name"])) for row in rows], self.using)
+
+        # Only overwrite contact details the new row actually has, and
+        # give repositories without a primary contact one.
+        contacts = models.ContactInformation._base_manager.using(self.using)
+        existing = set()
+        for i in range(0, len(rows), models.PREFETCH_BATCH_SIZE):
+            existing.update(contacts.filter(primary_contact=True, actor__in=[row["pk"]
+                    for row in rows[i:i + models.PREFETCH_BATCH_SIZE]])
+                    .values_list("actor", flat=True))
+        columns = ("contact_person", "country_code", "email", "website",
+                "street_address", "fax", "telephone")
+        cursor = connection.cursor()
+        cursor.executemany("UPDATE %s SET %s, %s = %%s, %s = %s + 1 "
+                "WHERE %s = %%s AND %s = %%s" % (
+                qn(models.ContactInformation._meta.db_table),
+                ", ".join("%s = COALESCE(%%s, %s)" % (qn(c), qn(c)) for c in columns),
+                qn("updated_at"), qn("serial_number"), qn("serial_number"),
+                qn("actor_id"), qn("primary_contact")),
+                [[row[c] for c in columns] + [now, row["pk"], True]
+                    for row in rows if row["pk"] in existing])
+        self.insert_contacts([row for row in rows if row["pk"] not in existing], lang)
+        cursor.executemany("UPDATE %s SET %s = %%s, %s = %s + 1 WHERE %s = %%s" % (
+                qn(models.Object._meta.db_table), qn("updated_at"),
+                qn("serial_number"), qn("serial_number"), qn("id")),
+                [(now, row["pk"]) for row in rows])
+        models.log_changes(self.using, [(row["pk"], "QubitRepository", None,
+                models.ChangeLog.UPDATE) for row in rows])
+
+    def insert(self, rows, lang, user=None, status=None, detail=None, properties=None):
+        """Create new repositories for unmatched rows."""
+        if not rows:
+            return
+        properties = properties or {}
+        now = datetime.datetime.now()
+        status = status.pk if status else None
+        detail = detail.pk if detail else None
+        userid = user.pk if user else None
+
+        # Make room for the new repositories at the end of the root
+        # actor's children.
+        root = models.Actor.objects.using(self.using).get(pk=models.Actor.ROOT_ID)
+        width = 2 * len(rows)
+        actors = models.Actor.objects.using(self.using)
+        models.log_tree_changes(actors.filter(rgt__gte=root.rgt))
+        actors.filter(lft__gt=root.rgt).update(lft=F("lft") + width)
+        actors.filter(rgt__gte=root.rgt).update(rgt=F("rgt") + width)
+
+        first = models.allocate_ids(models.Object, len(rows), self.using)
+        repos, actori18n, repoi18n, slugs, contacts = [], [], [], [], []
+        notes, othernames = [], []
+        for offset, row in enumerate(rows):
+            pk = row["pk"] = first + offset
+            lft = root.rgt + 2 * offset
+            repos.append(dict(pk=pk, created_at=now, updated_at=now,
+                    parent_id=root.pk, lft=lft, rgt=lft + 1,
+                    entity_type_id=models.Term.CORPORATE_BODY_ID,
+                    description_status_id=status, description_detail_id=detail,
+                    desc_status_id=status, desc_detail_id=detail,
+                    identifier=row["identifier"], source_culture=lang,
+                    repository_source_culture=lang))
+            actori18n.append((pk, lang, dict(authorized_form_of_name=row["name"])))
+            if row["origin"]:
+                repoi18n.append(dict(base_id=pk, culture=lang, desc_sources=row["origin"]))
+            slugs.append(dict(object_id_id=pk, slug=row["slug"]))
+            for text in (row["comments"], row["extra"]):
+                if text:
+                    notes.append((pk, text))
+            if row["english_name"]:
+                othernames.append((pk, row["english_name"]))
+            contacts.append(row)
+        models.insert_objects(models.Repository, repos, self.using)
+        models.write_i18n(models.Actor, actori18n, self.using)
+        models.bulk_insert(models.RepositoryI18N, repoi18n, self.using)
+        models.bulk_insert(models.Slug, slugs, self.using)
+
+        noteid = models.allocate_ids(models.Note, len(notes), self.using)
+        models.bulk_insert(models.Note, [dict(id=noteid + i, object_id_id=pk,
+                type_id=models.Term.MAINTENANCE_NOTE_ID, user_id=userid,
+                scope="QubitRepository", source_culture=lang)
+                for i, (pk, text) in enumerate(notes)], self.using)
+        models.bulk_insert(models.NoteI18N, [dict(base_id=noteid + i, culture=lang,
+                content=text) for i, (pk, text) in enumerate(notes)], self.using)
+
+        nameid = models.allocate_ids(models.OtherName, len(othernames), self.using)
+        models.bulk_insert(models.OtherName, [dict(id=nameid + i, object_id_id=pk,
+                type_id=models.Term.OTHER_FORM_OF_NAME_ID, source_culture=lang)
+                for i, (pk, name) in enumerate(othernames)], self.using)
+        models.bulk_insert(models.OtherNameI18N, [dict(base_id=nameid + i, culture=lang,
+                name=name) for i, (pk, name) in enumerate(othernames)], self.using)
+
+        self.insert_contacts(contacts, lang)
+
+        names = sorted(properties)
+        propid = models.allocate_ids(models.Property, len(names) * len(rows), self.using)
+        props, propi18n = [], []
+        for row in rows:
+            for name in names:
+                props.append(dict(id=propid, object_id_id=row["pk"], name=name,
+                        source_culture=lang))
+                propi18n.append(dict(base_id=propid, culture=lang, value=properties[name]))
+                propid += 1
+        models.bulk_insert(models.Property, props, self.using)
+        models.bulk_insert(models.PropertyI18N, propi18n, self.using)
+
+    def insert_contacts(self, rows, lang):
+        """Create the primary contact of each row's repository."""
+        if not rows:
+            return
+        contactid = models.allocate_ids(models.ContactInformation, len(rows), self.using)
+        models.bulk_insert(models.ContactInformation, [dict(id=contactid + i,
+                actor_id=row["pk"], primary_contact=True,
+                contact_person=row["contact_person"], country_code=row["country_code"],
+                email=row["email"], website=row["website"],
+                street_address=row["street_address"], fax=row["fax"],
+                telephone=row["telephone"], source_culture=lang)
+                for i, row in enumerate(rows)], self.using)
+        models.bulk_insert(models.ContactInformationI18N, [dict(base_id=contactid + i,
+                culture=lang, contact_type="Main", city=row["city"],
+                region=row["region"]) for i, row in enumerate(rows)], self.using)
@@ -0,0 +1,77 @@
+"""
+Set-based status changes over nested-set subtrees.
+
+Publishing a fonds means setting a status on every description in it.
+Saving each node costs a load, a parent check and a save per row;
+set_status_for_subtree() instead works on the lft/rgt range with a
+handful of statements in one transaction, whatever the subtree size.
+"""
+
+import datetime
+
+from django.db import connections, router, transaction
+
+from djqubit import models
+
+
+def set_status_for_subtree(node, status_type, status, using=None):
+    """Give `node` and all its descendants `status` (a Term or id) for
+    `status_type`, e.g. Term.STATUS_TYPE_PUBLICATION_ID and
+    Term.PUBLICATION_STATUS_PUBLISHED_ID.  Nodes whose status changes
+    get their updated_at bumped and a change log entry.  Returns the
+    number of nodes changed."""
+    model = node.__class__
+    using = using or router.db_for_write(model)
+    status_type = getattr(status_type, "pk", status_type)
+    status = getattr(status, "pk", status)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    now = datetime.datetime.now()
+    params = dict(
+        table=qn(model._meta.db_table),
+        status=qn(models.Status._meta.db_table),
+        object=qn(models.Object._meta.db_table),
+        changelog=qn(models.ChangeLog._meta.db_table),
+        id=qn("id"), lft=qn("lft"), rgt=qn("rgt"),
+        object_id=qn("object_id"), type_id=qn("type_id"), status_id=qn("status_id"),
+        serial_number=qn("serial_number"), updated_at=qn("updated_at"),
+        logcolumns=", ".join(qn(c) for c in
+                ("object_id", "class_name", "culture", "action", "created_at")),
+    )
+    # Nodes in range whose status row is missing or different.
+    changed = ("SELECT t.%(id)s FROM %(table)s t LEFT JOIN %(status)s s "
+            "ON s.%(object_id)s = t.%(id)s AND s.%(type_id)s = %%s "
+            "WHERE t.%(lft)s >= %%s AND t.%(rgt)s <= %%s "
+            "AND (s.%(status_id)s IS NULL OR s.%(status_id)s <> %%s)") % params
+    inrange = ("SELECT %(id)s FROM %(table)s "
+            "WHERE %(lft)s >= %%s AND %(rgt)s <= %%s") % params
+
+    with transaction.commit_on_success(using=using):
+        # Re-read the bounds inside the transaction.
+        lft, rgt = model.objects.using(using).filter(pk=node.pk)\
+                .values_list("lft", "rgt").get()
+        selected = [status_type, lft, rgt, status]
+        cursor = connection.cursor()
+        cursor.execute(("INSERT INTO %(changelog)s (%(logcolumns)s) "
+                "SELECT o.%(id)s, o.class_name, NULL, %%s, %%s FROM %(object)s o "
+                "WHERE o.%(id)s IN (") % params + changed + ")",
+                [models.ChangeLog.UPDATE, now] + selected)
+        count = cursor.rowcount
+        if not count:
+            return 0
+        cursor.execute(("UPDATE %(object)s SET %(updated_at)s = %%s, "
+                "%(serial_number)s = %(serial_number)s + 1 "
+                "WHERE %(id)s IN (") % params + changed + ")", [now] + selected)
+        cursor.execute(("UPDATE %(status)s SET %(status_id)s = %%s, "
+                "%(serial_number)s = %(serial_number)s + 1 "
+                "WHERE %(type_id)s = %%s AND %(status_id)s <> %%s "
+                "AND %(object_id)s IN (") % params + inrange + ")",
+                [status, status_type, status, lft, rgt])
+        cursor.execute(("INSERT INTO %(status)s (%(object_id)s, %(type_id)s, "
+                "%(status_id)s, %(serial_number)s) "
+                "SELECT t.%(id)s, %%s, %%s, 0 FROM %(table)s t "
+                "WHERE t.%(lft)s >= %%s AND t.%(rgt)s <= %%s AND NOT EXISTS ("
+                "SELECT 1 FROM %(status)s s WHERE s.%(object_id)s = t.%(id)s "
+                "AND s.%(type_id)s = %%s)") % params,
+                [status_type, status, lft, rgt, status_type])
+    return count
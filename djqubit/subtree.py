@@ -0,0 +1,346 @@
+"""
+Dumping nested-set subtrees to a file and loading them into another
+Qubit database.
+
+dump_subtree() writes a node and its descendants with every row that
+hangs off them: the object and inheritance table rows, i18n rows,
+events and digital objects of information objects, relations to or
+from any dumped object, and the notes, properties, other names, slugs,
+statuses and contacts of all of these.  load_subtree() adds the lot
+under a new parent:
+
+    dump_subtree(fonds, "fonds.qst")
+    load_subtree("fonds.qst", other_repository_root, using="staging")
+
+The file is gzipped JSON lines: a header, then per table a line naming
+its columns followed by blocks of up to BLOCK_SIZE rows stored column
+by column, then a trailer with the row count.  Column order is that of
+the model, so loading into a database with a different schema fails
+rather than guessing.
+
+Loading reserves each id range once (object ids, note ids, ...), moves
+lft/rgt by a single offset, maps every id and reference through
+in-memory maps as the blocks stream past and inserts each block with
+one executemany.  References to rows outside the dump (terms, actors,
+users, ...) are kept if the target database has them; otherwise they
+are cleared where the column allows NULL and the load fails where it
+does not.  Slugs already taken get the new object id appended, and
+information objects get fresh OAI identifiers.
+"""
+
+import gzip
+import json
+from collections import defaultdict
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router, transaction
+from django.db.models import F, Max, Min, get_app, get_models
+
+from djqubit import models
+
+FORMAT = "djqubit-subtree"
+VERSION = 1
+
+# Rows per column block.
+BLOCK_SIZE = 5000
+
+# Tables of rows owned by dumped objects, with the field pointing at
+# the owner.
+OWNED = (
+    (models.Note, "object_id"),
+    (models.Property, "object_id"),
+    (models.OtherName, "object_id"),
+    (models.Slug, "object_id"),
+    (models.Status, "object_id"),
+    (models.ContactInformation, "actor"),
+)
+
+
+def id_space(model):
+    """The model whose table allocates `model`'s primary keys."""
+    return models.inheritance_chain(model)[0]
+
+
+def tree_table(model):
+    """The table of `model`'s inheritance chain holding lft/rgt."""
+    for table in models.inheritance_chain(model):
+        if "lft" in [f.name for f in table._meta.local_fields]:
+            return table
+    raise ValueError("%s is not a tree model" % model.__name__)
+
+
+def batches(items, size=models.PREFETCH_BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def select_ids(model, field, values, using):
+    """Primary keys of the `model` rows whose `field` is in `values`."""
+    ids = []
+    for batch in batches(values):
+        ids.extend(model._base_manager.using(using)
+                .filter(**{"%s__in" % field: batch}).values_list("pk", flat=True))
+    return ids
+
+
+class SubtreeDump(object):
+    """The tables and primary keys making up one subtree."""
+    def __init__(self, root, using=None):
+        self.root = root
+        self.using = using or router.db_for_read(root.__class__)
+        self.tree = tree_table(root.__class__)
+        self.sections = []
+        self.counts = {}
+        self.collect()
+
+    def collect(self):
+        using, root = self.using, self.root
+        nodes = list(self.tree._base_manager.using(using)
+                .filter(lft__gte=root.lft, rgt__lte=root.rgt)
+                .order_by("lft").values_list("pk", flat=True))
+        objects = set(nodes)
+        self.digital_lft = None
+        if issubclass(self.tree, models.InformationObject):
+            objects.update(select_ids(models.Event, "information_object", nodes, using))
+            digital = select_ids(models.DigitalObject, "information_object", nodes, using)
+            digital += select_ids(models.DigitalObject, "parent", digital, using)
+            objects.update(digital)
+            if digital:
+                self.digital_lft = min(models.DigitalObject._base_manager.using(using)
+                        .filter(pk__in=batch).aggregate(Min("lft"))["lft__min"]
+                        for batch in batches(digital))
+        objects.update(select_ids(models.Relation, "subject_id", objects, using))
+        objects.update(select_ids(models.Relation, "object_id", objects, using))
+        self.objects = sorted(objects)
+
+        # The tables of each class present, base tables first.
+        classes = models.class_models()
+        tables = defaultdict(set)
+        for batch in batches(self.objects):
+            for pk, classname in models.Object._base_manager.using(using)\
+                    .filter(pk__in=batch).values_list("pk", "class_name"):
+                model = classes.get(classname, models.Object)
+                for table in models.inheritance_chain(model):
+                    tables[table].add(pk)
+        for table in sorted(tables, key=lambda t: len(models.inheritance_chain(t))):
+            self.add(table, tables[table])
+        self.counts[models.Object._meta.db_table] = len(self.objects)
+
+        for model, field in OWNED:
+            ids = select_ids(model, field, self.objects, using)
+            if ids:
+                self.add(model, ids)
+                self.counts[model._meta.db_table] = len(ids)
+
+    def add(self, model, ids):
+        self.sections.append((model, sorted(ids)))
+        for i18n in models.i18n_tables(model):
+            self.sections.append((i18n, sorted(ids)))
+
+    def header(self):
+        return dict(format=FORMAT, version=VERSION,
+                model=self.root.__class__.__name__, tree=self.tree._meta.db_table,
+                root=self.root.pk, lft=self.root.lft, rgt=self.root.rgt,
+                digital_lft=self.digital_lft, counts=self.counts)
+
+    def rows(self, model, ids):
+        """Yield blocks of the model's rows, in primary key order."""
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        columns = ", ".join(qn(f.column) for f in model._meta.local_fields)
+        pk = qn(model._meta.pk.column)
+        cursor = connection.cursor()
+        block = []
+        for batch in batches(ids):
+            cursor.execute("SELECT %s FROM %s WHERE %s IN (%s) ORDER BY %s" % (
+                    columns, qn(model._meta.db_table), pk,
+                    ", ".join(["%s"] * len(batch)), pk), batch)
+            block.extend(cursor.fetchall())
+            if len(block) >= BLOCK_SIZE:
+                yield block
+                block = []
+        if block:
+            yield block
+
+    def write(self, handle):
+        """Write the dump as JSON lines to an open file."""
+        encoder = DjangoJSONEncoder(separators=(",", ":"))
+        handle.write(encoder.encode(self.header()) + "\n")
+        total = 0
+        for model, ids in self.sections:
+            handle.write(encoder.encode(dict(table=model._meta.db_table,
+                    columns=[f.column for f in model._meta.local_fields])) + "\n")
+            for block in self.rows(model, ids):
+                handle.write(encoder.encode(dict(data=zip(*block))) + "\n")
+                total += len(block)
+        handle.write(encoder.encode(dict(end=True, rows=total)) + "\n")
+        return total
+
+
+def dump_subtree(root, path, using=None):
+    """Write `root` and everything below it to a gzipped file at
+    `path`, returning the number of rows written."""
+    dump = SubtreeDump(root, using)
+    handle = gzip.open(path, "wb")
+    try:
+        return dump.write(handle)
+    finally:
+        handle.close()
+
+
+class SubtreeLoad(object):
+    """Id maps and reference checks for loading one dump."""
+    def __init__(self, header, new_parent, using):
+        self.header = header
+        self.new_parent = new_parent
+        self.using = using
+        self.connection = connections[using]
+        self.qn = self.connection.ops.quote_name
+        self.cursor = self.connection.cursor()
+        self.tables = dict((m._meta.db_table, m) for m in
+                get_models(get_app(models.Object._meta.app_label)))
+        self.maps = defaultdict(dict)
+        self.next = {}
+        self.existing = defaultdict(set)
+
+    def allocate(self):
+        """Reserve the ids of each id space."""
+        for table, count in self.header["counts"].iteritems():
+            model = self.tables[table]
+            self.next[model] = models.allocate_ids(model, count, self.using)
+
+    def new_id(self, model, old):
+        space = id_space(model)
+        new = self.maps[space][old] = self.next[space]
+        self.next[space] += 1
+        return new
+
+    def resolve(self, field, values, internal=False):
+        """Map the values of a foreign key column; references outside
+        the dump are kept if they exist here, else nulled or refused.
+        `internal` references, into the table being loaded, are nulled
+        when not yet mapped rather than pointed at an unrelated row."""
+        target = field.rel.to
+        space = self.maps[id_space(target)]
+        unknown = set(v for v in values if v is not None and v not in space
+                and v not in self.existing[target]) if not internal else ()
+        if unknown:
+            self.existing[target].update(target._base_manager.using(self.using)
+                    .filter(pk__in=list(unknown)).values_list("pk", flat=True))
+        result = []
+        for value in values:
+            if value is None:
+                result.append(None)
+            elif value in space:
+                result.append(space[value])
+            elif value in self.existing[target]:
+                result.append(value)
+            elif field.null:
+                result.append(None)
+            else:
+                raise ValueError("%s.%s refers to %s %s, which is neither in the "
+                        "dump nor in the database" % (field.model._meta.db_table,
+                            field.column, target._meta.db_table, value))
+        return result
+
+    def load_block(self, model, columns, data):
+        fields = dict((f.column, f) for f in model._meta.local_fields)
+        data = dict(zip(columns, data))
+        count = len(data[columns[0]])
+        pk = model._meta.pk
+        old = data[pk.column]
+        if pk.rel is None:
+            data[pk.column] = [self.new_id(model, value) for value in old]
+        for column in columns:
+            field = fields[column]
+            if field.rel is not None:
+                data[column] = self.resolve(field, data[column],
+                        pk.rel is None and id_space(field.rel.to) is id_space(model))
+
+        table = model._meta.db_table
+        if table == self.header["tree"]:
+            offset = self.offset
+            data["lft"] = [v + offset for v in data["lft"]]
+            data["rgt"] = [v + offset for v in data["rgt"]]
+            data["parent_id"] = [self.new_parent.pk if o == self.header["root"] else p
+                    for o, p in zip(old, data["parent_id"])]
+        elif model is models.DigitalObject:
+            data["lft"] = [v + self.digital_offset for v in data["lft"]]
+            data["rgt"] = [v + self.digital_offset for v in data["rgt"]]
+        if model is models.InformationObject:
+            data["oai_local_identifier"] = range(self.next_oai, self.next_oai + count)
+            self.next_oai += count
+        if model is models.Slug:
+            data["slug"] = self.free_slugs(data["slug"], data["object_id"])
+        if model is models.Object:
+            models.log_changes(self.using, [(new, classname, None, models.ChangeLog.INSERT)
+                    for new, classname in zip(data["id"], data["class_name"])])
+
+        self.cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+                self.qn(table), ", ".join(self.qn(c) for c in columns),
+                ", ".join(["%s"] * len(columns))), zip(*[data[c] for c in columns]))
+        return count
+
+    def free_slugs(self, slugs, owners):
+        taken = set(models.Slug._base_manager.using(self.using)
+                .filter(slug__in=slugs).values_list("slug", flat=True))
+        return [u"%s-%s" % (slug, owner) if slug in taken else slug
+                for slug, owner in zip(slugs, owners)]
+
+
+def load_subtree(path, new_parent, using=None):
+    """Add the subtree dumped at `path` as the last child of
+    `new_parent`, which must be in the same kind of tree, and return
+    the new root."""
+    handle = gzip.open(path, "rb")
+    try:
+        header = json.loads(handle.readline())
+        if header.get("format") != FORMAT or header.get("version") != VERSION:
+            raise ValueError("%s is not a version %d subtree dump" % (path, VERSION))
+        model = new_parent.__class__
+        tree = tree_table(model)
+        if tree._meta.db_table != header["tree"]:
+            raise ValueError("Cannot load a %s subtree under a %s" % (
+                    header["tree"], tree._meta.db_table))
+        using = using or router.db_for_write(model)
+        objects = tree._base_manager.using(using)
+        with transaction.commit_on_success(using=using):
+            new_parent = objects.get(pk=new_parent.pk)
+            width = header["rgt"] - header["lft"] + 1
+            models.log_tree_changes(objects.filter(rgt__gte=new_parent.rgt))
+            objects.filter(lft__gt=new_parent.rgt).update(lft=F("lft") + width)
+            objects.filter(rgt__gte=new_parent.rgt).update(rgt=F("rgt") + width)
+
+            state = SubtreeLoad(header, new_parent, using)
+            state.offset = new_parent.rgt - header["lft"]
+            state.digital_offset = 0
+            if header["digital_lft"] is not None:
+                state.digital_offset = (models.DigitalObject._base_manager.using(using)
+                        .aggregate(Max("rgt"))["rgt__max"] or 0) + 1 - header["digital_lft"]
+            state.next_oai = (models.InformationObject._base_manager.using(using)
+                    .aggregate(Max("oai_local_identifier"))["oai_local_identifier__max"] or 0) + 1
+            state.allocate()
+
+            table, columns, total = None, None, 0
+            for line in handle:
+                record = json.loads(line)
+                if "data" in record:
+                    total += state.load_block(table, columns, record["data"])
+                elif "table" in record:
+                    table = state.tables[record["table"]]
+                    columns = record["columns"]
+                    if columns != [f.column for f in table._meta.local_fields]:
+                        raise ValueError("The columns of %s do not match this schema"
+                                % record["table"])
+                elif record.get("end"):
+                    if record["rows"] != total:
+                        raise ValueError("Expected %d rows, read %d" % (record["rows"], total))
+                    break
+            else:
+                raise ValueError("%s is truncated" % path)
+            root = state.maps[models.Object][header["root"]]
+    finally:
+        handle.close()
+    root_model = models.class_models().get("Qubit%s" % header["model"], tree)
+    return root_model._base_manager.using(using).get(pk=root)
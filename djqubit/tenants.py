@@ -0,0 +1,174 @@
+"""
+Routing djqubit models to one of several tenants' Qubit databases.
+
+Tenants are configured by name, each with an ordinary database entry:
+
+    DJQUBIT_TENANTS = {
+        "kcl": {"ENGINE": "django.db.backends.mysql", "NAME": "qubit_kcl", ...},
+        "niod": {"ENGINE": "django.db.backends.mysql", "NAME": "qubit_niod", ...},
+    }
+
+Inside a `with tenant("kcl"):` block (or after set_tenant("kcl")) the
+DjqubitRouter sends djqubit queries to that tenant's alias, which is
+registered the first time it is used.  The current tenant is kept per
+thread.  Django keeps connections per thread as well, and a thread can
+only close its own, so the cap is per thread: each thread closes its
+least recently used tenant connection once it has more than
+DJQUBIT_TENANT_CONNECTIONS open.  A process with N threads can hold N
+times that many.
+
+run_for_tenants() runs a job for many tenants from one worker pool:
+
+    run_for_tenants(lambda name: normalize_event_dates(), workers=4)
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.conf import settings
+from django.db import connections
+
+ALIAS_PREFIX = "djqubit_tenant_"
+
+# Default cap on open tenant connections per thread.
+MAX_CONNECTIONS = 8
+
+TENANT_OPTION = make_option(
+    "--tenant",
+    action="store",
+    dest="tenant",
+    default=None,
+    help="Name of the tenant (see DJQUBIT_TENANTS) whose database to use")
+
+_local = threading.local()
+
+
+class UnknownTenantError(KeyError):
+    pass
+
+
+def tenants():
+    """Names of the configured tenants."""
+    return sorted(getattr(settings, "DJQUBIT_TENANTS", {}))
+
+
+def tenant_alias(name):
+    """Return the database alias for a tenant, registering it with the
+    connection handler if this is its first use."""
+    alias = ALIAS_PREFIX + name
+    if alias not in connections.databases:
+        config = getattr(settings, "DJQUBIT_TENANTS", {})
+        if name not in config:
+            raise UnknownTenantError(name)
+        connections.databases[alias] = dict(config[name])
+    return alias
+
+
+def is_tenant_alias(alias):
+    return alias.startswith(ALIAS_PREFIX)
+
+
+def current_tenant():
+    """The current thread's tenant, or None."""
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def current_alias():
+    """The current thread's tenant database alias, or None."""
+    name = current_tenant()
+    return tenant_alias(name) if name is not None else None
+
+
+def _used(alias):
+    """Mark `alias` as most recently used by this thread and close the
+    oldest tenant connections beyond the cap, other than those of
+    enclosing tenant blocks."""
+    used = getattr(_local, "used", None)
+    if used is None:
+        used = _local.used = OrderedDict()
+    used.pop(alias, None)
+    used[alias] = True
+    cap = getattr(settings, "DJQUBIT_TENANT_CONNECTIONS", MAX_CONNECTIONS)
+    active = set(tenant_alias(name) for name in _local.stack)
+    for old in list(used):
+        if len(used) <= cap:
+            break
+        if old not in active:
+            del used[old]
+            connections[old].close()
+
+
+def set_tenant(name):
+    """Make `name` (or None) the current thread's only tenant, e.g. at
+    the start of a request or job."""
+    _local.stack = []
+    if name is not None:
+        alias = tenant_alias(name)
+        _local.stack.append(name)
+        _used(alias)
+
+
+@contextmanager
+def tenant(name):
+    """Route djqubit models to tenant `name` inside the block.  A name
+    of None leaves routing as it is."""
+    if name is None:
+        yield None
+        return
+    alias = tenant_alias(name)
+    if getattr(_local, "stack", None) is None:
+        _local.stack = []
+    _local.stack.append(name)
+    try:
+        _used(alias)
+        yield alias
+    finally:
+        _local.stack.pop()
+
+
+def run_for_tenants(func, names=None, workers=4):
+    """Call func(name) inside each tenant's block, spread over a pool
+    of `workers` threads, and return {name: result}.  Each job closes
+    its tenant's connection when it finishes, so the pool holds at
+    most `workers` tenant connections.  Exceptions are re-raised once
+    all tenants have run."""
+    names = tenants() if names is None else list(names)
+    def job(name):
+        alias = tenant_alias(name)
+        try:
+            with tenant(name):
+                return func(name)
+        finally:
+            _local.used.pop(alias, None)
+            connections[alias].close()
+    pool = ThreadPool(workers)
+    try:
+        pending = [(name, pool.apply_async(job, (name,))) for name in names]
+        results = {}
+        failure = None
+        for name, result in pending:
+            try:
+                results[name] = result.get()
+            except Exception, err:
+                failure = failure or err
+        if failure is not None:
+            raise failure
+        return results
+    finally:
+        pool.close()
+        pool.join()
+
+
+def tenant_command(handle):
+    """Decorator running a management command's handle() for the tenant
+    given by its --tenant option (see TENANT_OPTION)."""
+    def wrapper(self, *args, **options):
+        with tenant(options.get("tenant")):
+            return handle(self, *args, **options)
+    wrapper.__name__ = handle.__name__
+    wrapper.__doc__ = handle.__doc__
+    return wrapper
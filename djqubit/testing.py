@@ -0,0 +1,189 @@
+"""
+Test cases starting from a prebuilt SQLite snapshot of their data.
+
+A TestCase with `fixtures` runs the fixture loader, one deserialised
+object at a time, before every test method.  SnapshotTestCase instead
+builds its data once into a SQLite file next to the test database's
+schema and, before each test, refills the test database's tables from
+that file with one INSERT ... SELECT per table:
+
+    class MyTest(SnapshotTestCase):
+        snapshot_fixtures = ["test_fixtures.json"]
+        snapshot_builders = [add_many_synthetic_fonds]
+
+Builders are called with the database alias after the fixtures load,
+so large synthetic data sets cost their build time once.  Snapshots
+are kept in DJQUBIT_TEST_SNAPSHOT_DIR (default the temp directory),
+named by a hash of the schema, the fixture files and the builders'
+names, and reused by later runs until one of those changes; bump
+`snapshot_version` when a builder's behaviour changes.
+
+On databases other than SQLite the fixtures are loaded and builders
+run for every test, as before.
+"""
+
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_apps
+from django.test import TestCase, TransactionTestCase
+from django.test.testcases import connections_support_transactions, \
+        restore_transaction_methods
+
+_snapshots = {}
+
+
+def fixture_paths(label):
+    """The fixture files loaddata would consider for a label."""
+    if os.path.isabs(label):
+        return [label]
+    dirs = [os.path.join(os.path.dirname(app.__file__), "fixtures") for app in get_apps()]
+    dirs.extend(settings.FIXTURE_DIRS)
+    dirs.append("")
+    return [os.path.join(d, label) for d in dirs if os.path.isfile(os.path.join(d, label))]
+
+
+class Snapshot(object):
+    """A SQLite file holding the rows of every table of a test
+    database, attached to its connection under `name`."""
+    def __init__(self, key, using):
+        directory = getattr(settings, "DJQUBIT_TEST_SNAPSHOT_DIR", tempfile.gettempdir())
+        self.path = os.path.join(directory, "djqubit-test-%s.sqlite" % key)
+        self.name = "snapshot_%s" % key
+        self.using = using
+
+    @classmethod
+    def key(cls, fixtures, builders, version, using):
+        digest = hashlib.sha1(str(version))
+        cursor = connections[using].cursor()
+        cursor.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL ORDER BY name")
+        for sql, in cursor.fetchall():
+            digest.update(sql.encode("utf8"))
+        for label in fixtures:
+            digest.update(label)
+            for path in fixture_paths(label):
+                with open(path, "rb") as handle:
+                    digest.update(handle.read())
+        for builder in builders:
+            digest.update("%s.%s" % (builder.__module__, builder.__name__))
+        return digest.hexdigest()[:16]
+
+    @classmethod
+    def get(cls, fixtures=(), builders=(), version=0, using=DEFAULT_DB_ALIAS):
+        """The snapshot for some fixtures and builders, building it if
+        no earlier run has."""
+        spec = (tuple(fixtures), tuple(builders), version, using)
+        if spec not in _snapshots:
+            snapshot = cls(cls.key(fixtures, builders, version, using), using)
+            if not os.path.exists(snapshot.path):
+                snapshot.build(fixtures, builders)
+            _snapshots[spec] = snapshot
+        return _snapshots[spec]
+
+    def tables(self, database="main"):
+        cursor = connections[self.using].cursor()
+        cursor.execute("SELECT name FROM %s.sqlite_master WHERE type = 'table' "
+                "AND name NOT LIKE 'sqlite_%%'" % database)
+        return [name for name, in cursor.fetchall()]
+
+    def build(self, fixtures, builders):
+        call_command("flush", verbosity=0, interactive=False, database=self.using)
+        if fixtures:
+            call_command("loaddata", *fixtures, **{"verbosity": 0, "database": self.using})
+        for builder in builders:
+            builder(self.using)
+        transaction.commit_unless_managed(using=self.using)
+
+        qn = connections[self.using].ops.quote_name
+        tmp = "%s.%d" % (self.path, os.getpid())
+        cursor = connections[self.using].cursor()
+        cursor.execute("ATTACH DATABASE %s AS snapshot_build", [tmp])
+        try:
+            for table in self.tables():
+                cursor.execute("CREATE TABLE snapshot_build.%s AS SELECT * FROM main.%s"
+                        % (qn(table), qn(table)))
+            transaction.commit_unless_managed(using=self.using)
+        finally:
+            cursor.execute("DETACH DATABASE snapshot_build")
+        os.rename(tmp, self.path)
+
+    def restore(self):
+        """Replace the contents of every table of the test database
+        with the snapshot's, and commit."""
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA database_list")
+        if self.name not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ATTACH DATABASE %%s AS %s" % self.name, [self.path])
+        saved = set(self.tables(self.name))
+        for table in self.tables():
+            cursor.execute("DELETE FROM main.%s" % qn(table))
+            if table in saved:
+                cursor.execute("INSERT INTO main.%s SELECT * FROM %s.%s" % (
+                        qn(table), self.name, qn(table)))
+        connection._commit()
+
+
+class SnapshotMixin(object):
+    snapshot_fixtures = ()
+    snapshot_builders = ()
+    snapshot_version = 0
+
+    def restore_snapshot(self):
+        """Restore the snapshot into the default database, returning
+        False if it is not SQLite."""
+        if connections[DEFAULT_DB_ALIAS].vendor != "sqlite":
+            return False
+        Snapshot.get(self.snapshot_fixtures, self.snapshot_builders,
+                self.snapshot_version).restore()
+        return True
+
+    def load_data(self, **kwargs):
+        if self.snapshot_fixtures:
+            call_command("loaddata", *self.snapshot_fixtures, **dict(kwargs,
+                    verbosity=0, database=DEFAULT_DB_ALIAS))
+        for builder in self.snapshot_builders:
+            builder(DEFAULT_DB_ALIAS)
+
+    def committed_fixture_setup(self):
+        """Set up for a test running outside a transaction."""
+        if not self.restore_snapshot():
+            TransactionTestCase._fixture_setup(self)
+            self.load_data()
+
+
+class SnapshotTestCase(SnapshotMixin, TestCase):
+    """TestCase starting each test from the snapshot's data and
+    rolling back afterwards."""
+    def _fixture_setup(self):
+        # TestCase flushes instead of using a transaction once any
+        # connection, e.g. one registered by a test, lacks them.
+        self.in_transaction = connections_support_transactions()
+        if not self.in_transaction:
+            return self.committed_fixture_setup()
+        restored = self.restore_snapshot()
+        super(SnapshotTestCase, self)._fixture_setup()
+        if not restored:
+            self.load_data(commit=False)
+
+    def _fixture_teardown(self):
+        # TestCase would leave the transaction open, with commit()
+        # disabled, if the test registered such a connection.
+        if self.in_transaction and not connections_support_transactions():
+            restore_transaction_methods()
+            transaction.rollback(using=DEFAULT_DB_ALIAS)
+            transaction.leave_transaction_management(using=DEFAULT_DB_ALIAS)
+        else:
+            super(SnapshotTestCase, self)._fixture_teardown()
+
+
+class SnapshotTransactionTestCase(SnapshotMixin, TransactionTestCase):
+    """TransactionTestCase starting each test from the snapshot's data,
+    for tests which must commit."""
+    def _fixture_setup(self):
+        self.committed_fixture_setup()
@@ -2,12 +2,13 @@
 DJQubit test suite.
 """
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.db.models import Max
+from djqubit.testing import SnapshotTestCase, SnapshotTransactionTestCase
 import models
 
-class InformationObjectTest(TestCase):
-    fixtures = ["test_fixtures.json"]
+class InformationObjectTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
     def setUp(self):
         pass
 
@@ -87,3 +88,1209 @@ class InformationObjectTest(TestCase):
 
 
 
+class RelationGraphTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_traverse(self):
+        from djqubit.graph import RelationGraph
+        graph = RelationGraph()
+        io = models.InformationObject.objects.get(identifier="Foobar")
+        # one query per level of the walk
+        with self.assertNumQueries(2):
+            distances = graph.traverse([io.pk], depth=2)
+        self.assertEqual(distances[io.pk], 0)
+        self.assertEqual(distances[282], 1)
+        # the index is reused, so the same walk costs nothing
+        with self.assertNumQueries(0):
+            graph.traverse([io.pk], depth=2)
+
+    def test_related_in_subtree(self):
+        from djqubit.graph import RelationGraph
+        graph = RelationGraph()
+        root = models.InformationObject.objects.get(pk=models.InformationObject.ROOT_ID)
+        ids = root.get_descendants(include_self=True).values_list("pk", flat=True)
+        functions = graph.related(ids, models.Function)
+        self.assertEqual([282], [f.pk for f in functions])
+        self.assertEqual([], list(graph.related(ids, models.Actor)))
+
+
+class AdminChangeListTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def changelist_rows(self, model):
+        from djqubit import admin
+        site = admin.admin.site
+        from django.contrib.admin.templatetags.admin_list import results
+        from django.test.client import RequestFactory
+        request = RequestFactory().get("/")
+        ma = site._registry[model]
+        cl = ma.get_changelist(request)(request, model, ma.list_display,
+                ma.list_display_links, ma.list_filter, ma.date_hierarchy,
+                ma.search_fields, ma.list_select_related, ma.list_per_page,
+                ma.list_editable, ma)
+        cl.formset = None
+        return [list(row) for row in results(cl)]
+
+    def test_prefetch_i18n(self):
+        terms = list(models.Term.objects.filter(taxonomy=models.Taxonomy.LEVEL_OF_DESCRIPTION_ID))
+        expected = [t.i18n.all()[0] for t in terms]
+        with self.assertNumQueries(1):
+            models.prefetch_i18n(terms)
+            names = [t.get_i18n(i18n.culture, "name") for t, i18n in zip(terms, expected)]
+        self.assertEqual([i18n.name for i18n in expected], names)
+
+    def test_constant_queries(self):
+        from django.core.cache import cache
+        cache.clear()
+        # count, page, taxonomies, term i18n and taxonomy i18n
+        with self.assertNumQueries(5):
+            rows = self.changelist_rows(models.Term)
+        self.assertEqual(100, len(rows))
+        # the count is now cached
+        with self.assertNumQueries(4):
+            self.changelist_rows(models.Term)
+
+
+class TreeSnapshotTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def test_snapshot(self):
+        root = models.InformationObject.objects.get(pk=models.InformationObject.ROOT_ID)
+        io = models.InformationObject.objects.get(identifier="Foobar")
+        snap = root.snapshot()
+        self.assertEqual(3, len(snap))
+        self.assertEqual([io.pk], snap.children(root.pk))
+        self.assertEqual(None, snap.parent(root.pk))
+        self.assertEqual(io.pk, snap.parent(284))
+        self.assertEqual(2, snap.depth(284))
+        self.assertEqual(io.level_of_description_id, snap.level(io.pk))
+        self.assertEqual(io.get_i18n("en", "title"), snap.title(io.pk))
+        self.assertTrue(snap.is_leaf(284))
+
+    def test_cache_key_has_database(self):
+        from django.core.cache import cache
+        root = models.InformationObject.objects.get(pk=models.InformationObject.ROOT_ID)
+        snap = root.snapshot()
+        self.assertEqual(snap.marker, cache.get(
+                "djqubit.tree.default.information_object.%d.*" % root.pk).marker)
+
+    def test_snapshot_cache_invalidation(self):
+        root = models.InformationObject.objects.get(pk=models.InformationObject.ROOT_ID)
+        root.snapshot()
+        # only the freshness check runs when the snapshot is cached
+        with self.assertNumQueries(1):
+            root.snapshot()
+        models.InformationObject(identifier="SnapTest", parent=root).save()
+        root = models.InformationObject.objects.get(pk=root.pk)
+        self.assertEqual(4, len(root.snapshot()))
+
+
+class NestedSetRebuildTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_engines_agree(self):
+        import random
+        from djqubit import nestedset
+        rand = random.Random(29)
+        ids = range(1, 2001)
+        parents = [0] + [rand.randint(1, i - 1) if i > 1 else 0 for i in ids[1:]]
+        keys = [rand.randint(0, 100) for i in ids]
+        pylft, pyrgt = nestedset.compute_intervals(ids, parents, keys, nestedset.PYTHON)
+        self.assertEqual(max(pyrgt), len(ids) * 2)
+        if nestedset.numpy is not None:
+            nplft, nprgt = nestedset.compute_intervals(ids, parents, keys, nestedset.NUMPY)
+            self.assertEqual(pylft, nplft.tolist())
+            self.assertEqual(pyrgt, nprgt.tolist())
+
+    def test_orphans_and_cycles(self):
+        from djqubit import nestedset
+        engines = [nestedset.PYTHON]
+        if nestedset.numpy is not None:
+            engines.append(nestedset.NUMPY)
+        for engine in engines:
+            # a parent which is not in the table makes a root
+            lft, rgt = nestedset.compute_intervals([1, 2, 3], [0, 99, 1], [0, 0, 0], engine)
+            self.assertEqual(([1, 5, 2], [4, 6, 3]), (list(lft), list(rgt)))
+            for parents in ([2, 1, 0], [1, 0, 0]):
+                self.assertRaises(nestedset.NestedSetError, nestedset.compute_intervals,
+                        [1, 2, 3], parents, [0, 0, 0], engine)
+
+    def test_rebuild(self):
+        expected = list(models.Term.objects.order_by("pk").values_list("pk", "lft", "rgt"))
+        models.Term.objects.update(lft=0, rgt=0)
+        logged = models.ChangeLog.objects.count()
+        # with no sibling order to go on, ids are used
+        models.Term.rebuild_nested_set()
+        self.assertEqual(len(expected), models.ChangeLog.objects.count() - logged)
+        self.assertEqual(set(pk for pk, lft, rgt in expected), set(models.ChangeLog.objects
+                .filter(action=models.ChangeLog.UPDATE).values_list("object_id", flat=True)))
+        rebuilt = dict((pk, (lft, rgt)) for pk, lft, rgt in
+                models.Term.objects.values_list("pk", "lft", "rgt"))
+        for pk, lft, rgt in expected:
+            self.assertEqual(rgt - lft, rebuilt[pk][1] - rebuilt[pk][0])
+        self.assertEqual(0, models.Term.rebuild_nested_set(engine="python"))
+
+
+class I18NBufferTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_buffered_writes_coalesce(self):
+        io = models.InformationObject.objects.get(identifier="Foobar")
+        # one UPDATE plus its change-log entry
+        with self.assertNumQueries(2):
+            with models.buffered_i18n():
+                io.set_i18n("en", dict(title="First"))
+                io.set_i18n("en", dict(edition="Second"))
+                io.set_i18n("en", dict(title="Third", bogus="ignored"))
+        self.assertEqual("Third", io.get_i18n("en", "title"))
+        self.assertEqual("Second", io.get_i18n("en", "edition"))
+
+    def test_buffered_batch(self):
+        terms = list(models.Term.objects.filter(
+                taxonomy=models.Taxonomy.LEVEL_OF_DESCRIPTION_ID))
+        rows = [t.i18n.all()[0] for t in terms]
+        # one existence check, one batched UPDATE and the change log
+        with self.assertNumQueries(3):
+            with models.buffered_i18n():
+                for term, row in zip(terms, rows):
+                    term.set_i18n(row.culture, dict(name=row.name.upper()))
+        for term, row in zip(terms, rows):
+            self.assertEqual(row.name.upper(), term.get_i18n(row.culture, "name"))
+
+    def test_buffer_discarded_on_error(self):
+        io = models.InformationObject.objects.get(identifier="Foobar")
+        title = io.get_i18n("en", "title")
+        try:
+            with models.buffered_i18n():
+                io.set_i18n("en", dict(title="Discarded"))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(title, io.get_i18n("en", "title"))
+
+    def test_loaded_database(self):
+        from django.core.management.color import no_style
+        from django.db import connections
+        alias = "djqubit_i18n_other"
+        connections.databases[alias] = {
+                "ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
+        try:
+            cursor = connections[alias].cursor()
+            for model in (models.InformationObjectI18N, models.ChangeLog):
+                for sql in connections[alias].creation.sql_create_model(model, no_style())[0]:
+                    cursor.execute(sql)
+            io = models.InformationObject.objects.get(identifier="Foobar")
+            title = io.get_i18n("en", "title")
+            io._state.db = alias
+            with models.buffered_i18n():
+                io.set_i18n("en", dict(title="Elsewhere"))
+            self.assertEqual("Elsewhere", io.get_i18n("en", "title"))
+            self.assertEqual(title, models.InformationObject.objects.get(pk=io.pk)
+                    .get_i18n("en", "title"))
+        finally:
+            if alias in connections._connections:
+                connections._connections.pop(alias).close()
+            del connections.databases[alias]
+
+
+class OAIPMHTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+    urls = "djqubit.urls"
+
+    def oai(self, **args):
+        response = self.client.get("/oai/", args)
+        self.assertEqual(200, response.status_code)
+        return "".join(response)
+
+    def test_identify(self):
+        self.assertTrue("<protocolVersion>2.0</protocolVersion>" in self.oai(verb="Identify"))
+
+    def test_errors(self):
+        self.assertTrue('code="badVerb"' in self.oai(verb="Bogus"))
+        self.assertTrue('code="badArgument"' in self.oai(verb="ListRecords"))
+        self.assertTrue('code="cannotDisseminateFormat"' in
+                self.oai(verb="ListRecords", metadataPrefix="marc"))
+        self.assertTrue('code="badResumptionToken"' in
+                self.oai(verb="ListRecords", resumptionToken="nonsense"))
+
+    def test_list_records_resumption(self):
+        from djqubit import views
+        views.PAGE_SIZE, pagesize = 1, views.PAGE_SIZE
+        try:
+            first = self.oai(verb="ListRecords", metadataPrefix="oai_dc")
+            self.assertTrue("<dc:identifier>Foobar</dc:identifier>" in first)
+            token = first.split("<resumptionToken>")[1].split("</resumptionToken>")[0]
+            second = self.oai(verb="ListRecords", resumptionToken=token)
+            self.assertTrue("<dc:identifier>KCL0001</dc:identifier>" in second)
+            self.assertTrue("<resumptionToken/>" in second)
+        finally:
+            views.PAGE_SIZE = pagesize
+
+    def test_resumption_within_one_second(self):
+        import datetime
+        from djqubit import views
+        second = datetime.datetime(2011, 1, 1, 12, 0, 0)
+        models.Object._base_manager.filter(pk=281).update(updated_at=second.replace(microsecond=750000))
+        models.Object._base_manager.filter(pk=284).update(updated_at=second.replace(microsecond=250000))
+        views.PAGE_SIZE, pagesize = 1, views.PAGE_SIZE
+        try:
+            pages = [self.oai(verb="ListIdentifiers", metadataPrefix="oai_dc")]
+            while "<resumptionToken>" in pages[-1] and len(pages) < 5:
+                token = pages[-1].split("<resumptionToken>")[1].split("</resumptionToken>")[0]
+                pages.append(self.oai(verb="ListIdentifiers", resumptionToken=token))
+        finally:
+            views.PAGE_SIZE = pagesize
+        self.assertEqual(2, len(pages))
+        self.assertNotEqual(pages[0].split("<identifier>")[1], pages[1].split("<identifier>")[1])
+        # stored in local time (America/Chicago), served in UTC
+        self.assertTrue("<datestamp>2011-01-01T18:00:00Z</datestamp>" in pages[0])
+        self.assertTrue("<identifier>" in self.oai(verb="ListIdentifiers",
+                metadataPrefix="oai_dc", until="2011-01-01T18:00:00Z"))
+
+    def test_get_record(self):
+        io = models.InformationObject.objects.get(identifier="Foobar")
+        response = self.oai(verb="GetRecord", metadataPrefix="oai_dc",
+                identifier="oai:testserver:%d" % io.oai_local_identifier)
+        self.assertTrue("<dc:publisher>The Land of Testing</dc:publisher>" in response)
+        self.assertTrue("<dc:date>2011-09-01</dc:date>" in response)
+
+
+class ChangeLogTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_changes_since(self):
+        from djqubit import changelog
+        changes, token = changelog.changes_since(None)
+        self.assertEqual([], changes)
+
+        root = models.InformationObject.objects.get(pk=models.InformationObject.ROOT_ID)
+        io = models.InformationObject(identifier="Logged", parent=root, source_culture="en")
+        io.save()
+        io.save()
+        io.set_i18n("en", dict(title="Logged title"))
+        old = models.InformationObject.objects.get(identifier="KCL0001")
+        oldpk = old.pk
+        old.delete()
+
+        changes, token = changelog.changes_since(token)
+        self.assertEqual([
+            (root.pk, None, "update"),  # nested-set shift
+            (io.pk, None, "insert"),
+            (io.pk, None, "update"),
+            (io.pk, "en", "insert"),
+            (root.pk, None, "update"),
+            (281, None, "update"),
+            (oldpk, None, "update"),
+            (io.pk, None, "update"),
+            (oldpk, None, "delete"),
+        ], [(c.object_id, c.culture, c.action) for c in changes])
+
+        rows = dict(((r["id"], r["culture"]), r) for r in changelog.delta(changes))
+        self.assertEqual(5, len(rows))
+        self.assertEqual(("insert", "Logged"), (rows[(io.pk, None)]["action"],
+                rows[(io.pk, None)]["data"]["identifier"]))
+        self.assertEqual("Logged title", rows[(io.pk, "en")]["data"]["title"])
+        self.assertEqual(("update", 1), (rows[(root.pk, None)]["action"],
+                rows[(root.pk, None)]["data"]["lft"]))
+        self.assertEqual((None, "delete"), (rows[(oldpk, None)]["data"],
+                rows[(oldpk, None)]["action"]))
+
+        self.assertEqual(([], token), changelog.changes_since(token))
+
+    def test_late_commits(self):
+        import datetime
+        from django.db.models import Max
+        from djqubit import changelog
+        last = models.ChangeLog.objects.aggregate(Max("pk"))["pk__max"] or 0
+        now = datetime.datetime.now()
+        def log(pk, created_at=now):
+            models.ChangeLog.objects.create(pk=pk, object_id=1, class_name="QubitInformationObject",
+                    action=models.ChangeLog.UPDATE, created_at=created_at)
+        log(last + 3)
+        changes, token = changelog.changes_since(str(last))
+        self.assertEqual([last + 3], [c.pk for c in changes])
+        self.assertEqual("%d:%d-%d" % (last + 3, last + 1, last + 2), token)
+        # a transaction which allocated last + 2 commits late
+        log(last + 2)
+        changes, token = changelog.changes_since(token)
+        self.assertEqual([last + 2], [c.pk for c in changes])
+        self.assertEqual("%d:%d" % (last + 3, last + 1), token)
+        self.assertEqual(([], token), changelog.changes_since(token))
+        # ids left missing for longer than LOOKBACK are given up
+        log(last + 5, now - changelog.LOOKBACK - datetime.timedelta(hours=1))
+        changes, token = changelog.changes_since(token)
+        self.assertEqual([last + 5], [c.pk for c in changes])
+        self.assertEqual("%d:%d" % (last + 5, last + 1), token)
+
+    def test_gaps_capped(self):
+        from django.db.models import Max
+        from djqubit import changelog
+        last = models.ChangeLog.objects.aggregate(Max("pk"))["pk__max"] or 0
+        token = changelog.format_token(last + 400,
+                [(last + 2 * i, last + 2 * i) for i in range(1, 151)])
+        # one query for the log rows and one for the ranges' neighbours
+        with self.assertNumQueries(2):
+            changes, token = changelog.changes_since(token)
+        missing = changelog.parse_token(token)[1]
+        self.assertEqual(changelog.MAX_GAPS, len(missing))
+        self.assertEqual((last + 102, last + 102), missing[0])
+
+    def test_subtract(self):
+        from djqubit.changelog import subtract
+        self.assertEqual([(1, 2), (4, 4), (7, 10)], subtract([(1, 5), (7, 10)], [3, 5, 6]))
+
+
+class EventDateTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_parse_date_range(self):
+        import datetime
+        from djqubit.dates import parse_date_range
+        d = datetime.date
+        cases = [
+            ("1933-1945", (d(1933, 1, 1), d(1945, 12, 31))),
+            ("ca. 1933 - 1945", (d(1933, 1, 1), d(1945, 12, 31))),
+            (u"1914\u201318", (d(1914, 1, 1), d(1918, 12, 31))),
+            ("1940s", (d(1940, 1, 1), d(1949, 12, 31))),
+            ("[1938?]", (d(1938, 1, 1), d(1938, 12, 31))),
+            ("12 March 1938", (d(1938, 3, 12), d(1938, 3, 12))),
+            ("February 1940", (d(1940, 2, 1), d(1940, 2, 29))),
+            ("1938-03-12", (d(1938, 3, 12), d(1938, 3, 12))),
+            ("1938-03", (d(1938, 3, 1), d(1938, 3, 31))),
+            ("1938-11", (d(1938, 11, 1), d(1938, 11, 30))),
+            ("1938-45", (d(1938, 1, 1), d(1945, 12, 31))),
+            ("1938-03-12 to 1939-01", (d(1938, 3, 12), d(1939, 1, 31))),
+            ("12/03/1938", (d(1938, 3, 12), d(1938, 3, 12))),
+            ("1933/1945", (d(1933, 1, 1), d(1945, 12, 31))),
+            ("1933/45", (d(1933, 1, 1), d(1945, 12, 31))),
+            ("1938-03-12/1939-01", (d(1938, 3, 12), d(1939, 1, 31))),
+            ("from 1933/1945", (d(1933, 1, 1), d(1945, 12, 31))),
+            ("19330101/19451231", (d(1933, 1, 1), d(1945, 12, 31))),
+            ("before 1900", (None, d(1900, 12, 31))),
+            ("1945-1933", (None, None)),
+            ("n.d.", (None, None)),
+        ]
+        for text, expected in cases:
+            self.assertEqual(expected, parse_date_range(text), text)
+
+    def test_overlapping_in_subtree(self):
+        import datetime
+        io = models.InformationObject.objects.get(identifier="Foobar")
+        events = models.Event.objects.of_type(models.Term.CREATION_ID)\
+                .overlapping(datetime.date(2011, 9, 2), datetime.date(2011, 12, 31))\
+                .in_subtree(io)
+        self.assertEqual([286], [e.pk for e in events])
+        child = models.InformationObject.objects.get(identifier="KCL0001")
+        self.assertEqual(0, models.Event.objects.in_subtree(child).count())
+        self.assertEqual([285, 286], [e.pk for e in models.Event.objects\
+                .overlapping(end=datetime.date(2011, 9, 5)).chronological()])
+
+    def test_normalize_event_dates(self):
+        import datetime
+        from djqubit.dates import normalize_event_dates
+        models.Event.objects.update(start_date=None, end_date=None)
+        models.EventI18N.objects.filter(base=286).update(date="1933-1945")
+        self.assertEqual(2, normalize_event_dates())
+        event = models.Event.objects.get(pk=286)
+        self.assertEqual((datetime.date(1933, 1, 1), datetime.date(1945, 12, 31)),
+                (event.start_date, event.end_date))
+        self.assertEqual(0, normalize_event_dates())
+
+
+class FacetTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_subtree_facets(self):
+        root = models.InformationObject.objects.get(pk=models.InformationObject.ROOT_ID)
+        with self.assertNumQueries(4):
+            facets = root.facets(use_cache=False)
+        self.assertEqual({278: 1, 280: 1}, facets["repository"].counts())
+        self.assertEqual({None: 2}, facets["digital_objects__media_type"].counts())
+        self.assertEqual(1, len(facets["level_of_description"]))
+        value, label, count = list(facets["level_of_description"])[0]
+        self.assertEqual((190, 2), (value, count))
+        self.assertEqual(models.Term.objects.get(pk=190).i18n.all()[0].name, label)
+        self.assertTrue("The Land of Testing" in [label for value, label, count
+                in facets["repository"]])
+
+    def test_cached_facets(self):
+        io = models.InformationObject.objects.get(identifier="Foobar")
+        self.assertEqual({280: 1}, io.facets(["repository"])["repository"].counts())
+        with self.assertNumQueries(1):
+            io.facets(["repository"])
+        child = models.InformationObject.objects.get(identifier="KCL0001")
+        child.repository_id = 278
+        child.save()
+        self.assertEqual({278: 1}, io.facets(["repository"])["repository"].counts())
+
+
+class StagedImportTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_staged_merge(self):
+        from djqubit.staging import StagedImport
+        existing = models.Slug.objects.all()[0]
+        existing.slug = "museum"
+        existing.save()
+        staged = StagedImport()
+        staged.load([
+            dict(line=2, identifier="ehri2GB", name=" The Archive ", country_code="GB",
+                email="not an email", comments="Checked", city="London"),
+            dict(line=3, identifier="ehri3GB", name="the archive", country_code="GB"),
+            dict(line=4, identifier="ehri4", name=""),
+            dict(line=5, identifier="ehri5NL", name="Museum", english_name="Other",
+                country_code="NL"),
+        ])
+        staged.validate()
+        staged.deduplicate()
+        staged.allocate()
+        self.assertEqual([(3, "duplicate of line 2"), (4, "missing name")],
+                staged.rejected())
+
+        root = models.Actor.objects.get(pk=models.Actor.ROOT_ID)
+        self.assertEqual(2, staged.merge("en", properties=dict(script="Latn")))
+        self.assertEqual(0, staged.merge("en"))
+
+        repo = models.Repository.objects.get(identifier="ehri2GB")
+        self.assertEqual("The Archive", repo.get_i18n("en", "authorized_form_of_name"))
+        self.assertEqual("the-archive", repo.slug.slug)
+        self.assertEqual((root.pk, root.rgt, root.rgt + 1), (repo.parent_id, repo.lft, repo.rgt))
+        self.assertEqual(root.rgt + 4, models.Actor.objects.get(pk=root.pk).rgt)
+        contact = repo.contacts.get()
+        self.assertEqual((None, "GB"), (contact.email, contact.country_code))
+        self.assertEqual("London", contact.get_i18n("en", "city"))
+        self.assertEqual("Checked", repo.notes.get().get_i18n("en", "content"))
+        self.assertEqual("Latn", repo.properties.get(name="script").get_i18n("en", "value"))
+
+        other = models.Repository.objects.get(identifier="ehri5NL")
+        self.assertEqual("museum-1", other.slug.slug)
+        self.assertEqual("Other", other.other_names.get().get_i18n("en", "name"))
+
+
+class RepositoryMatchTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_index(self):
+        from djqubit.matching import RepositoryIndex
+        index = RepositoryIndex()
+        index.add(1, [u"Archiv der Akademie der K\xfcnste"], "DE", "Berlin")
+        index.add(2, [u"Staatsarchiv Hamburg"], "DE", website="http://www.hamburg.de/")
+        index.add(3, [u"Archiv der Akademie der Kunste"], "AT")
+        self.assertEqual(1, index.match("ARCHIV DER AKADEMIE DER KUNSTE", "de"))
+        self.assertEqual(set([1]), index.candidates(frozenset(["kunste"]), "DE"))
+        self.assertEqual(2, index.match("Hamburg State Archives", "DE",
+                email="info@hamburg.de", other_names=["Staatsarchiv Hamburg"]))
+        self.assertEqual(None, index.match("Akademie", "DE"))
+        self.assertEqual(None, index.match("Archiv der Akademie der Kunste", "NL"))
+
+    def test_staged_match_updates(self):
+        from djqubit.staging import StagedImport
+        repo = models.Repository.objects.get(pk=278)
+        before = models.Repository.objects.count()
+        serial = models.ContactInformation.objects.get(actor=278).serial_number
+        staged = StagedImport()
+        staged.load([dict(line=2, identifier=repo.identifier, name="the land of testing!",
+                telephone="555 1234")])
+        staged.validate()
+        staged.deduplicate()
+        staged.allocate()
+        self.assertEqual([(2, 278)], staged.matched())
+        self.assertEqual(1, staged.merge("en"))
+        self.assertEqual(before, models.Repository.objects.count())
+        self.assertEqual("the land of testing!",
+                models.Repository.objects.get(pk=278).get_i18n("en", "authorized_form_of_name"))
+        contact = models.ContactInformation.objects.get(actor=278)
+        self.assertEqual(("555 1234", serial + 1), (contact.telephone, contact.serial_number))
+
+    def test_staged_match_adds_contact(self):
+        from djqubit.staging import StagedImport
+        models.ContactInformation.objects.filter(actor=278).delete()
+        serial = models.Object._base_manager.get(pk=278).serial_number
+        staged = StagedImport()
+        staged.load([dict(line=2, identifier="Test Institution", name="The Land of Testing",
+                telephone="555 1234", city="London")])
+        staged.validate()
+        staged.deduplicate()
+        staged.allocate()
+        self.assertEqual([(2, 278)], staged.matched())
+        self.assertEqual(1, staged.merge("en"))
+        contact = models.ContactInformation.objects.get(actor=278)
+        self.assertEqual(("555 1234", True, "London"), (contact.telephone,
+                contact.primary_contact, contact.get_i18n("en", "city")))
+        self.assertEqual(serial + 1, models.Object._base_manager.get(pk=278).serial_number)
+
+    def test_alias_per_path(self):
+        import os, tempfile
+        from django.db import connections
+        from djqubit.staging import staging_alias
+        first, second = tempfile.mktemp(), tempfile.mktemp()
+        aliases = [staging_alias(first), staging_alias(second), staging_alias(first)]
+        try:
+            self.assertEqual(aliases[0], aliases[2])
+            self.assertNotEqual(aliases[0], aliases[1])
+            self.assertEqual(second, connections.databases[aliases[1]]["NAME"])
+        finally:
+            for alias in set(aliases):
+                del connections.databases[alias]
+            for path in (first, second):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class MappingTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    spec = {
+        "culture": "en",
+        "parts": [
+            {"name": "repository", "model": "Repository",
+             "fields": {
+                 "identifier": {"columns": ["Code"], "transforms": ["upper"],
+                                "format": "imp{line}{0}"},
+                 "parent_id": {"value": 3},
+                 "entity_type_id": {"value": 131},
+                 "description_status_id": {"column": "Status", "transforms": [["term", 33]]}},
+             "i18n": {"authorized_form_of_name": {"column": "Name",
+                                                  "transforms": ["strip", ["truncate", 10]]}},
+             "slug": "authorized_form_of_name"},
+            {"name": "note", "model": "Note", "link": "object_id", "required": "content",
+             "fields": {"type_id": {"value": 127}},
+             "i18n": {"content": {"column": "Note", "transforms": ["empty_null"]}}},
+        ],
+    }
+
+    def test_extract(self):
+        from djqubit.mapping import Mapping, MappingError
+        status = models.TermI18N.objects.filter(base__taxonomy=33)[0]
+        extract = Mapping(self.spec).compile(["Name", "Code", "Status", "Note"])
+        rows = [[" Archive of Things ", "gb", status.name.encode("utf8"), ""]] * 3
+        with self.assertNumQueries(1):
+            records = [extract(row, line) for line, row in enumerate(rows, 2)]
+        fields, i18n = records[1]["repository"]
+        self.assertEqual("imp3GB", fields["identifier"])
+        self.assertEqual(status.base_id, fields["description_status_id"])
+        self.assertEqual({"authorized_form_of_name": u"Archive of"}, i18n)
+        self.assertEqual(({"type_id": 127}, {"content": None}), records[0]["note"])
+        self.assertRaises(MappingError, Mapping(self.spec).compile, ["Name"])
+
+    def test_save(self):
+        from djqubit.mapping import Mapping, MappedImporter
+        mapping = Mapping(self.spec)
+        extract = mapping.compile(["Name", "Code", "Status", "Note"])
+        importer = MappedImporter(mapping)
+        first = importer.save(extract(["Mapped", "nl", "", "A note"], 2))
+        second = importer.save(extract(["Mapped", "nl", "", ""], 3))
+        self.assertEqual("imp2NL", models.Repository.objects.get(pk=first.pk).identifier)
+        self.assertEqual("Mapped", first.get_i18n("en", "authorized_form_of_name"))
+        self.assertEqual(("mapped", "mapped-1"), (first.slug.slug, second.slug.slug))
+        self.assertEqual("A note", first.notes.get().get_i18n("en", "content"))
+        self.assertEqual(0, second.notes.count())
+
+
+class EADImportTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    ead = """<?xml version="1.0" encoding="UTF-8"?>
+<ead xmlns="urn:isbn:1-931666-22-9">
+  <eadheader><eadid>test</eadid></eadheader>
+  <archdesc level="fonds">
+    <did>
+      <unitid>F1</unitid>
+      <unittitle>Papers of A. Person</unittitle>
+      <unitdate normal="19330101/19451231">1933-1945</unitdate>
+      <origination><persname>Person, A.</persname></origination>
+    </did>
+    <scopecontent><head>Scope</head><p>First.</p><p>Second  para.</p></scopecontent>
+    <controlaccess><corpname>The Land of Testing</corpname></controlaccess>
+    <dsc>
+      <c01 level="series">
+        <did><unitid>S1</unitid><unittitle>Letters</unittitle></did>
+        <c02 level="file"><did><unittitle>Letter 1</unittitle>
+          <unitdate>12 March 1938</unitdate></did>
+          <odd><p>Torn.</p></odd></c02>
+      </c01>
+      <c01 level="series"><did><unittitle>Diaries</unittitle></did></c01>
+    </dsc>
+  </archdesc>
+</ead>"""
+
+    def test_import(self):
+        import datetime
+        from StringIO import StringIO
+        from django.db.models import Max
+        from djqubit.ead import EADImporter
+        parent = models.InformationObject.objects.get(identifier="Foobar")
+        child = models.InformationObject.objects.get(identifier="KCL0001")
+        actors = models.Actor.objects.count()
+        # The test schema keeps one culture per term; make sure it is English.
+        models.TermI18N.objects.filter(base=187).update(name="Series", culture="en")
+        logged = models.ChangeLog.objects.aggregate(Max("pk"))["pk__max"] or 0
+        importer = EADImporter(parent, batch_size=2)
+        self.assertEqual(4, importer.run(StringIO(self.ead)))
+        # the shifted ancestors are logged, the new rows only as inserts
+        self.assertEqual(set([parent.pk, models.InformationObject.ROOT_ID]), set(
+                models.ChangeLog.objects.filter(pk__gt=logged, class_name="QubitInformationObject",
+                action=models.ChangeLog.UPDATE).values_list("object_id", flat=True)))
+
+        fonds = models.InformationObject.objects.get(identifier="F1")
+        self.assertEqual((parent.pk, 5, 12), (fonds.parent_id, fonds.lft, fonds.rgt))
+        self.assertEqual((2, 13), models.InformationObject.objects\
+                .filter(pk=parent.pk).values_list("lft", "rgt")[0])
+        self.assertEqual(14, models.InformationObject.objects.get(
+                pk=models.InformationObject.ROOT_ID).rgt)
+        self.assertEqual((3, 4), models.InformationObject.objects\
+                .filter(pk=child.pk).values_list("lft", "rgt")[0])
+        self.assertEqual(["Letters", "Letter 1", "Diaries"],
+                [io.get_i18n("en", "title") for io in fonds.get_descendants().order_by("lft")])
+        self.assertEqual([(6, 9), (7, 8), (10, 11)], list(fonds.get_descendants()\
+                .order_by("lft").values_list("lft", "rgt")))
+        series = models.InformationObject.objects.get(identifier="S1")
+        self.assertEqual(fonds.pk, series.parent_id)
+        self.assertEqual(u"First.\n\nSecond para.", fonds.get_i18n("en", "scope_and_content"))
+        self.assertEqual(187, series.level_of_description_id)
+
+        event = fonds.events.get()
+        self.assertEqual((datetime.date(1933, 1, 1), datetime.date(1945, 12, 31)),
+                (event.start_date, event.end_date))
+        self.assertEqual("Person, A.", event.actor.get_i18n("en", "authorized_form_of_name"))
+        self.assertEqual(actors + 1, models.Actor.objects.count())
+        self.assertEqual([278], [r.object_id_id for r in
+                models.Relation.objects.filter(subject_id=fonds.pk)])
+        letter = series.get_descendants().get()
+        self.assertEqual("Torn.", letter.notes.get().get_i18n("en", "content"))
+
+
+class CloneSubtreeTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_clone(self):
+        root = models.InformationObject.objects.get(pk=1)
+        source = models.InformationObject.objects.get(identifier="Foobar")
+        before = models.InformationObject.objects.count()
+        copy = source.clone(root)
+
+        self.assertEqual(before + 2, models.InformationObject.objects.count())
+        self.assertEqual((root.pk, 6, 9), (copy.parent_id, copy.lft, copy.rgt))
+        self.assertEqual(10, models.InformationObject.objects.get(pk=1).rgt)
+        self.assertEqual("Foobar", copy.identifier)
+        self.assertNotEqual(source.oai_local_identifier, copy.oai_local_identifier)
+        child = copy.get_descendants().get()
+        self.assertEqual(("KCL0001", copy.pk, 7, 8),
+                (child.identifier, child.parent_id, child.lft, child.rgt))
+        i18n = models.InformationObjectI18N.objects
+        self.assertEqual(list(i18n.filter(base=source.pk).values_list("culture", "title")),
+                list(i18n.filter(base=copy.pk).values_list("culture", "title")))
+        events = copy.events.order_by("start_date")
+        self.assertEqual(2, events.count())
+        self.assertEqual(["2011-09-01", None], [models.EventI18N.objects.get(base=e.pk).date
+                for e in events])
+        notes = models.NoteI18N.objects.order_by("base__type", "content")
+        self.assertEqual(list(notes.filter(base__object_id=source.pk).values_list("content")),
+                list(notes.filter(base__object_id=copy.pk).values_list("content")))
+        self.assertFalse(set(models.Note.objects.filter(object_id=source.pk))
+                & set(models.Note.objects.filter(object_id=copy.pk)))
+        slug = models.Slug.objects.filter(object_id=source.pk).values_list("slug", flat=True)
+        self.assertEqual(["%s-%d" % (s, copy.pk) for s in slug],
+                list(models.Slug.objects.filter(object_id=copy.pk).values_list("slug", flat=True)))
+        self.assertEqual(2, models.ChangeLog.objects.filter(object_id__in=[copy.pk, child.pk],
+                action=models.ChangeLog.INSERT).count())
+        # The source is untouched.
+        source = models.InformationObject.objects.get(pk=source.pk)
+        self.assertEqual((2, 5), (source.lft, source.rgt))
+        self.assertEqual(2, source.events.count())
+
+    def test_clone_in_batches(self):
+        from djqubit import clone, subtree
+        batches = clone.batches
+        clone.batches = lambda items: subtree.batches(items, 1)
+        try:
+            self.test_clone()
+        finally:
+            clone.batches = batches
+
+    def test_clone_mixed_classes(self):
+        source = models.Actor.objects.get(pk=models.Actor.ROOT_ID)
+        copy = source.clone(models.Actor.objects.get(pk=277))
+        children = list(models.Actor.objects.filter(parent=copy.pk).order_by("lft"))
+        self.assertEqual(2, len(children))
+        for child, original in zip(children, (278, 280)):
+            repo = models.Repository.objects.get(pk=child.pk)
+            self.assertEqual(models.Repository.objects.get(pk=original).identifier,
+                    repo.identifier)
+            self.assertEqual(models.Actor.objects.get(pk=original).get_i18n("en",
+                    "authorized_form_of_name"), repo.get_i18n("en", "authorized_form_of_name"))
+            self.assertEqual(models.RepositoryI18N.objects.filter(base=original).count(),
+                    models.RepositoryI18N.objects.filter(base=repo.pk).count())
+        self.assertFalse(models.Repository.objects.filter(pk=copy.pk).exists())
+
+
+class SubtreeStatusTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_publish(self):
+        source = models.InformationObject.objects.get(identifier="Foobar")
+        child = models.InformationObject.objects.get(identifier="KCL0001")
+        models.Status(object_id=child, type_id=models.Term.STATUS_TYPE_PUBLICATION_ID,
+                status_id=models.Term.PUBLICATION_STATUS_DRAFT_ID).save()
+        stamp = source.updated_at
+        self.assertEqual(2, source.set_status(models.Term.STATUS_TYPE_PUBLICATION_ID,
+                models.Term.PUBLICATION_STATUS_PUBLISHED_ID))
+        statuses = models.Status.objects.filter(type=models.Term.STATUS_TYPE_PUBLICATION_ID)
+        self.assertEqual(sorted([(source.pk, 160), (child.pk, 160)]),
+                sorted(statuses.values_list("object_id", "status")))
+        self.assertTrue(models.InformationObject.objects.get(pk=source.pk).updated_at > stamp)
+        self.assertFalse(statuses.filter(object_id=1).exists())
+        self.assertEqual(2, models.ChangeLog.objects.filter(action=models.ChangeLog.UPDATE,
+                object_id__in=[source.pk, child.pk]).count())
+        # Nothing left to change.
+        self.assertEqual(0, source.set_status(models.Term.STATUS_TYPE_PUBLICATION_ID,
+                models.Term.PUBLICATION_STATUS_PUBLISHED_ID))
+
+
+class SerialNumberTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_conflict(self):
+        first = models.InformationObject.objects.get(identifier="Foobar")
+        second = models.InformationObject.objects.get(identifier="Foobar")
+        serial = first.serial_number
+        first.identifier = "Foobar2"
+        first.save()
+        self.assertEqual(serial + 1, first.serial_number)
+        self.assertEqual(serial + 1, models.InformationObject.objects.get(pk=first.pk).serial_number)
+        second.identifier = "Foobar3"
+        self.assertRaises(models.ConcurrentUpdateError, second.save)
+        self.assertEqual("Foobar2", models.InformationObject.objects.get(pk=first.pk).identifier)
+        # Saving again from the same instance is fine.
+        first.save()
+        self.assertEqual(serial + 2, first.serial_number)
+
+    def test_failed_save(self):
+        io = models.InformationObject.objects.get(identifier="Foobar")
+        stored = lambda: models.Object._base_manager.get(pk=io.pk).serial_number
+        io.parent = models.InformationObject.objects.get(pk=284)
+        def fail():
+            raise ValueError
+        io.update_nested_set = fail
+        self.assertRaises(ValueError, io.save)
+        self.assertFalse("_serial_claimed" in io.__dict__)
+        # the instance agrees with the database, whether or not the
+        # claim was rolled back, and the next save claims again
+        serial = stored()
+        self.assertEqual(serial, io.serial_number)
+        del io.update_nested_set
+        io.save()
+        self.assertEqual((serial + 1, serial + 1), (io.serial_number, stored()))
+
+    def test_retry(self):
+        stale = models.Note.objects.filter(object_id=281)[0]
+        models.Note.objects.get(pk=stale.pk).save()
+        attempts = []
+        def edit():
+            note = stale if not attempts else models.Note.objects.get(pk=stale.pk)
+            attempts.append(note)
+            note.scope = "edited"
+            note.save()
+        models.retry_on_conflict(edit)
+        self.assertEqual(2, len(attempts))
+        self.assertEqual("edited", models.Note.objects.get(pk=stale.pk).scope)
+
+
+class DowncastTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_downcast(self):
+        from django.db import connection
+        from django.conf import settings
+        from djqubit.polymorphic import downcast
+        ids = [281, 278, 187, 285, 284, 999999]
+        settings.DEBUG, debug = True, settings.DEBUG
+        try:
+            start = len(connection.queries)
+            objs = downcast(ids)
+            # One for the class names, one per class.
+            self.assertEqual(5, len(connection.queries) - start)
+        finally:
+            settings.DEBUG = debug
+        self.assertEqual([models.InformationObject, models.Repository, models.Term,
+                models.Event, models.InformationObject], [o.__class__ for o in objs])
+        self.assertEqual(ids[:-1], [o.pk for o in objs])
+
+        note = models.Note.objects.filter(object_id=281)[0]
+        objs = downcast([note.object_id, models.Term.objects.get(pk=187)], i18n=True)
+        self.assertEqual([models.InformationObject, models.Term], [o.__class__ for o in objs])
+        self.assertTrue(hasattr(objs[0], "_i18n_cache"))
+
+
+class PrefetchQubitTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_prefetch(self):
+        from django.db import connection
+        from django.conf import settings
+        from djqubit.prefetch import prefetch_qubit
+        qs = models.InformationObject.objects.filter(pk__in=[281, 284]).order_by("lft")
+        expected = [(list(o.notes.order_by("pk")), list(o.events.order_by("pk")))
+                for o in qs]
+        settings.DEBUG, debug = True, settings.DEBUG
+        try:
+            objs = prefetch_qubit(qs, include=["notes", "events", "slug"], cultures=["en"])
+            start = len(connection.queries)
+            found = [(list(o.notes.all()), list(o.events.all())) for o in objs]
+            [o.slug for o in objs if hasattr(o, "_slug_cache")]
+            [n.get_i18n("en", "content") for notes, _ in found for n in notes]
+            self.assertEqual(0, len(connection.queries) - start)
+            self.assertEqual(objs[0].pk, found[0][0][0].object_id.pk)
+            self.assertEqual(0, len(connection.queries) - start)
+        finally:
+            settings.DEBUG = debug
+        self.assertEqual(expected, found)
+        # Filtering still goes to the database.
+        self.assertEqual(0, objs[0].notes.filter(pk=-1).count())
+
+
+class ProjectionTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_project(self):
+        from djqubit.projection import project
+        repo = models.Repository.objects.get(pk=278)
+        name = models.ActorI18N.objects.filter(base=278).values_list("culture",
+                "authorized_form_of_name").get()
+        rows = list(project(models.Repository.objects.filter(pk=278),
+                ["identifier", "class_name", "parent", "lft"],
+                i18n=["authorized_form_of_name"], culture=name[0]))
+        self.assertEqual(1, len(rows))
+        row = rows[0]
+        self.assertEqual((repo.identifier, repo.class_name, repo.parent_id, repo.lft, name[1]),
+                tuple(row))
+        self.assertEqual(name[1], row.authorized_form_of_name)
+        self.assertEqual((), row.__slots__)
+        # Missing cultures fall back, then come back empty.
+        models.ActorI18N.objects.filter(base=278).update(culture="en")
+        rows = project(models.Repository.objects.filter(pk__in=[278, 280]),
+                ["identifier"], i18n=["authorized_form_of_name", "history"], culture="fr")
+        self.assertEqual(name[1], dict((r.identifier, r.authorized_form_of_name)
+                for r in rows)[repo.identifier])
+        self.assertEqual(models.Repository.objects.count(),
+                len(list(project(models.Repository.objects.all(), ["identifier"], chunk_size=1))))
+
+
+class BulkLoadTest(SnapshotTransactionTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def indexes(self, table):
+        from django.db import connection
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = %s AND sql IS NOT NULL", [table])
+        return sorted(r[0] for r in cursor.fetchall())
+
+    def test_bulk_load(self):
+        from django.db import connection, IntegrityError
+        from djqubit.bulkload import bulk_load, check_foreign_keys
+        if connection.vendor != "sqlite":
+            return
+        before = self.indexes("object")
+        self.assertTrue(before)
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA synchronous")
+        synchronous = cursor.fetchone()[0]
+        with bulk_load(defer=[models.Object]):
+            self.assertEqual([], self.indexes("object"))
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(0, cursor.fetchone()[0])
+            models.Slug.objects.filter(object_id=281).update(slug="bulk")
+        self.assertEqual(before, self.indexes("object"))
+        cursor.execute("PRAGMA synchronous")
+        self.assertEqual(synchronous, cursor.fetchone()[0])
+        self.assertEqual([], check_foreign_keys())
+        # indexes are only deferred when asked for
+        with bulk_load():
+            self.assertEqual(before, self.indexes("object"))
+
+        def load():
+            with bulk_load(defer=[]):
+                cursor.execute("INSERT INTO note (object_id, lft, rgt, created_at, "
+                        "updated_at, source_culture, serial_number) "
+                        "VALUES (999999, 0, 0, '2011-01-01', '2011-01-01', 'en', 0)")
+        self.assertRaises(IntegrityError, load)
+
+
+class TenantTest(TestCase):
+    SETTINGS = ("DJQUBIT_TENANTS", "DJQUBIT_TENANT_CONNECTIONS")
+
+    def setUp(self):
+        from django.conf import settings
+        from django.db import connections
+        self.saved = dict((name, getattr(settings, name)) for name in self.SETTINGS
+                if hasattr(settings, name))
+        self.aliases = set(connections.databases)
+        settings.DJQUBIT_TENANTS = dict((name, {
+                "ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"})
+                for name in ("kcl", "niod"))
+        settings.DJQUBIT_TENANT_CONNECTIONS = 1
+
+    def tearDown(self):
+        from django.conf import settings
+        from django.db import connections
+        from djqubit import tenants
+        tenants.set_tenant(None)
+        for name in self.SETTINGS:
+            if name in self.saved:
+                setattr(settings, name, self.saved[name])
+            else:
+                delattr(settings, name)
+        for alias in set(connections.databases) - self.aliases:
+            if alias in connections._connections:
+                connections._connections.pop(alias).close()
+            del connections.databases[alias]
+        tenants._local.used = None
+
+    def test_tenant_routing(self):
+        from djqubit import tenants
+        from djqubit.router import DjqubitRouter
+        router = DjqubitRouter()
+        self.assertEqual("djqubit", router.db_for_read(models.Repository))
+        with tenants.tenant("kcl") as alias:
+            self.assertEqual("djqubit_tenant_kcl", alias)
+            self.assertEqual(alias, router.db_for_write(models.Repository))
+            with tenants.tenant("niod"):
+                self.assertEqual("niod", tenants.current_tenant())
+                self.assertEqual("djqubit_tenant_niod", router.db_for_read(models.Repository))
+                # the enclosing tenant's connection is not closed
+                self.assertEqual(["djqubit_tenant_kcl", "djqubit_tenant_niod"],
+                        list(tenants._local.used))
+            self.assertEqual(alias, router.db_for_read(models.Repository))
+        self.assertEqual(None, tenants.current_alias())
+        with tenants.tenant("niod"):
+            self.assertEqual(["djqubit_tenant_niod"], list(tenants._local.used))
+        self.assertTrue(router.allow_syncdb("djqubit_tenant_kcl", models.Repository))
+        self.assertRaises(tenants.UnknownTenantError, tenants.tenant_alias, "nobody")
+
+    def test_run_for_tenants(self):
+        from djqubit import tenants
+        self.assertEqual({"kcl": "djqubit_tenant_kcl", "niod": "djqubit_tenant_niod"},
+                tenants.run_for_tenants(lambda name: tenants.current_alias(), workers=2))
+        # each job closes its connection, whatever the per-thread cap
+        from django.conf import settings
+        settings.DJQUBIT_TENANT_CONNECTIONS = 8
+        self.assertEqual({"kcl": ["djqubit_tenant_kcl"], "niod": ["djqubit_tenant_niod"]},
+                tenants.run_for_tenants(lambda name: list(tenants._local.used), workers=1))
+
+
+class AutocompleteTest(SnapshotTransactionTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+    urls = "djqubit.urls"
+
+    def tearDown(self):
+        from djqubit import autocomplete
+        autocomplete.discard_index()
+
+    def test_lookup(self):
+        from djqubit import autocomplete
+        index = autocomplete.get_index()
+        self.assertEqual([("actor", 278, "The Land of Testing")],
+                index.lookup(u"the land", kinds=["actor"]))
+        self.assertEqual([("term", 273, "Business process")], index.lookup(u"BUSINESS  pro"))
+        self.assertEqual([], index.lookup(u"Bundesarchiv"))
+
+        repo = models.Repository.objects.get(pk=278)
+        repo.set_i18n("en", dict(authorized_form_of_name=u"Bundesarchiv Au\xdfenstelle"))
+        self.assertEqual([("actor", 278, u"Bundesarchiv Au\xdfenstelle")],
+                index.lookup(u"bundesarchiv au"))
+        self.assertEqual([], index.lookup(u"the land"))
+        models.ActorI18N.objects.get(pk=278).delete()
+        self.assertEqual([], index.lookup(u"bundes"))
+
+    def test_snapshot(self):
+        import os, tempfile
+        from djqubit.autocomplete import NameIndex
+        index = NameIndex.build()
+        path = tempfile.mktemp()
+        try:
+            index.save(path)
+            loaded = NameIndex.load(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(index.lookup(u"c", limit=50), loaded.lookup(u"c", limit=50))
+        self.assertTrue(loaded.lookup(u"the institute"))
+
+    def test_stale_snapshot(self):
+        import os, tempfile
+        from django.conf import settings
+        from djqubit import autocomplete
+        path = settings.DJQUBIT_AUTOCOMPLETE_SNAPSHOT = tempfile.mktemp()
+        try:
+            autocomplete.get_index()
+            self.assertTrue(os.path.exists(path))
+            models.Repository.objects.get(pk=278).set_i18n("en",
+                    dict(authorized_form_of_name=u"Bundesarchiv"))
+            autocomplete.discard_index()
+            self.assertEqual([("actor", 278, u"Bundesarchiv")],
+                    autocomplete.get_index().lookup(u"bundes"))
+            self.assertEqual(autocomplete.freshness("default"),
+                    autocomplete.NameIndex.load(path).marker)
+        finally:
+            del settings.DJQUBIT_AUTOCOMPLETE_SNAPSHOT
+            os.remove(path)
+
+    def test_transactions(self):
+        from django.db import transaction
+        from djqubit import autocomplete
+        autocomplete.get_index()
+        repo = models.Repository.objects.get(pk=278)
+        try:
+            with transaction.commit_on_success():
+                repo.set_i18n("en", dict(authorized_form_of_name=u"Rolled back"))
+                self.assertEqual([], autocomplete.get_index().lookup(u"rolled"))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual([], autocomplete.get_index().lookup(u"rolled"))
+        self.assertTrue(autocomplete.get_index().lookup(u"the land"))
+        with transaction.commit_on_success():
+            repo.set_i18n("en", dict(authorized_form_of_name=u"Committed"))
+        self.assertEqual([("actor", 278, u"Committed")],
+                autocomplete.get_index().lookup(u"committed"))
+        self.assertEqual([], autocomplete.get_index().lookup(u"the land"))
+
+    def test_transaction_on_other_thread(self):
+        import threading
+        from django.db import transaction
+        from djqubit import autocomplete
+        autocomplete.get_index()
+        started, finish = threading.Event(), threading.Event()
+        def writer():
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            transaction.set_dirty()
+            autocomplete.defer("default", models.Actor, [278])
+            started.set()
+            finish.wait()
+            transaction.set_clean()
+            transaction.leave_transaction_management()
+        thread = threading.Thread(target=writer)
+        thread.start()
+        started.wait()
+        try:
+            # this thread's clean state says nothing of the writer's
+            autocomplete.get_index()
+            self.assertEqual(1, len(autocomplete._pending["default"]))
+        finally:
+            finish.set()
+            thread.join()
+        autocomplete.get_index()
+        self.assertEqual({}, autocomplete._pending["default"])
+
+    def test_view(self):
+        import json
+        response = self.client.get("/autocomplete/", {"q": "the l", "kind": "actor"})
+        self.assertEqual([{"kind": "actor", "id": 278, "name": "The Land of Testing"}],
+                json.loads(response.content))
+
+
+class SubtreeDumpTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def test_dump_and_load(self):
+        import os, tempfile
+        from djqubit.subtree import dump_subtree, load_subtree
+        root = models.InformationObject.objects.get(pk=1)
+        source = models.InformationObject.objects.get(identifier="Foobar")
+        before = models.InformationObject.objects.count()
+        path = tempfile.mktemp()
+        try:
+            self.assertTrue(dump_subtree(source, path))
+            copy = load_subtree(path, root)
+        finally:
+            os.remove(path)
+
+        self.assertEqual(before + 2, models.InformationObject.objects.count())
+        self.assertEqual((root.pk, 6, 9), (copy.parent_id, copy.lft, copy.rgt))
+        self.assertEqual(10, models.InformationObject.objects.get(pk=1).rgt)
+        self.assertEqual(("Foobar", source.created_at), (copy.identifier, copy.created_at))
+        self.assertNotEqual(source.oai_local_identifier, copy.oai_local_identifier)
+        child = copy.get_descendants().get()
+        self.assertEqual(("KCL0001", copy.pk, 7, 8),
+                (child.identifier, child.parent_id, child.lft, child.rgt))
+        i18n = models.InformationObjectI18N.objects
+        self.assertEqual(list(i18n.filter(base=source.pk).values_list("culture", "title")),
+                list(i18n.filter(base=copy.pk).values_list("culture", "title")))
+        self.assertEqual(sorted(source.events.values_list("start_date", "actor")),
+                sorted(copy.events.values_list("start_date", "actor")))
+        notes = models.NoteI18N.objects.order_by("base__type", "content")
+        self.assertEqual(list(notes.filter(base__object_id=source.pk).values_list("content")),
+                list(notes.filter(base__object_id=copy.pk).values_list("content")))
+        slug = models.Slug.objects.filter(object_id=source.pk).values_list("slug", flat=True)
+        self.assertEqual(["%s-%d" % (s, copy.pk) for s in slug],
+                list(models.Slug.objects.filter(object_id=copy.pk).values_list("slug", flat=True)))
+        self.assertEqual(1, models.ChangeLog.objects.filter(object_id=copy.pk,
+                action=models.ChangeLog.INSERT).count())
+
+    def test_bad_file(self):
+        import gzip, os, tempfile
+        from djqubit.subtree import load_subtree
+        path = tempfile.mktemp()
+        handle = gzip.open(path, "wb")
+        handle.write('{"format": "something else"}\n')
+        handle.close()
+        try:
+            self.assertRaises(ValueError, load_subtree, path,
+                    models.InformationObject.objects.get(pk=1))
+        finally:
+            os.remove(path)
+
+
+class AnnotateI18NTest(SnapshotTestCase):
+    snapshot_fixtures = ["test_fixtures.json"]
+
+    def setUp(self):
+        models.InformationObjectI18N.objects.filter(base=281).update(
+                culture="fr", title="Zebra description")
+
+    def test_fallback_ordering(self):
+        objects = models.InformationObject.objects.exclude(pk=1)
+        with self.assertNumQueries(1):
+            self.assertEqual([(284, "Random Object Number 1"), (281, "Zebra description")],
+                    list(objects.annotate_i18n("title", ["fr"]).order_by("title")
+                        .values_list("pk", "title")))
+        self.assertEqual([(281, None), (284, "Random Object Number 1")],
+                list(objects.annotate_i18n("title").order_by("title").values_list("pk", "title")))
+        self.assertEqual("Zebra description", objects.annotate_i18n("title", ["fr"])
+                .order_by("-title")[0].title)
+
+    def test_filter(self):
+        objects = models.InformationObject.objects.annotate_i18n("title", ["fr"])
+        pks = lambda qs: sorted(qs.values_list("pk", flat=True))
+        self.assertEqual([281], pks(objects.filter(title__istartswith="zeb")))
+        self.assertEqual([281], pks(objects.filter(title="Zebra description", lft__gt=1)))
+        self.assertEqual([1, 281], pks(objects.exclude(title__icontains="object")))
+        self.assertEqual([1], pks(objects.filter(title__isnull=True)))
+        self.assertEqual([281, 284], pks(objects.filter(
+                title__in=["Zebra description", "Random Object Number 1"])))
+
+    def test_exclude_mixed(self):
+        from django.db.models import Q
+        objects = models.InformationObject.objects.annotate_i18n("title", ["fr"])
+        pks = lambda qs: sorted(qs.values_list("pk", flat=True))
+        # rows are dropped only when every lookup matches
+        self.assertEqual([1, 281, 284], pks(objects.exclude(title="Zebra description",
+                level_of_description=-1)))
+        self.assertEqual([1, 284], pks(objects.exclude(title="Zebra description",
+                lft__gt=1)))
+        self.assertEqual([1, 281, 284], pks(objects.exclude(Q(pk=284),
+                title="Zebra description")))
+        self.assertEqual([1, 281], pks(objects.exclude(title="Random Object Number 1")
+                .exclude(title="Zebra description", pk=1)))
+
+    def test_bad_field(self):
+        from django.core.exceptions import FieldError
+        objects = models.InformationObject.objects
+        self.assertRaises(FieldError, objects.annotate_i18n, "nonexistent")
+        self.assertRaises(FieldError, objects.annotate_i18n, "identifier")
+        self.assertRaises(FieldError, objects.annotate_i18n("title").filter, title__year=2000)
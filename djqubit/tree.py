@@ -0,0 +1,157 @@
+"""
+Compact in-memory snapshots of nested-set trees.
+
+A snapshot holds the shape of a subtree in parallel `array` columns,
+ordered by `lft`, so that a tree of a few hundred thousand nodes can
+be held and walked without instantiating any model objects.
+"""
+
+from array import array
+
+from django.core.cache import cache
+from django.db.models import Max, Count
+
+from djqubit.models import FALLBACK_CULTURE, I18NMixin, i18n_model
+
+# Seconds to keep snapshots in the cache.  Stale snapshots are detected
+# by comparing against the subtree's current state anyway.
+CACHE_TIMEOUT = 3600
+
+LEVEL_FIELD = "level_of_description"
+
+
+class TreeSnapshot(object):
+    """Read-only, array-backed copy of a subtree.  Nodes are addressed
+    by id; parent, depth and level lookups are O(1) and children are
+    found by skipping over sibling subtrees."""
+    def __init__(self, rows, titles=None, marker=None):
+        """`rows` is an iterable of (id, lft, rgt, parent_id, level_id)
+        in `lft` order; `titles` maps culture -> {id: title}."""
+        self.ids = array("i")
+        self.lft = array("i")
+        self.rgt = array("i")
+        self.parents = array("i")
+        self.levels = array("i")
+        self.depths = array("i")
+        self.marker = marker
+        self.index = {}
+        stack = []
+        for id, lft, rgt, parent, level in rows:
+            while stack and self.rgt[stack[-1]] < lft:
+                stack.pop()
+            pos = len(self.ids)
+            self.index[id] = pos
+            self.ids.append(id)
+            self.lft.append(lft)
+            self.rgt.append(rgt)
+            self.parents.append(parent or 0)
+            self.levels.append(level or 0)
+            self.depths.append(len(stack))
+            stack.append(pos)
+
+        # Titles are stored per culture as lists parallel to `ids`,
+        # with repeated strings shared between nodes and cultures.
+        self.titles = {}
+        strings = {}
+        for culture, names in (titles or {}).iteritems():
+            column = [None] * len(self.ids)
+            for id, name in names.iteritems():
+                if id in self.index and name is not None:
+                    column[self.index[id]] = strings.setdefault(name, name)
+            self.titles[culture] = column
+
+    @classmethod
+    def load(cls, node, cultures=None, use_cache=True):
+        """Snapshot the subtree under `node` (inclusive).  If `cultures`
+        is None titles are loaded in all available cultures."""
+        model = node.__class__
+        subtree = model.objects.filter(lft__gte=node.lft, rgt__lte=node.rgt)
+        state = subtree.aggregate(Max("updated_at"), Count("pk"))
+        marker = (node.lft, node.rgt, state["updated_at__max"], state["pk__count"])
+        key = "djqubit.tree.%s.%s.%s.%s" % (subtree.db, model._meta.db_table, node.pk,
+                ",".join(sorted(cultures)) if cultures is not None else "*")
+        if use_cache:
+            snapshot = cache.get(key)
+            if snapshot is not None and snapshot.marker == marker:
+                return snapshot
+
+        fields = ["pk", "lft", "rgt", "parent"]
+        if LEVEL_FIELD in [f.name for f in model._meta.fields]:
+            fields.append(LEVEL_FIELD)
+        rows = subtree.order_by("lft").values_list(*fields)
+        if len(fields) == 4:
+            rows = (row + (None,) for row in rows)
+
+        titles = {}
+        if issubclass(model, I18NMixin):
+            i18n = i18n_model(model).objects.filter(
+                    base__lft__gte=node.lft, base__rgt__lte=node.rgt)
+            if cultures is not None:
+                i18n = i18n.filter(culture__in=set(cultures) | set([FALLBACK_CULTURE]))
+            for id, culture, name in i18n.values_list(
+                    "base", "culture", model.i18n_name_field):
+                titles.setdefault(culture, {})[id] = name
+
+        snapshot = cls(rows, titles, marker)
+        if use_cache:
+            cache.set(key, snapshot, CACHE_TIMEOUT)
+        return snapshot
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def __iter__(self):
+        """Iterate over node ids in tree (`lft`) order."""
+        return iter(self.ids)
+
+    @property
+    def root(self):
+        return self.ids[0] if self.ids else None
+
+    def parent(self, id):
+        """Parent id of a node, or None for the snapshot root."""
+        pos = self.index[id]
+        if pos == 0:
+            return None
+        return self.parents[pos]
+
+    def depth(self, id):
+        """Depth of a node relative to the snapshot root."""
+        return self.depths[self.index[id]]
+
+    def level(self, id):
+        """Level of description term id for a node, or None."""
+        return self.levels[self.index[id]] or None
+
+    def is_leaf(self, id):
+        pos = self.index[id]
+        return self.rgt[pos] == self.lft[pos] + 1
+
+    def children(self, id):
+        """Ids of a node's direct children, in order."""
+        pos = self.index[id]
+        end = self.rgt[pos]
+        found = []
+        child = pos + 1
+        while child < len(self.ids) and self.lft[child] < end:
+            found.append(self.ids[child])
+            # skip over the child's own subtree
+            child += (self.rgt[child] - self.lft[child] + 1) // 2
+        return found
+
+    def descendant_count(self, id):
+        pos = self.index[id]
+        return (self.rgt[pos] - self.lft[pos] - 1) // 2
+
+    def title(self, id, culture=FALLBACK_CULTURE):
+        """Title of a node in `culture`, falling back to the fallback
+        culture."""
+        pos = self.index[id]
+        for c in (culture, FALLBACK_CULTURE):
+            column = self.titles.get(c)
+            if column is not None and column[pos] is not None:
+                return column[pos]
+        return None
@@ -0,0 +1,9 @@
+"""
+DjQubit URLs.
+"""
+from django.conf.urls.defaults import patterns, url
+
+urlpatterns = patterns('djqubit.views',
+    url(r'^oai/$', 'oai', name='djqubit_oai'),
+    url(r'^autocomplete/$', 'autocomplete_names', name='djqubit_autocomplete'),
+)
@@ -1 +1,387 @@
-# Create your views here.
+"""
+DjQubit views.
+
+OAI-PMH 2.0 provider for information objects, serving `oai_dc`.
+
+Lists are paged by keyset over (Object.updated_at, id) rather than by
+OFFSET, so every page costs the same however deep into a harvest it
+is; the position is carried in the resumption token.  Responses are
+streamed a page at a time, with the i18n rows, events and related
+actors for each page fetched in a handful of batch queries.
+
+Harvesting relies on an index on `object.updated_at`.  syncdb creates
+it; on an existing Qubit database add it with:
+
+    CREATE INDEX object_updated_at ON object (updated_at);
+"""
+
+import base64
+import calendar
+import datetime
+import json
+import time
+from collections import defaultdict
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
+from django.http import HttpResponse
+
+from djqubit import autocomplete, models
+
+# Records per ListRecords/ListIdentifiers response.
+PAGE_SIZE = 100
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+DAY_FORMAT = "%Y-%m-%d"
+# Resumption tokens keep the full timestamp, as the keyset filter
+# would repeat rows differing from it in microseconds only.
+TOKEN_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+OAI_DC = "oai_dc"
+
+# (metadataPrefix, schema, namespace)
+METADATA_FORMATS = (
+    (OAI_DC, "http://www.openarchives.org/OAI/2.0/oai_dc.xsd",
+        "http://www.openarchives.org/OAI/2.0/oai_dc/"),
+)
+
+HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"
+         xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+         xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/ http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd">
+<responseDate>%s</responseDate>
+"""
+
+DC_HEADER = """<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+           xmlns:dc="http://purl.org/dc/elements/1.1/"
+           xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/oai_dc/ http://www.openarchives.org/OAI/2.0/oai_dc.xsd">
+"""
+
+
+class OAIError(Exception):
+    """An OAI-PMH protocol error, reported in the response body."""
+    def __init__(self, code, message):
+        super(OAIError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def repository_identifier(request):
+    return getattr(settings, "OAI_REPOSITORY_IDENTIFIER", request.get_host())
+
+
+def oai_identifier(request, io):
+    return "oai:%s:%d" % (repository_identifier(request), io.oai_local_identifier)
+
+
+def parse_identifier(request, identifier):
+    prefix = "oai:%s:" % repository_identifier(request)
+    if not identifier.startswith(prefix):
+        raise OAIError("idDoesNotExist", "Unknown identifier")
+    try:
+        return int(identifier[len(prefix):])
+    except ValueError:
+        raise OAIError("idDoesNotExist", "Unknown identifier")
+
+
+def datestamp(value):
+    """Format a local time, as Qubit stores them, as a UTC datestamp."""
+    return datetime.datetime.utcfromtimestamp(
+            time.mktime(value.timetuple())).strftime(DATE_FORMAT)
+
+
+def parse_date(value, until=False):
+    """Parse a UTC date argument into local time.  With `until` the end
+    of the second or day it names is returned, to compare with <."""
+    if value is None:
+        return None
+    for fmt, step in ((DATE_FORMAT, datetime.timedelta(seconds=1)),
+            (DAY_FORMAT, datetime.timedelta(days=1))):
+        try:
+            date = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if until:
+            date += step
+        return datetime.datetime.fromtimestamp(calendar.timegm(date.timetuple()))
+    raise OAIError("badArgument", "Invalid date: %s" % value)
+
+
+def encode_token(prefix, fromdate, until, updated, pk):
+    parts = [prefix, fromdate or "", until or "", updated.strftime(TOKEN_DATE_FORMAT), str(pk)]
+    return base64.urlsafe_b64encode("|".join(parts))
+
+
+def decode_token(token):
+    try:
+        prefix, fromdate, until, updated, pk = base64.urlsafe_b64decode(
+                str(token)).split("|")
+        return (prefix, fromdate or None, until or None,
+                datetime.datetime.strptime(updated, TOKEN_DATE_FORMAT), int(pk))
+    except (ValueError, TypeError):
+        raise OAIError("badResumptionToken", "Invalid resumption token")
+
+
+def harvestable():
+    """Information objects exposed to harvesters, in harvest order."""
+    return models.InformationObject.objects\
+            .exclude(pk=models.InformationObject.ROOT_ID)\
+            .order_by("updated_at", "pk")
+
+
+def element(name, value):
+    if value is None or value == "":
+        return ""
+    return u"<%s>%s</%s>\n" % (name, escape(unicode(value)), name)
+
+
+class RecordPage(object):
+    """A page of information objects with the data needed to render
+    their oai_dc records loaded in batch."""
+    def __init__(self, objects):
+        self.objects = objects
+        models.prefetch_i18n(objects)
+        self.events = defaultdict(list)
+        events = list(models.Event.objects.filter(
+                information_object__in=[io.pk for io in objects]))
+        models.prefetch_i18n(events)
+        actorids = set(e.actor_id for e in events if e.actor_id)
+        actorids.update(io.repository_id for io in objects if io.repository_id)
+        self.actors = models.Actor.objects.in_bulk(list(actorids))
+        models.prefetch_i18n(self.actors.values())
+        for event in events:
+            self.events[event.information_object_id].append(event)
+
+    def i18n(self, obj, culture, name):
+        try:
+            return obj.get_i18n(culture, name)
+        except ObjectDoesNotExist:
+            return None
+
+    def actor_name(self, pk):
+        actor = self.actors.get(pk)
+        if actor is None:
+            return None
+        return self.i18n(actor, actor.source_culture, "authorized_form_of_name")
+
+    def dublin_core(self, request, io):
+        culture = io.source_culture
+        parts = [DC_HEADER]
+        parts.append(element("dc:title", self.i18n(io, culture, "title")))
+        for event in self.events[io.pk]:
+            if event.type_id == models.Term.CREATION_ID and event.actor_id:
+                parts.append(element("dc:creator", self.actor_name(event.actor_id)))
+        parts.append(element("dc:description", self.i18n(io, culture, "scope_and_content")))
+        if io.repository_id:
+            parts.append(element("dc:publisher", self.actor_name(io.repository_id)))
+        for event in self.events[io.pk]:
+            date = self.i18n(event, culture, "date") or event.start_date
+            parts.append(element("dc:date", date))
+        parts.append(element("dc:format", self.i18n(io, culture, "extent_and_medium")))
+        parts.append(element("dc:identifier", io.identifier))
+        parts.append(element("dc:identifier", oai_identifier(request, io)))
+        parts.append(element("dc:rights", self.i18n(io, culture, "access_conditions")))
+        parts.append("</oai_dc:dc>\n")
+        return u"".join(parts)
+
+
+def header(request, io):
+    return u"<header>\n%s%s</header>\n" % (
+            element("identifier", oai_identifier(request, io)),
+            element("datestamp", datestamp(io.updated_at)))
+
+
+def record(request, page, io):
+    return u"<record>\n%s<metadata>\n%s</metadata>\n</record>\n" % (
+            header(request, io), page.dublin_core(request, io))
+
+
+def identify(request, args):
+    earliest = harvestable()[:1]
+    yield u"<Identify>\n"
+    yield element("repositoryName", getattr(settings, "OAI_REPOSITORY_NAME", "Qubit"))
+    yield element("baseURL", request.build_absolute_uri(request.path))
+    yield element("protocolVersion", "2.0")
+    for name, email in settings.ADMINS:
+        yield element("adminEmail", email)
+    if earliest:
+        yield element("earliestDatestamp", datestamp(earliest[0].updated_at))
+    yield element("deletedRecord", "no")
+    yield element("granularity", "YYYY-MM-DDThh:mm:ssZ")
+    yield u"</Identify>\n"
+
+
+def list_metadata_formats(request, args):
+    if "identifier" in args:
+        get_record_object(request, args["identifier"])
+    yield u"<ListMetadataFormats>\n"
+    for prefix, schema, namespace in METADATA_FORMATS:
+        yield u"<metadataFormat>\n%s%s%s</metadataFormat>\n" % (
+                element("metadataPrefix", prefix),
+                element("schema", schema),
+                element("metadataNamespace", namespace))
+    yield u"</ListMetadataFormats>\n"
+
+
+def list_sets(request, args):
+    raise OAIError("noSetHierarchy", "Sets are not supported")
+
+
+def get_record_object(request, identifier):
+    local = parse_identifier(request, identifier)
+    try:
+        return harvestable().get(oai_local_identifier=local)
+    except models.InformationObject.DoesNotExist:
+        raise OAIError("idDoesNotExist", "Unknown identifier")
+
+
+def get_record(request, args):
+    check_prefix(args.get("metadataPrefix"))
+    io = get_record_object(request, args["identifier"])
+    page = RecordPage([io])
+    yield u"<GetRecord>\n%s</GetRecord>\n" % record(request, page, io)
+
+
+def check_prefix(prefix):
+    if prefix not in [f[0] for f in METADATA_FORMATS]:
+        raise OAIError("cannotDisseminateFormat", "Unsupported metadataPrefix")
+
+
+def list_pages(args):
+    """Validate list arguments and return a function producing the
+    first page, so that errors are raised before streaming starts."""
+    if "resumptionToken" in args:
+        prefix, fromdate, until, lastupdated, lastpk = decode_token(
+                args["resumptionToken"])
+    else:
+        prefix, fromdate, until = (args.get("metadataPrefix"),
+                args.get("from"), args.get("until"))
+        lastupdated = lastpk = None
+    check_prefix(prefix)
+    qs = harvestable()
+    if fromdate:
+        qs = qs.filter(updated_at__gte=parse_date(fromdate))
+    if until:
+        qs = qs.filter(updated_at__lt=parse_date(until, until=True))
+    if lastupdated is not None:
+        qs = qs.filter(Q(updated_at__gt=lastupdated)
+                | Q(updated_at=lastupdated, pk__gt=lastpk))
+    objects = list(qs[:PAGE_SIZE + 1])
+    if not objects:
+        raise OAIError("noRecordsMatch", "No matching records")
+    token = None
+    if len(objects) > PAGE_SIZE:
+        objects = objects[:PAGE_SIZE]
+        last = objects[-1]
+        token = encode_token(prefix, fromdate, until, last.updated_at, last.pk)
+    return objects, token
+
+
+def resumption(token):
+    if token is None:
+        return u"<resumptionToken/>\n"
+    return element("resumptionToken", token)
+
+
+def list_records(request, args, objects, token):
+    page = RecordPage(objects)
+    yield u"<ListRecords>\n"
+    for io in objects:
+        yield record(request, page, io)
+    yield resumption(token)
+    yield u"</ListRecords>\n"
+
+
+def list_identifiers(request, args, objects, token):
+    yield u"<ListIdentifiers>\n"
+    for io in objects:
+        yield header(request, io)
+    yield resumption(token)
+    yield u"</ListIdentifiers>\n"
+
+
+# verb -> (handler, required args, optional args, is list)
+VERBS = {
+    "Identify": (identify, (), (), False),
+    "ListMetadataFormats": (list_metadata_formats, (), ("identifier",), False),
+    "ListSets": (list_sets, (), ("resumptionToken",), False),
+    "GetRecord": (get_record, ("identifier", "metadataPrefix"), (), False),
+    "ListRecords": (list_records, ("metadataPrefix",), ("from", "until", "set"), True),
+    "ListIdentifiers": (list_identifiers, ("metadataPrefix",), ("from", "until", "set"), True),
+}
+
+
+def check_args(verb, args):
+    handler, required, optional, islist = VERBS[verb]
+    names = set(args) - set(["verb"])
+    if islist and "resumptionToken" in names:
+        if names != set(["resumptionToken"]):
+            raise OAIError("badArgument", "resumptionToken is an exclusive argument")
+        return
+    for name in required:
+        if name not in names:
+            raise OAIError("badArgument", "Missing argument: %s" % name)
+    for name in names:
+        if name not in required and name not in optional:
+            raise OAIError("badArgument", "Illegal argument: %s" % name)
+    if "set" in names:
+        raise OAIError("noSetHierarchy", "Sets are not supported")
+
+
+def stream(request, verb, args, body):
+    attrs = u"".join(u' %s="%s"' % (k, escape(v, {'"': "&quot;"}))
+            for k, v in sorted(args.items()))
+    yield HEADER % datetime.datetime.utcnow().strftime(DATE_FORMAT)
+    yield u"<request%s>%s</request>\n" % (attrs,
+            escape(request.build_absolute_uri(request.path)))
+    for chunk in body:
+        yield chunk
+    yield u"</OAI-PMH>\n"
+
+
+def oai(request):
+    """OAI-PMH endpoint."""
+    params = request.POST if request.method == "POST" else request.GET
+    args = dict((k, v) for k, v in params.items())
+    verb = args.get("verb")
+    try:
+        if verb not in VERBS:
+            raise OAIError("badVerb", "Illegal OAI verb")
+        check_args(verb, args)
+        handler, required, optional, islist = VERBS[verb]
+        if islist:
+            objects, token = list_pages(args)
+            body = handler(request, args, objects, token)
+        else:
+            # run up to the first chunk so protocol errors surface here
+            body = handler(request, args)
+            first = body.next()
+            body = _chain(first, body)
+    except OAIError, err:
+        if err.code in ("badVerb", "badArgument"):
+            args = {}
+        body = [u'<error code="%s">%s</error>\n' % (err.code, escape(err.message))]
+    return HttpResponse(stream(request, verb, args, body),
+            mimetype="text/xml; charset=utf-8")
+
+
+def _chain(first, rest):
+    yield first
+    for chunk in rest:
+        yield chunk
+
+
+def autocomplete_names(request):
+    """Actor and term names starting with `q`, as JSON.  `kind` may be
+    given (repeatedly) to restrict the kinds returned."""
+    try:
+        limit = min(int(request.GET.get("limit", autocomplete.LIMIT)), 100)
+    except ValueError:
+        limit = autocomplete.LIMIT
+    kinds = [k for k in request.GET.getlist("kind") if k in autocomplete.KINDS]
+    matches = autocomplete.get_index().lookup(request.GET.get("q", u""),
+            kinds=kinds or None, limit=limit)
+    return HttpResponse(json.dumps([dict(kind=kind, id=id, name=name)
+            for kind, id, name in matches]), mimetype="application/json")
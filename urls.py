@@ -6,6 +6,7 @@ admin.autodiscover()
 
 urlpatterns = patterns('',
     # Examples:
+    url(r'^', include('djqubit.urls')),
     url(r'^', include(admin.site.urls)),
     # url(r'^ehridata/', include('ehridata.foo.urls')),
 